@@ -0,0 +1,198 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+
+# Cache entries live next to the uploads, under this prefix in the pdf-uploads container
+BLOB_CACHE_PREFIX = "_cache/"
+CHUNK_CACHE_PREFIX = "_chunks/"
+
+
+def cache_key(content_hash, model, prompt_version):
+    """Build the cache key for a document: content hash + model name + prompt version"""
+    raw = f"{content_hash}:{model}:{prompt_version}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class LocalAnalysisCache:
+    """Disk-backed cache with TTL and size-based (oldest first) eviction.
+
+    Eviction runs after a write, at most once per evict_interval seconds.
+    """
+
+    def __init__(self, directory, ttl_seconds, max_bytes, evict_interval=0):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self.evicted_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        # Write to a temp file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        now = time.time()
+        if now - self.evicted_at < self.evict_interval:
+            return
+        self.evicted_at = now
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class BlobAnalysisCache:
+    """Cache stored as JSON blobs in the uploads container, with TTL and size-based eviction.
+
+    Eviction lists every entry under the prefix, so it runs at most once per evict_interval seconds.
+    """
+
+    def __init__(self, container_client, ttl_seconds, max_bytes, prefix=BLOB_CACHE_PREFIX, evict_interval=0):
+        self.container_client = container_client
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.evict_interval = evict_interval
+        self.evicted_at = 0.0
+
+    def get(self, key):
+        try:
+            downloader = self.container_client.get_blob_client(f"{self.prefix}{key}.json").download_blob()
+        except ResourceNotFoundError:
+            return None
+        age = time.time() - downloader.properties.last_modified.timestamp()
+        if age > self.ttl_seconds:
+            return None
+        try:
+            return json.loads(downloader.readall())
+        except ValueError:
+            return None
+
+    def set(self, key, value):
+        payload = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.container_client.get_blob_client(f"{self.prefix}{key}.json").upload_blob(payload, overwrite=True)
+        self._evict()
+
+    def _evict(self):
+        now = time.time()
+        if now - self.evicted_at < self.evict_interval:
+            return
+        self.evicted_at = now
+        entries = []
+        total = 0
+        for blob in self.container_client.list_blobs(name_starts_with=self.prefix):
+            if now - blob.last_modified.timestamp() > self.ttl_seconds:
+                self._delete(blob.name)
+                continue
+            entries.append((blob.last_modified, blob.size, blob.name))
+            total += blob.size
+
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._delete(name)
+            total -= size
+
+    def _delete(self, name):
+        try:
+            self.container_client.delete_blob(name)
+        except ResourceNotFoundError:
+            pass
+
+
+_analysis_cache = None
+
+
+def get_analysis_cache(container_client):
+    """Return the configured cache backend (ANALYSIS_CACHE_BACKEND: blob, local or none)"""
+    global _analysis_cache
+
+    backend = os.getenv('ANALYSIS_CACHE_BACKEND', 'blob').lower()
+    if backend == 'none':
+        return None
+
+    if not _analysis_cache:
+        ttl_seconds = int(os.getenv('ANALYSIS_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))  # Default 7 days
+        max_bytes = int(os.getenv('ANALYSIS_CACHE_MAX_MB', '200')) * 1024 * 1024
+        if backend == 'local':
+            directory = os.getenv('ANALYSIS_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'pdf-ai-analyzer-cache')
+            _analysis_cache = LocalAnalysisCache(directory, ttl_seconds, max_bytes)
+        else:
+            _analysis_cache = BlobAnalysisCache(container_client, ttl_seconds, max_bytes)
+        logging.info(f"Analysis cache backend: {backend}")
+
+    return _analysis_cache
+
+
+_chunk_cache = None
+
+
+def get_chunk_cache(container_client):
+    """Return the cache for per-chunk analyses (CHUNK_CACHE_BACKEND: blob, local or none;
+    defaults to ANALYSIS_CACHE_BACKEND)"""
+    global _chunk_cache
+
+    backend = os.getenv('CHUNK_CACHE_BACKEND', os.getenv('ANALYSIS_CACHE_BACKEND', 'blob')).lower()
+    if backend == 'none':
+        return None
+
+    if not _chunk_cache:
+        ttl_seconds = int(os.getenv('CHUNK_CACHE_TTL_SECONDS', str(30 * 24 * 3600)))  # Default 30 days
+        max_bytes = int(os.getenv('CHUNK_CACHE_MAX_MB', '500')) * 1024 * 1024
+        # A document writes one entry per chunk, so the store is swept every few minutes instead of per write
+        if backend == 'local':
+            directory = os.getenv('CHUNK_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'pdf-ai-analyzer-chunks')
+            _chunk_cache = LocalAnalysisCache(directory, ttl_seconds, max_bytes, evict_interval=300)
+        else:
+            _chunk_cache = BlobAnalysisCache(container_client, ttl_seconds, max_bytes, CHUNK_CACHE_PREFIX, evict_interval=300)
+        logging.info(f"Chunk cache backend: {backend}")
+
+    return _chunk_cache
@@ -0,0 +1,70 @@
+import re
+import unicodedata
+
+ENTITY_FIELDS = ("personer", "selskaper", "offentlige_etater")
+RED_FLAG_FIELDS = ("uvanlige_formuleringer", "avvik_og_kritikk", "økonomiske_størrelser", "varsler_og_mangler", "andre_røde_flagg")
+
+# Leading titles and trailing company forms that don't change who/what an entity is
+_TITLES = {"dr", "prof", "professor", "adv", "advokat", "herr", "fru", "frk", "siv", "ing", "statsråd", "minister"}
+_COMPANY_FORMS = {"as", "asa", "sa", "ans", "da", "ba", "ab", "ltd", "inc", "gmbh"}
+
+_NORWEGIAN_FOLD = str.maketrans({"æ": "ae", "ø": "o", "å": "a"})
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return [str(item) for item in value if str(item).strip()]
+    if isinstance(value, str) and value.strip():
+        return [value]
+    return []
+
+
+def entity_key(name):
+    """Matching key for an entity name: case, whitespace, diacritics, titles and company forms ignored"""
+    words = re.sub(r"[^\w&]+", " ", unicodedata.normalize('NFKC', name).casefold()).split()
+    while len(words) > 1 and words[0] in _TITLES:
+        words.pop(0)
+    while len(words) > 1 and words[-1] in _COMPANY_FORMS:
+        words.pop()
+    # Fold diacritics last, so e.g. the surname "Ås" isn't mistaken for the company form "AS"
+    text = " ".join(words).translate(_NORWEGIAN_FOLD)
+    return "".join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+
+
+def _text_key(text):
+    """Matching key for free-text items such as red flags: case and whitespace ignored"""
+    return " ".join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+def _merge_items(lists, key):
+    """Union of lists in first-seen order; of equal items, the spelling with diacritics is kept"""
+    merged = {}
+    for items in lists:
+        for item in items:
+            item = " ".join(item.split())
+            item_key = key(item)
+            if not item_key:
+                continue
+            kept = merged.get(item_key)
+            if kept is None or (kept.isascii() and not item.isascii()):
+                merged[item_key] = item
+    return list(merged.values())
+
+
+def merge_structured(analyses):
+    """Deterministically merge nøkkelinformasjon and røde_flagg from parsed chunk analyses"""
+    info = [analysis.get("nøkkelinformasjon") or {} for analysis in analyses]
+    flags = [analysis.get("røde_flagg") or {} for analysis in analyses]
+
+    nøkkelinformasjon = {
+        field: _merge_items([_as_list(part.get(field)) for part in info], entity_key)
+        for field in ENTITY_FIELDS
+    }
+    periods = _merge_items([_as_list(part.get("tidsperiode")) for part in info], _text_key)
+    nøkkelinformasjon["tidsperiode"] = "; ".join(periods)
+
+    røde_flagg = {
+        field: _merge_items([_as_list(part.get(field)) for part in flags], _text_key)
+        for field in RED_FLAG_FIELDS
+    }
+    return nøkkelinformasjon, røde_flagg
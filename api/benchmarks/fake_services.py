@@ -0,0 +1,431 @@
+"""Fake Blob Storage, AI Foundry and Document Intelligence services that inject throttling and latency.
+
+FakeBlobServiceClient, FakeChatClient and FakeDocumentClient stand in for the SDK
+clients in-process (CannedDocumentResult builds Document Intelligence results for
+them). serve_fake_endpoint runs a local HTTP chat completions endpoint for the real
+ChatCompletionsClient. Run this file to drive the shared rate limiter against the
+HTTP fake:
+
+    python benchmarks/fake_services.py --requests 60 --workers 12 --throttle 0.3
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from rate_limit import LimitedChatClient, RateLimiter  # noqa: E402
+
+FAKE_ANALYSIS = {
+    "sammendrag": ["Et punkt fra denne delen"],
+    "nøkkelinformasjon": {"personer": ["Kari Nordmann"], "selskaper": ["Eksempel AS"], "offentlige_etater": [], "tidsperiode": "2024"},
+    "røde_flagg": {"uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [], "varsler_og_mangler": [], "andre_røde_flagg": []}
+}
+
+
+class Throttle:
+    """Decides which calls fail: a random fraction, and/or every call above max_concurrent in flight"""
+
+    def __init__(self, rate=0.0, max_concurrent=None, retry_after=1.0, latency=0.0, seed=None):
+        self.rate = rate
+        self.max_concurrent = max_concurrent
+        self.retry_after = retry_after
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.counts = {"calls": 0, "throttled": 0}
+
+    def enter(self):
+        """Returns False if this call should get a 429"""
+        with self.lock:
+            self.counts["calls"] += 1
+            over = self.max_concurrent is not None and self.in_flight >= self.max_concurrent
+            if over or self.random.random() < self.rate:
+                self.counts["throttled"] += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+
+def throttled_error(retry_after):
+    response = SimpleNamespace(
+        status_code=429, reason="Too Many Requests", headers={"Retry-After": str(retry_after)},
+        text=lambda encoding=None: '{"error": {"code": "429", "message": "Rate limit is exceeded"}}',
+        content_type="application/json", request=None
+    )
+    return HttpResponseError(response=response)
+
+
+class FakeChatClient:
+    """In-process ChatCompletionsClient: answers every call with FAKE_ANALYSIS.
+
+    completion_tokens pads the answer with extra summary points to about that many
+    tokens; with tokens_per_second, generating them adds to the latency.
+    invalid_json_rate is the fraction of answers cut off mid-JSON. Usage reports
+    the prompt at about 4 characters per token.
+    """
+
+    def __init__(self, throttle=None, answer=None, completion_tokens=None, tokens_per_second=None,
+                 invalid_json_rate=0.0, seed=None):
+        self.throttle = throttle or Throttle()
+        answer = dict(answer or FAKE_ANALYSIS)
+        if completion_tokens:
+            filler = "Utfyllende punkt fra delen med tall, navn og datoer."
+            points = max(1, (completion_tokens * 4 - len(json.dumps(answer, ensure_ascii=False))) // (len(filler) + 4))
+            answer["sammendrag"] = list(answer["sammendrag"]) + [filler] * points
+        self.answer = json.dumps(answer, ensure_ascii=False)
+        self.tokens_per_second = tokens_per_second
+        self.invalid_json_rate = invalid_json_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def complete(self, stream=False, **kwargs):
+        if not self.throttle.enter():
+            raise throttled_error(self.throttle.retry_after)
+        completion_tokens = len(self.answer) // 4
+        try:
+            time.sleep(self.throttle.latency + (completion_tokens / self.tokens_per_second if self.tokens_per_second else 0))
+        finally:
+            self.throttle.leave()
+        with self.lock:
+            invalid = self.random.random() < self.invalid_json_rate
+        answer = self.answer[:len(self.answer) // 2] if invalid else self.answer
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in kwargs.get("messages", [])) // 4
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, total_tokens=prompt_tokens + completion_tokens
+        )
+        if stream:
+            return iter([
+                SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=answer[i:i + 16]))])
+                for i in range(0, len(answer), 16)
+            ])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=answer))], usage=usage)
+
+
+class FakeDocumentClient:
+    """In-process DocumentAnalysisClient; result(model_id, document, **kwargs) builds the analyze result.
+
+    latency is spent when the operation is started, poll_latency when its result is fetched.
+    """
+
+    def __init__(self, result, throttle=None, poll_latency=0.0):
+        self.build_result = result
+        self.throttle = throttle or Throttle()
+        self.poll_latency = poll_latency
+
+    def begin_analyze_document(self, model_id, document, **kwargs):
+        if not self.throttle.enter():
+            raise throttled_error(self.throttle.retry_after)
+        try:
+            time.sleep(self.throttle.latency)
+        finally:
+            self.throttle.leave()
+        result = self.build_result(model_id, document, **kwargs)
+
+        def poll():
+            time.sleep(self.poll_latency)
+            return result
+        return SimpleNamespace(result=poll)
+
+
+_WORDS = (
+    "kommunen styret vedtak budsjett revisjon avvik kontroll tiltak risiko rapport selskapet "
+    "tilskudd kontrakt leverandør anskaffelse regnskap merforbruk innsyn frist mangler"
+).split()
+
+_PDF_PAGE = re.compile(rb"/Type\s*/Page(?!s)")
+
+
+def _page_selection(pages):
+    """Page numbers from a Document Intelligence pages argument such as '1-3,7'"""
+    numbers = set()
+    for part in (pages or "").split(","):
+        first, _, last = part.partition("-")
+        if first.strip():
+            numbers.update(range(int(first), int(last or first) + 1))
+    return numbers
+
+
+class CannedDocumentResult:
+    """Builds synthetic prebuilt-read / prebuilt-layout results for FakeDocumentClient.
+
+    The page count is taken from the submitted PDF. Every page has lines_per_page
+    lines of pseudo-Norwegian text, and every table_every-th page is a table, which
+    the read result returns as many short lines (so it is sent on to layout) and the
+    layout result as a table with cells and spans.
+    """
+
+    def __init__(self, lines_per_page=40, table_every=10, table_rows=12, table_columns=4):
+        self.lines_per_page = lines_per_page
+        self.table_every = table_every
+        self.table_rows = table_rows
+        self.table_columns = table_columns
+
+    def _lines(self, page_number):
+        rng = random.Random(page_number)
+        return [" ".join(rng.choice(_WORDS) for _ in range(rng.randint(6, 14))) for _ in range(self.lines_per_page)]
+
+    def _cells(self, page_number):
+        rng = random.Random(-page_number)
+        header = [f"Kolonne {column + 1}" for column in range(self.table_columns)]
+        rows = [[f"{rng.randint(1, 99999):,}".replace(",", " ") for _ in range(self.table_columns)] for _ in range(self.table_rows)]
+        return [header] + rows
+
+    def is_table(self, page_number):
+        return bool(self.table_every) and page_number % self.table_every == 0
+
+    def __call__(self, model_id, document, pages=None, **kwargs):
+        page_count = len(_PDF_PAGE.findall(document)) or 1
+        selected = _page_selection(pages) or set(range(1, page_count + 1))
+        result_pages = []
+        tables = []
+        offset = 0
+        for number in sorted(selected):
+            lines = []
+            if self.is_table(number):
+                cells = self._cells(number)
+                cell_lines = [content for row in cells for content in row]
+                if model_id == "prebuilt-layout":
+                    start = offset
+                    for content in cell_lines:
+                        lines.append(SimpleNamespace(content=content, spans=[SimpleNamespace(offset=offset, length=len(content))]))
+                        offset += len(content) + 1
+                    tables.append(SimpleNamespace(
+                        row_count=len(cells), column_count=self.table_columns,
+                        cells=[
+                            SimpleNamespace(row_index=row, column_index=column, content=content,
+                                            kind="columnHeader" if row == 0 else "content")
+                            for row, values in enumerate(cells) for column, content in enumerate(values)
+                        ],
+                        bounding_regions=[SimpleNamespace(page_number=number)],
+                        spans=[SimpleNamespace(offset=start, length=offset - start)]
+                    ))
+                else:
+                    lines.extend(SimpleNamespace(content=content, spans=None) for content in cell_lines)
+            for content in self._lines(number)[:self.lines_per_page // 4 if self.is_table(number) else None]:
+                lines.append(SimpleNamespace(content=content, spans=[SimpleNamespace(offset=offset, length=len(content))]))
+                offset += len(content) + 1
+            result_pages.append(SimpleNamespace(page_number=number, lines=lines))
+        return SimpleNamespace(pages=result_pages, tables=tables)
+
+
+class _FakeDownloader:
+    def __init__(self, blob, chunk_size=4 * 1024 * 1024):
+        self.data = blob["data"]
+        self.chunk_size = chunk_size
+        self.properties = SimpleNamespace(
+            size=len(self.data), metadata=dict(blob["metadata"]), last_modified=blob["last_modified"]
+        )
+
+    def readall(self):
+        return self.data
+
+    def chunks(self):
+        return (self.data[i:i + self.chunk_size] for i in range(0, len(self.data), self.chunk_size))
+
+
+class _FakeBlobClient:
+    def __init__(self, service, container_name, blob_name):
+        self.service = service
+        self.container_name = container_name
+        self.blob_name = blob_name
+        self.account_name = "fakeaccount"
+        self.url = f"https://fakeaccount.blob.core.windows.net/{container_name}/{blob_name}"
+
+    def _key(self):
+        return (self.container_name, self.blob_name)
+
+    def _get(self):
+        blob = self.service.blobs.get(self._key())
+        if blob is None:
+            raise ResourceNotFoundError("The specified blob does not exist.")
+        return blob
+
+    def _put(self, data, metadata):
+        self.service.blobs[self._key()] = {
+            "data": bytes(data), "metadata": dict(metadata or {}), "last_modified": datetime.now(timezone.utc)
+        }
+
+    def upload_blob(self, data, overwrite=False, metadata=None, **kwargs):
+        self.service.count("upload_blob")
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not overwrite and self._key() in self.service.blobs:
+            raise HttpResponseError(message="The specified blob already exists.")
+        self._put(data, metadata)
+
+    def create_append_blob(self, **kwargs):
+        self.service.count("create_append_blob")
+        self._put(b"", None)
+
+    def append_block(self, data, **kwargs):
+        self.service.count("append_block")
+        with self.service.lock:
+            blob = self._get()
+            blob["data"] += data.encode("utf-8") if isinstance(data, str) else bytes(data)
+
+    def stage_block(self, block_id, data, **kwargs):
+        self.service.count("stage_block")
+        with self.service.lock:
+            self.service.staged.setdefault(self._key(), {})[block_id] = bytes(data)
+
+    def commit_block_list(self, block_list, metadata=None, **kwargs):
+        self.service.count("commit_block_list")
+        with self.service.lock:
+            staged = self.service.staged.pop(self._key(), {})
+        self._put(b"".join(staged[block_id] for block_id in block_list), metadata)
+
+    def download_blob(self, **kwargs):
+        self.service.count("download_blob")
+        return _FakeDownloader(self._get())
+
+    def get_blob_properties(self, **kwargs):
+        self.service.count("get_blob_properties")
+        return _FakeDownloader(self._get()).properties
+
+    def set_blob_metadata(self, metadata=None, **kwargs):
+        self.service.count("set_blob_metadata")
+        self._get()["metadata"] = dict(metadata or {})
+
+    def delete_blob(self, **kwargs):
+        self.service.count("delete_blob")
+        self._get()
+        self.service.blobs.pop(self._key(), None)
+
+
+class _FakeContainerClient:
+    def __init__(self, service, container_name):
+        self.service = service
+        self.container_name = container_name
+
+    def get_blob_client(self, blob):
+        return _FakeBlobClient(self.service, self.container_name, blob)
+
+    def list_blobs(self, name_starts_with=None, include=None, **kwargs):
+        self.service.count("list_blobs")
+        prefix = name_starts_with or ""
+        return [
+            SimpleNamespace(name=name, size=len(blob["data"]), metadata=dict(blob["metadata"]), last_modified=blob["last_modified"])
+            for (container, name), blob in sorted(self.service.blobs.items())
+            if container == self.container_name and name.startswith(prefix)
+        ]
+
+    def delete_blob(self, blob, **kwargs):
+        self.service.count("delete_blob")
+        self.service.blobs.pop((self.container_name, blob), None)
+
+
+class FakeBlobServiceClient:
+    """In-memory BlobServiceClient with the subset of the API the app uses; counts calls by operation"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.blobs = {}   # (container, name) -> {"data", "metadata", "last_modified"}
+        self.staged = {}  # (container, name) -> {block_id: data}
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.credential = SimpleNamespace(account_key="ZmFrZQ==")
+
+    def count(self, operation):
+        with self.lock:
+            self.counts[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_container_client(self, container):
+        return _FakeContainerClient(self, container)
+
+    def get_blob_client(self, container, blob):
+        return _FakeBlobClient(self, container, blob)
+
+
+def serve_fake_endpoint(throttle, port=0):
+    """Start a local /chat/completions endpoint in a background thread; returns (server, url)"""
+    answer = json.dumps(FAKE_ANALYSIS, ensure_ascii=False)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not throttle.enter():
+                body = b'{"error": {"code": "429", "message": "Rate limit is exceeded"}}'
+                self.send_response(429)
+                self.send_header('Retry-After', str(throttle.retry_after))
+            else:
+                try:
+                    time.sleep(throttle.latency)
+                finally:
+                    throttle.leave()
+                body = json.dumps({
+                    "id": "fake", "created": int(time.time()), "model": "fake",
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer}}],
+                    "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150}
+                }).encode('utf-8')
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=60)
+    parser.add_argument('--workers', type=int, default=12, help="concurrent callers, as from several analyses")
+    parser.add_argument('--throttle', type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument('--max-concurrent', type=int, default=4, help="in-flight calls above this get 429")
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--rpm', type=int, default=0)
+    args = parser.parse_args()
+
+    from azure.ai.inference import ChatCompletionsClient
+    from azure.core.credentials import AzureKeyCredential
+
+    throttle = Throttle(args.throttle, args.max_concurrent, args.retry_after, args.latency, seed=1)
+    server, url = serve_fake_endpoint(throttle)
+    limiter = RateLimiter("fake", requests_per_minute=args.rpm, max_concurrency=args.workers, max_retries=8)
+    client = LimitedChatClient(ChatCompletionsClient(endpoint=url, credential=AzureKeyCredential("fake"), retry_total=0), limiter)
+
+    def call(_):
+        client.complete(model="fake", messages=[{"role": "user", "content": "Analyser"}], max_tokens=100)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    print(json.dumps({
+        "seconds": round(elapsed, 2),
+        "endpoint": throttle.counts,
+        "limiter": dict(limiter.stats, concurrency=int(limiter.concurrency.limit))
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+"""End-to-end benchmark of upload and analysis against in-process fakes of every Azure service.
+
+Uploads a synthetic PDF corpus through the upload endpoint and analyzes each
+document with /api/analyze?mode=sync, with Blob Storage, Document Intelligence and
+the model replaced by the fakes in fake_services.py. No Azure resources or network
+are needed. Reports latency (p50/p95) per corpus size, throughput, peak memory and
+calls per stage; --output saves the report and --baseline compares with a saved one:
+
+    python benchmarks/pipeline.py --pages 1,10,50,100,250,500 --documents 3 --output before.json
+    python benchmarks/pipeline.py --pages 1,10,50,100,250,500 --documents 3 --baseline before.json
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_services import (  # noqa: E402
+    CannedDocumentResult, FakeBlobServiceClient, FakeChatClient, FakeDocumentClient, Throttle
+)
+
+# Text for the PDF text layer; the standard Helvetica font only covers ASCII reliably
+_TEXT_WORDS = (
+    "kommunen styret vedtak budsjett revisjon avvik kontroll tiltak risiko rapport selskapet "
+    "tilskudd kontrakt leverandor anskaffelse regnskap merforbruk innsyn frist mangler"
+).split()
+
+# Model calls by stage, recognised from the prompt
+_STAGES = (
+    ("map", "Analyser denne delen"),
+    ("single", "Analyser følgende dokument"),
+    ("synthesis", "Lag et samlet sammendrag"),
+    ("repair", "Reparer denne JSON"),
+)
+
+
+def make_pdf(page_count, scanned_every, lines_per_page, salt):
+    """A PDF with a text layer on every page except every scanned_every-th, which is blank
+    (scanned, so it goes to Document Intelligence). salt makes each document's bytes unique."""
+    import random
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+    writer = PdfWriter()
+    font = DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica")
+    })
+    for number in range(1, page_count + 1):
+        page = writer.add_blank_page(width=595, height=842)
+        if scanned_every and number % scanned_every == 0:
+            continue
+        rng = random.Random(number)
+        lines = [" ".join(rng.choice(_TEXT_WORDS) for _ in range(rng.randint(6, 12))) for _ in range(lines_per_page)]
+        stream = DecodedStreamObject()
+        stream.set_data(("BT /F1 9 Tf 11 TL 40 800 Td " + " ".join(f"({line}) Tj T*" for line in lines) + " ET").encode("ascii"))
+        page[NameObject("/Resources")] = DictionaryObject({NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})})
+        page.replace_contents(stream)
+    writer.add_metadata({"/Title": f"Benchmark {page_count} sider #{salt}"})
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+class StageCountingChatClient:
+    """Counts model calls per pipeline stage before passing them on (retried calls count again)"""
+
+    def __init__(self, client, counts, lock):
+        self.client = client
+        self.counts = counts
+        self.lock = lock
+
+    def complete(self, **kwargs):
+        prompt = str(kwargs.get("messages", [{}])[-1].get("content", ""))
+        stage = next((name for name, marker in _STAGES if marker in prompt), "other")
+        with self.lock:
+            self.counts[f"model.{stage}"] += 1
+        return self.client.complete(**kwargs)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def multipart_upload_request(filename, data):
+    import azure.functions as func
+
+    boundary = "benchmark-boundary"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+        f"Content-Type: application/pdf\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return func.HttpRequest(
+        "POST", "/api/upload", headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}, body=body
+    )
+
+
+def install_fakes(function_app, args, counts):
+    """Point the app's client getters at the fakes, behind the app's own shared rate limiters"""
+    from rate_limit import LimitedChatClient, LimitedDocumentClient, get_limiter
+
+    blob_service = FakeBlobServiceClient(latency=args.blob_latency)
+    canned = CannedDocumentResult(lines_per_page=args.lines_per_page, table_every=args.table_every)
+
+    counts_lock = threading.Lock()
+
+    def document_result(model_id, document, **kwargs):
+        with counts_lock:
+            counts[f"document_intelligence.{model_id}"] += 1
+        return canned(model_id, document, **kwargs)
+
+    document_client = LimitedDocumentClient(
+        FakeDocumentClient(document_result, Throttle(latency=args.di_latency), poll_latency=args.poll_latency),
+        get_limiter("document_intelligence")
+    )
+    chat_client = LimitedChatClient(
+        StageCountingChatClient(FakeChatClient(
+            Throttle(args.throttle, retry_after=args.retry_after, latency=args.latency, seed=1),
+            completion_tokens=args.completion_tokens,
+            tokens_per_second=args.tokens_per_second,
+            invalid_json_rate=args.invalid_json,
+            seed=2
+        ), counts, counts_lock),
+        get_limiter("ai")
+    )
+    function_app.get_blob_service = lambda: blob_service
+    function_app.get_document_client = lambda: document_client
+    function_app.get_chat_client = lambda: chat_client
+    return blob_service
+
+
+def run_document(function_app, pdf, filename):
+    """Upload and analyze one document; returns (upload seconds, analyze seconds, response)"""
+    import azure.functions as func
+
+    started = time.perf_counter()
+    upload = function_app.upload_pdf(multipart_upload_request(filename, pdf))
+    uploaded = time.perf_counter()
+    if upload.status_code != 200:
+        raise RuntimeError(f"upload failed: {upload.get_body().decode()}")
+    file_id = json.loads(upload.get_body())["file_id"]
+    analysis = function_app.analyze_pdf(func.HttpRequest(
+        "POST", f"/api/analyze/{file_id}", body=b"", route_params={"file_id": file_id}, params={"mode": "sync"}
+    ))
+    finished = time.perf_counter()
+    if analysis.status_code != 200:
+        raise RuntimeError(f"analysis failed: {analysis.get_body().decode()}")
+    return uploaded - started, finished - uploaded, json.loads(analysis.get_body())
+
+
+def benchmark(args):
+    os.environ.setdefault('AI_FOUNDRY_ENDPOINT', 'https://benchmark.services.ai.azure.com/models')
+    os.environ.setdefault('AI_FOUNDRY_API_KEY', 'benchmark')
+    os.environ.setdefault('ANALYSIS_CACHE_BACKEND', 'blob' if args.cache else 'none')
+    os.environ.setdefault('CHUNK_CACHE_BACKEND', 'blob' if args.cache else 'none')
+    os.environ.setdefault('FILE_INDEX_BACKEND', 'blob')
+    logging.disable(logging.WARNING)
+    import function_app
+
+    counts = Counter()
+    blob_service = install_fakes(function_app, args, counts)
+    sizes = [int(size) for size in args.pages.split(",")]
+    corpus = [
+        (pages, make_pdf(pages, args.scanned_every, args.lines_per_page, salt=f"{pages}-{index}"))
+        for pages in sizes for index in range(args.documents)
+    ]
+
+    # Timed pass: all documents, up to --parallel at once
+    results = {pages: {"upload": [], "analyze": [], "chunks": []} for pages in sizes}
+
+    def timed(item):
+        pages, pdf = item
+        upload_seconds, analyze_seconds, response = run_document(function_app, pdf, f"dokument-{pages}.pdf")
+        results[pages]["upload"].append(upload_seconds)
+        results[pages]["analyze"].append(analyze_seconds)
+        results[pages]["chunks"].append(response.get("chunks_processed", 0))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        list(executor.map(timed, corpus))
+    elapsed = time.perf_counter() - started
+    call_counts = dict(sorted(counts.items()))
+    blob_counts = dict(sorted(blob_service.counts.items()))
+
+    # Memory pass: one document per size on its own, traced (tracing slows it down, so it isn't timed)
+    peak_mb = {}
+    for pages in sizes:
+        pdf = make_pdf(pages, args.scanned_every, args.lines_per_page, salt=f"{pages}-memory")
+        tracemalloc.start()
+        run_document(function_app, pdf, f"dokument-{pages}.pdf")
+        peak_mb[pages] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+
+    total_pages = sum(pages for pages, _ in corpus)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "throughput": {
+            "seconds": round(elapsed, 2),
+            "documents_per_second": round(len(corpus) / elapsed, 2),
+            "pages_per_second": round(total_pages / elapsed, 1)
+        },
+        "sizes": {
+            str(pages): {
+                "documents": len(timings["analyze"]),
+                "chunks": statistics.median(timings["chunks"]),
+                "upload_p50_ms": round(percentile(timings["upload"], 0.5) * 1000, 1),
+                "upload_p95_ms": round(percentile(timings["upload"], 0.95) * 1000, 1),
+                "analyze_p50_ms": round(percentile(timings["analyze"], 0.5) * 1000, 1),
+                "analyze_p95_ms": round(percentile(timings["analyze"], 0.95) * 1000, 1),
+                "peak_mb": peak_mb[pages]
+            }
+            for pages, timings in results.items()
+        },
+        "calls": call_counts,
+        "blob_calls": blob_counts,
+        "limiters": function_app.limiter_stats()
+    }
+
+
+def compare(report, baseline):
+    """Relative change per metric against a saved report, e.g. {"100": {"analyze_p50_ms": "-12%"}}"""
+    def change(new, old):
+        if not old:
+            return None
+        return f"{(new - old) / old:+.0%}"
+
+    deltas = {"throughput": {
+        key: change(value, baseline["throughput"].get(key)) for key, value in report["throughput"].items()
+    }}
+    for size, metrics in report["sizes"].items():
+        old = baseline["sizes"].get(size)
+        if old:
+            deltas[size] = {key: change(value, old.get(key)) for key, value in metrics.items() if key != "documents"}
+    deltas["calls"] = {
+        key: f"{value - baseline['calls'].get(key, 0):+d}" for key, value in report["calls"].items()
+        if value != baseline["calls"].get(key, 0)
+    }
+    return deltas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', default="1,10,50,100,250,500", help="corpus document sizes in pages")
+    parser.add_argument('--documents', type=int, default=3, help="documents per size")
+    parser.add_argument('--parallel', type=int, default=1, help="documents uploaded and analyzed at once")
+    parser.add_argument('--lines-per-page', type=int, default=40)
+    parser.add_argument('--scanned-every', type=int, default=5, help="every n-th page has no text layer (0: none)")
+    parser.add_argument('--table-every', type=int, default=10, help="every n-th scanned page is a table (0: none)")
+    parser.add_argument('--latency', type=float, default=0.05, help="model call latency, seconds")
+    parser.add_argument('--tokens-per-second', type=float, default=0, help="model generation speed (0: no extra latency)")
+    parser.add_argument('--completion-tokens', type=int, default=300, help="approximate tokens per model answer")
+    parser.add_argument('--throttle', type=float, default=0.0, help="fraction of model calls answered with 429")
+    parser.add_argument('--retry-after', type=float, default=0.1)
+    parser.add_argument('--invalid-json', type=float, default=0.0, help="fraction of model answers cut off mid-JSON")
+    parser.add_argument('--di-latency', type=float, default=0.05, help="Document Intelligence submit latency, seconds")
+    parser.add_argument('--poll-latency', type=float, default=0.2, help="Document Intelligence time to result, seconds")
+    parser.add_argument('--blob-latency', type=float, default=0.0, help="latency per blob operation, seconds")
+    parser.add_argument('--cache', action='store_true', help="keep the analysis and chunk caches on")
+    parser.add_argument('--output', help="save the report to this JSON file")
+    parser.add_argument('--baseline', help="compare with a report saved by --output")
+    args = parser.parse_args()
+
+    report = benchmark(args)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            report["compared_to_baseline"] = compare(report, json.load(f))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Measure the cold-start cost of importing function_app, as the Functions host does.
+
+Each run starts a fresh interpreter. --eager also imports the Azure SDKs, pypdf and
+tiktoken up front, as the module did before they were imported lazily, for comparison:
+
+    python benchmarks/startup_time.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+HEAVY_MODULES = (
+    "azure.storage.blob", "azure.storage.queue", "azure.ai.formrecognizer",
+    "azure.ai.inference", "azure.identity", "pypdf", "tiktoken"
+)
+
+_PROBE = """
+import importlib, json, sys, time
+started = time.perf_counter()
+for name in {eager!r}:
+    importlib.import_module(name)
+import function_app
+print(json.dumps({{
+    "ms": (time.perf_counter() - started) * 1000,
+    "loaded": [name for name in {heavy!r} if name in sys.modules]
+}}))
+"""
+
+
+def measure(runs, eager):
+    probe = _PROBE.format(eager=HEAVY_MODULES if eager else (), heavy=HEAVY_MODULES)
+    timings = []
+    loaded = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", probe], cwd=API_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["ms"])
+        loaded = result["loaded"]
+    return {
+        "median_ms": round(statistics.median(timings), 1),
+        "min_ms": round(min(timings), 1),
+        "max_ms": round(max(timings), 1),
+        "sdk_modules_loaded": loaded
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps({
+        "lazy": measure(args.runs, eager=False),
+        "eager": measure(args.runs, eager=True)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
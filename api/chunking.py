@@ -0,0 +1,277 @@
+import hashlib
+import logging
+import math
+import os
+import re
+
+# Used when tiktoken or its encoding files are unavailable; conservative for Norwegian text
+CHARS_PER_TOKEN = 3.5
+
+# Chunk boundaries are content-defined: once a chunk is CDC_MIN_FILL of the budget, each line
+# or table ends it with probability tokens / (budget * CDC_WINDOW), decided by a hash of its
+# text. Cut points then depend on the content around them rather than on where the chunk
+# started, so an edit only changes the chunks near it and the rest are cached.
+CDC_MIN_FILL = 0.25
+CDC_WINDOW = 0.45
+
+# Page starts are this much more likely to be cut points, so chunks tend to hold whole pages
+PAGE_CUT_WEIGHT = 8.0
+
+# Chunks average about this share of the budget, which the budget allows for
+EXPECTED_FILL = 0.55
+
+# The budget is rounded up to the next step of a geometric ladder from CHUNK_MIN_TOKENS, so
+# the cut points of a revised document are computed against the same budget
+BUDGET_LADDER = 1.25
+
+_PAGE_MARKER = re.compile(r"^--- Side \d+(?: \(forts\.\))? ---$", re.MULTILINE)
+
+_encoding = None
+
+
+def count_tokens(text):
+    """Number of model tokens in text (o200k_base, as used by gpt-4o models), or an estimate"""
+    global _encoding
+    if _encoding is None:
+        try:
+            # Imported on first use; the tokenizer is only needed once a document is chunked
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            _encoding = False
+        except Exception as encoding_error:
+            logging.warning(f"tiktoken encoding unavailable, estimating tokens: {encoding_error}")
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+class Chunk:
+    """A piece of the document sent to the model in one call"""
+    __slots__ = ("text", "tokens", "first_page", "last_page")
+
+    def __init__(self, text, tokens, first_page, last_page):
+        self.text = text
+        self.tokens = tokens
+        self.first_page = first_page
+        self.last_page = last_page
+
+
+class _Segment:
+    """Smallest unit the chunker places: a line or a whole table, never split across chunks"""
+    __slots__ = ("page", "starts_page", "text", "tokens")
+
+    def __init__(self, page, starts_page, text):
+        self.page = page
+        self.starts_page = starts_page
+        self.text = text
+        self.tokens = count_tokens(text)
+
+
+def _pack(pieces, max_tokens, separator):
+    """Join pieces greedily into parts of at most max_tokens"""
+    parts = []
+    current = []
+    current_tokens = 0
+    separator_tokens = count_tokens(separator)
+    for piece in pieces:
+        tokens = count_tokens(piece) + (separator_tokens if current else 0)
+        if current and current_tokens + tokens > max_tokens:
+            parts.append(separator.join(current))
+            current = []
+            current_tokens = 0
+            tokens = count_tokens(piece)
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        parts.append(separator.join(current))
+    return parts
+
+
+def _split_words(text, max_tokens):
+    """Split text into pieces below max_tokens at whitespace; only a single word longer than
+    that is cut, into roughly equal pieces"""
+    words = []
+    for word in text.split():
+        tokens = count_tokens(word)
+        if tokens > max_tokens:
+            size = math.ceil(len(word) / math.ceil(tokens / max_tokens))
+            words.extend(word[i:i + size] for i in range(0, len(word), size))
+        else:
+            words.append(word)
+    return _pack(words, max_tokens, " ")
+
+
+def _split_long_text(text, max_tokens):
+    """Split a single over-long line into lines below max_tokens"""
+    return [piece + "\n" for piece in _split_words(text, max_tokens)]
+
+
+def _split_row(row, max_tokens):
+    """Split a table row too large for one block at its cells, and a cell too large at its words"""
+    pieces = []
+    for cell in row:
+        pieces.extend(_split_words(cell, max_tokens) if count_tokens(cell) > max_tokens else [cell])
+    return _pack(pieces, max_tokens, " | ")
+
+
+def _table_blocks(rows, max_tokens):
+    """Render a table as one [TABELL] block, or several if it is too large.
+
+    Every block repeats the header row and holds at least one other row; a row too
+    large for a block is split over several lines at cell, then word boundaries.
+    """
+    if not rows:
+        return []
+    opening, closing = "\n[TABELL]\n", "[/TABELL]\n\n"
+    budget = max_tokens - count_tokens(opening + closing)
+    header = " | ".join(rows[0]) + "\n"
+    header_tokens = count_tokens(header)
+    body = rows[1:]
+    if header_tokens > budget // 2:
+        # A header this large isn't repeated; it is split like the other rows
+        header, header_tokens, body = "", 0, rows
+    row_budget = budget - header_tokens
+
+    lines = []
+    for row in body:
+        text = " | ".join(row) + "\n"
+        if count_tokens(text) <= row_budget:
+            lines.append(text)
+        else:
+            lines.extend(part + "\n" for part in _split_row(row, row_budget))
+
+    blocks = []
+    current = []
+    current_tokens = header_tokens
+    for line in lines:
+        tokens = count_tokens(line)
+        if current and current_tokens + tokens > budget:
+            blocks.append(current)
+            current = []
+            current_tokens = header_tokens
+        current.append(line)
+        current_tokens += tokens
+    if current or not blocks:
+        blocks.append(current)
+    return [opening + header + "".join(block) + closing for block in blocks]
+
+
+def _segments(extraction, max_tokens):
+    for page in extraction.pages:
+        # Table blocks are already within max_tokens; only a long line still needs splitting
+        texts = []
+        for table in page.tables:
+            texts.extend(_table_blocks(table, max_tokens))
+        for line in page.lines:
+            if count_tokens(line) > max_tokens:
+                texts.extend(_split_long_text(line, max_tokens))
+            else:
+                texts.append(line + "\n")
+
+        first = True
+        for text in texts:
+            yield _Segment(page.number, first, text)
+            first = False
+
+
+def _chunk_budget(total_tokens, concurrency, min_tokens, max_tokens, max_chunks=None):
+    """Tokens per chunk: a document that fits in one wave of `concurrency` parallel calls is
+    spread over all of them, anything larger gets the maximum, but the budget is never so
+    small that max_chunks chunks can't hold the document"""
+    if total_tokens <= max_tokens or total_tokens > max_tokens * concurrency * EXPECTED_FILL:
+        return max_tokens
+    per_chunk = math.ceil(total_tokens / (concurrency * EXPECTED_FILL))
+    if max_chunks:
+        per_chunk = max(per_chunk, math.ceil(total_tokens / (max_chunks * EXPECTED_FILL)))
+    steps = math.ceil(math.log(max(per_chunk, min_tokens) / min_tokens, BUDGET_LADDER) - 1e-9)
+    return min(max_tokens, round(min_tokens * BUDGET_LADDER ** steps))
+
+
+def _is_cut_point(segment, budget, weight=1.0):
+    digest = hashlib.blake2b(segment.text.strip().encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64 < weight * segment.tokens / (budget * CDC_WINDOW)
+
+
+def normalize_chunk_text(text):
+    """Chunk text without page markers and with whitespace collapsed, for cache keys:
+    the same content moved to other pages by an edit earlier in the document still matches"""
+    return " ".join(_PAGE_MARKER.sub(" ", text).split())
+
+
+def _page_marker(page_number, continued):
+    if continued:
+        return f"--- Side {page_number} (forts.) ---\n"
+    return f"\n--- Side {page_number} ---\n" if page_number > 1 else ""
+
+
+def chunk_extraction(extraction, concurrency=1, max_chunks=None):
+    """Split an extraction into token-budgeted chunks along page, table and line boundaries.
+
+    Chunk size is chosen from the document's token count and the number of parallel
+    model calls, between CHUNK_MIN_TOKENS and CHUNK_MAX_TOKENS. Within that budget,
+    boundaries are content-defined, so a revised document mostly yields the same
+    chunks as the original. At most max_chunks chunks are returned; coverage reports
+    how much of the document they contain. Returns (chunks, coverage).
+    """
+    max_tokens = int(os.getenv('CHUNK_MAX_TOKENS', '6000'))
+    min_tokens = min(max_tokens, int(os.getenv('CHUNK_MIN_TOKENS', '1500')))
+
+    segments = list(_segments(extraction, max_tokens))
+    total_tokens = sum(segment.tokens for segment in segments)
+    budget = _chunk_budget(total_tokens, max(1, concurrency), min_tokens, max_tokens, max_chunks)
+    page_tokens = {}
+    for segment in segments:
+        page_tokens[segment.page] = page_tokens.get(segment.page, 0) + segment.tokens
+
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    def flush():
+        parts = []
+        for index, segment in enumerate(current):
+            if segment.starts_page:
+                parts.append(_page_marker(segment.page, continued=False))
+            elif index == 0:
+                # A chunk starting mid-page is told which page it continues
+                parts.append(_page_marker(segment.page, continued=True))
+            parts.append(segment.text)
+        chunks.append(Chunk("".join(parts), current_tokens, current[0].page, current[-1].page))
+
+    for segment in segments:
+        page_cut = segment.starts_page and current_tokens >= budget * CDC_MIN_FILL and _is_cut_point(
+            segment, budget, PAGE_CUT_WEIGHT
+        )
+        if current and (current_tokens + segment.tokens > budget or page_cut):
+            flush()
+            current = []
+            current_tokens = 0
+        current.append(segment)
+        current_tokens += segment.tokens
+        if current_tokens >= budget * CDC_MIN_FILL and _is_cut_point(segment, budget):
+            flush()
+            current = []
+            current_tokens = 0
+    if current:
+        flush()
+
+    analyzed = chunks[:max_chunks] if max_chunks else chunks
+    analyzed_tokens = sum(chunk.tokens for chunk in analyzed)
+    coverage = {
+        "fraction": round(analyzed_tokens / total_tokens, 3) if total_tokens else 1.0,
+        "tokens_total": total_tokens,
+        "tokens_analyzed": analyzed_tokens,
+        "chunks_total": len(chunks),
+        "chunks_analyzed": len(analyzed),
+        "last_page_analyzed": analyzed[-1].last_page if analyzed else 0,
+        "pages_total": extraction.pages[-1].number if extraction.pages else 0
+    }
+    if len(analyzed) < len(chunks):
+        logging.warning(
+            f"Analyzing {len(analyzed)}/{len(chunks)} chunks (MAX_CHUNKS); "
+            f"{coverage['fraction']:.0%} of the document is covered"
+        )
+    logging.info(f"Chunk budget {budget} tokens for {total_tokens} tokens, {len(chunks)} chunks")
+    return analyzed, coverage
@@ -0,0 +1,185 @@
+import hashlib
+import heapq
+import logging
+import os
+import re
+import statistics
+
+from extraction import Extraction, Page
+
+# Repeating lines: a line that (with digits ignored) recurs on at least this many pages is
+# boilerplate if it sits in the first/last EDGE_LINES lines of a page (running headers,
+# footers, page numbers) and recurs on EDGE_PAGE_FRACTION of the pages, or anywhere on the
+# page if it is long (disclaimers) and recurs on BODY_PAGE_FRACTION of them.
+MIN_REPEAT_PAGES = 3
+EDGE_LINES = 3
+EDGE_PAGE_FRACTION = 0.2
+BODY_PAGE_FRACTION = 0.5
+BODY_MIN_CHARS = 30
+
+# Near-duplicate paragraphs: word SHINGLE_SIZE-grams, compared by bottom-k MinHash sketches
+# of SKETCH_SIZE hashes. Paragraphs shorter than MIN_PARAGRAPH_WORDS are always kept.
+SHINGLE_SIZE = 5
+SKETCH_SIZE = 32
+MIN_PARAGRAPH_WORDS = 20
+DUPLICATE_SIMILARITY = 0.7
+
+# Candidate pairs share one of their CANDIDATE_HASHES smallest hashes
+CANDIDATE_HASHES = 4
+
+_DIGITS = re.compile(r"\d+")
+
+
+def _line_key(line):
+    """Line identity for repeat detection: case, spacing and numbers (page numbers, dates) ignored"""
+    return " ".join(_DIGITS.sub("#", line.casefold()).split())
+
+
+def _repeated_lines(pages):
+    """(page index, line index) of boilerplate lines to drop; the first occurrence of each is kept"""
+    pages_with_text = sum(1 for page in pages if page.lines)
+    if pages_with_text < MIN_REPEAT_PAGES:
+        return set()
+
+    edge_pages = {}
+    body_pages = {}
+    for page_index, page in enumerate(pages):
+        last_edge = len(page.lines) - EDGE_LINES
+        for line_index, line in enumerate(page.lines):
+            key = _line_key(line)
+            if not key:
+                continue
+            if line_index < EDGE_LINES or line_index >= last_edge:
+                edge_pages.setdefault(key, set()).add(page_index)
+            body_pages.setdefault(key, set()).add(page_index)
+
+    edge_minimum = max(MIN_REPEAT_PAGES, EDGE_PAGE_FRACTION * pages_with_text)
+    body_minimum = max(MIN_REPEAT_PAGES, BODY_PAGE_FRACTION * pages_with_text)
+    boilerplate = {key for key, found in edge_pages.items() if len(found) >= edge_minimum}
+    boilerplate.update(
+        key for key, found in body_pages.items() if len(key) >= BODY_MIN_CHARS and len(found) >= body_minimum
+    )
+
+    drop = set()
+    seen = set()
+    for page_index, page in enumerate(pages):
+        last_edge = len(page.lines) - EDGE_LINES
+        for line_index, line in enumerate(page.lines):
+            key = _line_key(line)
+            if key not in boilerplate:
+                continue
+            at_edge = line_index < EDGE_LINES or line_index >= last_edge
+            # Edge-only boilerplate is left alone where it appears mid-page
+            if not at_edge and not (len(key) >= BODY_MIN_CHARS and len(body_pages[key]) >= body_minimum):
+                continue
+            if key in seen:
+                drop.add((page_index, line_index))
+            else:
+                seen.add(key)
+    return drop
+
+
+def _paragraphs(pages, dropped):
+    """Paragraphs as lists of (page index, line index). A paragraph ends at a short line
+    that ends a sentence, at an empty line or at the end of a page."""
+    paragraphs = []
+    for page_index, page in enumerate(pages):
+        lengths = [len(line) for line in page.lines if line.strip()]
+        if not lengths:
+            continue
+        short = 0.75 * statistics.median(lengths)
+        current = []
+        for line_index, line in enumerate(page.lines):
+            if (page_index, line_index) in dropped:
+                continue
+            text = line.strip()
+            if not text:
+                if current:
+                    paragraphs.append(current)
+                    current = []
+                continue
+            current.append((page_index, line_index))
+            if text[-1] in ".!?:" and len(text) < short:
+                paragraphs.append(current)
+                current = []
+        if current:
+            paragraphs.append(current)
+    return paragraphs
+
+
+def _sketch(words):
+    """Bottom-k MinHash sketch: the SKETCH_SIZE smallest shingle hashes, sorted"""
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    # A stable hash, not hash(): the cleaned text feeds the chunk cache keys, so it must not
+    # depend on the process's hash seed
+    return heapq.nsmallest(SKETCH_SIZE, {
+        int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for shingle in shingles
+    })
+
+
+def _similarity(sketch_a, sketch_b):
+    """Jaccard similarity estimated from two bottom-k sketches"""
+    union = heapq.nsmallest(SKETCH_SIZE, set(sketch_a) | set(sketch_b))
+    both = set(sketch_a) & set(sketch_b)
+    return sum(1 for value in union if value in both) / len(union) if union else 0.0
+
+
+def _duplicate_paragraphs(pages, dropped):
+    """(page index, line index) of paragraphs that nearly repeat an earlier one, and their count"""
+    drop = set()
+    removed = 0
+    kept = []      # sketches of the paragraphs kept so far
+    index = {}     # small hash -> positions in kept
+    for paragraph in _paragraphs(pages, dropped):
+        words = " ".join(pages[page].lines[line] for page, line in paragraph).casefold().split()
+        if len(words) < MIN_PARAGRAPH_WORDS:
+            continue
+        sketch = _sketch(words)
+        candidates = {position for value in sketch[:CANDIDATE_HASHES] for position in index.get(value, ())}
+        if any(_similarity(sketch, kept[position]) >= DUPLICATE_SIMILARITY for position in candidates):
+            drop.update(paragraph)
+            removed += 1
+            continue
+        for value in sketch[:CANDIDATE_HASHES]:
+            index.setdefault(value, []).append(len(kept))
+        kept.append(sketch)
+    return drop, removed
+
+
+def clean_extraction(extraction):
+    """Remove repeated headers/footers/page numbers/disclaimers and near-duplicate paragraphs.
+
+    Works on the page lines; tables are kept as they are. The first occurrence of
+    anything removed stays. Returns (cleaned extraction, stats). Turned off with
+    REMOVE_BOILERPLATE=false.
+    """
+    pages = extraction.pages
+    chars_before = sum(len(line) for page in pages for line in page.lines)
+    stats = {"chars_before": chars_before, "chars_removed": 0, "repeated_lines": 0, "duplicate_paragraphs": 0, "fraction": 0.0}
+    if os.getenv('REMOVE_BOILERPLATE', 'true').lower() != 'true' or not chars_before:
+        return extraction, stats
+
+    repeated = _repeated_lines(pages)
+    duplicates, duplicate_paragraphs = _duplicate_paragraphs(pages, repeated)
+    if not repeated and not duplicates:
+        return extraction, stats
+
+    dropped = repeated | duplicates
+    cleaned = []
+    for page_index, page in enumerate(pages):
+        lines = [line for line_index, line in enumerate(page.lines) if (page_index, line_index) not in dropped]
+        cleaned.append(Page(page.number, page.model, lines, page.tables))
+
+    chars_removed = sum(len(pages[page].lines[line]) for page, line in dropped)
+    stats.update(
+        chars_removed=chars_removed,
+        repeated_lines=len(repeated),
+        duplicate_paragraphs=duplicate_paragraphs,
+        fraction=round(chars_removed / chars_before, 3)
+    )
+    logging.info(
+        f"Removed {chars_removed} of {chars_before} characters: {len(repeated)} repeated lines, "
+        f"{duplicate_paragraphs} near-duplicate paragraphs"
+    )
+    return Extraction(cleaned), stats
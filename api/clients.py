@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+
+from rate_limit import LimitedChatClient, LimitedDocumentClient, get_limiter
+
+# The Azure SDKs are imported when a client is first needed, not at module load, so
+# endpoints that don't use a service (health, upload) don't pay for importing it.
+
+STORAGE_ACCOUNT_URL = "https://pdfaianalyzernorway.blob.core.windows.net"
+
+
+class ConfigError(Exception):
+    """Missing or invalid service configuration"""
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_session = None
+_ai_config = None
+
+
+def _http_session():
+    """One keep-alive requests session for all clients, with a connection pool per host
+    large enough for the concurrent chunk calls (the requests default keeps only 10)"""
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        pool_size = int(os.getenv('HTTP_POOL_SIZE', '32'))
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+def _transport():
+    from azure.core.pipeline.transport import RequestsTransport
+
+    # session_owner=False: the shared session outlives any one client
+    return RequestsTransport(session=_http_session(), session_owner=False)
+
+
+def _cached(name, create):
+    with _clients_lock:
+        if name not in _clients:
+            _clients[name] = create()
+        return _clients[name]
+
+
+def _create_blob_service():
+    from azure.storage.blob import BlobServiceClient
+
+    # Try connection string first, then account key, fallback to managed identity
+    storage_connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING') or os.getenv('AzureWebJobsStorage')
+    if storage_connection_string and storage_connection_string.strip():
+        return BlobServiceClient.from_connection_string(storage_connection_string, transport=_transport())
+    account_key = os.getenv('AZURE_STORAGE_ACCOUNT_KEY')
+    if account_key:
+        return BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=account_key, transport=_transport())
+    from azure.identity import DefaultAzureCredential
+    return BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=DefaultAzureCredential(), transport=_transport())
+
+
+def _create_document_client():
+    from azure.ai.formrecognizer import DocumentAnalysisClient
+    from azure.core.credentials import AzureKeyCredential
+
+    doc_intelligence_endpoint = os.getenv('DOC_INTELLIGENCE_ENDPOINT')
+    doc_intelligence_key = os.getenv('DOC_INTELLIGENCE_KEY')
+    if not doc_intelligence_endpoint or not doc_intelligence_key:
+        raise ConfigError("Document Intelligence-konfigurasjon mangler. Sett DOC_INTELLIGENCE_ENDPOINT og DOC_INTELLIGENCE_KEY.")
+    # Shares one request budget and concurrency limit across all analyses in the process.
+    # The SDK's own retries stay on here, since they also cover polling the operation.
+    return LimitedDocumentClient(
+        DocumentAnalysisClient(
+            endpoint=doc_intelligence_endpoint,
+            credential=AzureKeyCredential(doc_intelligence_key),
+            transport=_transport()
+        ),
+        get_limiter("document_intelligence")
+    )
+
+
+def _create_chat_client():
+    from azure.ai.inference import ChatCompletionsClient
+    from azure.core.credentials import AzureKeyCredential
+
+    endpoint, api_key, _ = ai_config()
+    # Retries are done by the shared limiter (Retry-After aware, with adaptive
+    # concurrency), so the SDK's own retry policy is turned off
+    return LimitedChatClient(
+        ChatCompletionsClient(
+            endpoint=endpoint,
+            credential=AzureKeyCredential(api_key),
+            retry_total=0,
+            transport=_transport()
+        ),
+        get_limiter("ai")
+    )
+
+
+def ai_config():
+    """Validated (endpoint, api_key, model) for Azure AI Foundry; raises ConfigError.
+
+    The environment is read and checked once per process.
+    """
+    global _ai_config
+    if _ai_config is None:
+        try:
+            _ai_config = _read_ai_config()
+        except ConfigError as config_error:
+            _ai_config = config_error
+    if isinstance(_ai_config, ConfigError):
+        raise _ai_config
+    return _ai_config
+
+
+def _read_ai_config():
+    ai_foundry_endpoint = os.getenv('AI_FOUNDRY_ENDPOINT')
+    ai_foundry_api_key = os.getenv('AI_FOUNDRY_API_KEY')
+    ai_foundry_model = os.getenv('AI_FOUNDRY_MODEL', 'gpt-4o-mini')
+
+    if not ai_foundry_endpoint or not ai_foundry_api_key:
+        raise ConfigError("Azure AI Foundry-konfigurasjon mangler. Sett AI_FOUNDRY_ENDPOINT og AI_FOUNDRY_API_KEY.")
+
+    endpoint = ai_foundry_endpoint.rstrip('/')
+    if not endpoint.startswith('https://'):
+        raise ConfigError(f"Ugyldig endpoint: {endpoint}. Må starte med https://")
+
+    if 'services.ai.azure.com' not in endpoint:
+        raise ConfigError("Kun Azure AI Foundry endpoints (services.ai.azure.com) støttes.")
+
+    # AI Foundry format: https://<resource>.services.ai.azure.com/models
+    if not endpoint.endswith('/models'):
+        endpoint = f"{endpoint}/models"
+
+    logging.info(f"Bruker Azure AI Foundry: {endpoint}, modell: {ai_foundry_model}")
+    return endpoint, ai_foundry_api_key, ai_foundry_model
+
+
+def get_blob_service():
+    return _cached("blob", _create_blob_service)
+
+
+def get_document_client():
+    return _cached("document_intelligence", _create_document_client)
+
+
+def get_chat_client():
+    """Pooled AI Foundry client; raises ConfigError if AI_FOUNDRY_* is missing or invalid"""
+    return _cached("ai", _create_chat_client)
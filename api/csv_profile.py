@@ -0,0 +1,403 @@
+import codecs
+import csv
+import heapq
+import io
+import itertools
+import logging
+import math
+import operator
+import os
+import random
+import re
+from collections import Counter
+
+from extraction import Extraction, Page
+from telemetry import stage
+
+# CSV files are profiled in one streaming pass instead of being sent to the model row by row:
+# the model gets per-column statistics for the whole file and a random sample of rows.
+SNIFF_BYTES = 64 * 1024
+BATCH_ROWS = 10000
+
+# A column is numeric (or a date column) when this share of its first non-empty values parse
+# as numbers (dates); the kind is decided after KIND_SAMPLE values
+NUMERIC_SHARE = 0.9
+KIND_SAMPLE = 200
+
+# Value counts kept per column for the most common values. Beyond 2 * TRACKED_VALUES distinct
+# values the counts are cut Misra-Gries style (every count lowered by the (TRACKED_VALUES + 1)th
+# largest, values reaching zero dropped), so memory stays bounded, every value more common than
+# 1 / TRACKED_VALUES of the rows is kept and the counts kept are lower bounds. Whether a column
+# is nearly all distinct values (ids, amounts) is decided over the whole file.
+TOP_VALUES = 5
+TRACKED_VALUES = 2000
+UNIQUE_SHARE = 0.9
+
+# Amounts this many standard deviations from a column's mean are reported, at most OUTLIERS per side
+OUTLIERS = 5
+OUTLIER_SIGMA = 4.0
+
+SAMPLE_CELL_CHARS = 200
+VALUE_CHARS = 60
+
+_NULLS = frozenset({"", "-", "NA", "N/A", "n/a", "na", "NULL", "null", "None", "none", "NaN", "nan"})
+_AMOUNT_HEADER = re.compile(
+    r"beløp|belop|sum|amount|\bkr\b|nok|total|pris|verdi|utbetal|tilskudd|kostnad|inntekt|lønn|honorar",
+    re.IGNORECASE
+)
+_NUMBER_NOISE = re.compile(r"[\s']+|\bkr\b\.?|\bnok\b", re.IGNORECASE)
+_PLAIN_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)")
+_DATE = re.compile(r"\s*(?:(\d{4})-(\d{2})-(\d{2})|(\d{1,2})[./](\d{1,2})[./](\d{4}))(?:[ T]|$)")
+
+
+def _detect_encoding(head):
+    """Encoding from a byte order mark, else UTF-8 if the first bytes decode as UTF-8, else Windows-1252"""
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head[:SNIFF_BYTES], final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        # Excel on Norwegian Windows saves CSV as Windows-1252
+        return "cp1252"
+
+
+def _sniff(sample):
+    """(dialect, has_header) for a sample of the file's text"""
+    sniffer = csv.Sniffer()
+    try:
+        dialect = sniffer.sniff(sample, delimiters=",;\t|")
+    except csv.Error:
+        # Sniffing fails on e.g. single-column files; use the separator most common on the first line
+        first_line = sample.split("\n", 1)[0]
+        dialect = type("dialect", (csv.excel,), {"delimiter": max(",;\t|", key=first_line.count)})
+    try:
+        has_header = sniffer.has_header(sample)
+    except csv.Error:
+        has_header = True
+    return dialect, has_header
+
+
+class _ChunkStream(io.RawIOBase):
+    """Read-only file over an iterator of byte chunks (a blob download), counting the bytes read"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.bytes_read += size
+        return size
+
+
+def _parse_number(value):
+    """A number written the Norwegian or English way ("1 234,50", "kr 1.234,-", "1,234.50"), or None"""
+    text = _NUMBER_NOISE.sub("", value)
+    if text.endswith((",-", ".-")):
+        text = text[:-2]
+    if "," in text and "." in text:
+        # The last separator is the decimal one
+        if text.rfind(",") > text.rfind("."):
+            text = text.replace(".", "").replace(",", ".")
+        else:
+            text = text.replace(",", "")
+    elif "," in text:
+        text = text.replace(",", ".") if text.count(",") == 1 else text.replace(",", "")
+    elif text.count(".") > 1:
+        text = text.replace(".", "")
+    return float(text) if _PLAIN_NUMBER.fullmatch(text) else None
+
+
+def _parse_numbers(values):
+    """Values as floats, None where a value isn't a number. Tries whole-batch conversions
+    first, which cover plain and decimal-comma columns at C speed."""
+    try:
+        numbers = list(map(float, values))
+    except ValueError:
+        try:
+            numbers = [float(value.replace(",", ".")) for value in values]
+        except ValueError:
+            return list(map(_parse_number, values))
+    if not all(map(math.isfinite, numbers)):
+        return [number if math.isfinite(number) else None for number in numbers]
+    return numbers
+
+
+def _parse_date(value):
+    """ISO date (yyyy-mm-dd) of a value written as yyyy-mm-dd or dd.mm.yyyy / dd/mm/yyyy, or None"""
+    match = _DATE.match(value)
+    if not match:
+        return None
+    if match.group(1):
+        return f"{match.group(1)}-{match.group(2)}-{match.group(3)}"
+    return f"{match.group(6)}-{int(match.group(5)):02d}-{int(match.group(4)):02d}"
+
+
+def _format_number(value):
+    """Number in Norwegian notation: space as thousands separator, decimal comma"""
+    if value == int(value) and abs(value) < 1e15:
+        text = f"{int(value):,}"
+    else:
+        text = f"{value:,.2f}"
+    return text.replace(",", " ").replace(".", ",")
+
+
+def _quote(value):
+    value = " ".join(value.split())
+    return f"«{value[:VALUE_CHARS]}…»" if len(value) > VALUE_CHARS else f"«{value}»"
+
+
+class _Column:
+    """Running profile of one column: nulls, kind, numeric/date range and most common values"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.kind = None  # "tall", "dato" or "tekst", decided from the first KIND_SAMPLE values
+        self.is_amount = bool(_AMOUNT_HEADER.search(name))
+        # Numbers
+        self.numbers = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.largest = []   # (value, row)
+        self.smallest = []
+        # Dates, as ISO strings
+        self.dates = 0
+        self.first_date = None
+        self.last_date = None
+        # Most common values, and the most distinct values seen at once (a lower bound once pruned)
+        self.values = Counter()
+        self.distinct = 0
+        self.pruned = False
+
+    def add(self, values, first_row):
+        """Add one batch of the column's values; first_row is the row number of values[0]"""
+        rows = range(first_row, first_row + len(values))
+        present = [value for value in values if value not in _NULLS]
+        if len(present) < len(values):
+            rows = [row for row, value in zip(rows, values) if value not in _NULLS]
+        self.nulls += len(values) - len(present)
+        self.count += len(present)
+        if not present:
+            return
+
+        if self.kind in (None, "tall"):
+            numbers = _parse_numbers(present)
+            pairs = [(number, row) for number, row in zip(numbers, rows) if number is not None]
+            if pairs:
+                self._add_numbers(pairs)
+        batch_counts = Counter(present)
+        if self.kind in (None, "dato"):
+            # Each distinct value is parsed once; date columns repeat their values a lot
+            dates = [(date, count) for date, count in zip(map(_parse_date, batch_counts), batch_counts.values()) if date]
+            if dates:
+                self.dates += sum(count for _, count in dates)
+                first, last = min(dates)[0], max(dates)[0]
+                self.first_date = min(first, self.first_date or first)
+                self.last_date = max(last, self.last_date or last)
+        if self.kind is None and self.count >= KIND_SAMPLE:
+            self._decide_kind()
+
+        self.values.update(batch_counts)
+        self.distinct = max(self.distinct, len(self.values))
+        if len(self.values) > 2 * TRACKED_VALUES:
+            cut = self.values.most_common(TRACKED_VALUES + 1)[-1][1]
+            self.values = Counter({value: count - cut for value, count in self.values.items() if count > cut})
+            self.pruned = True
+
+    def _add_numbers(self, pairs):
+        numbers = [number for number, _ in pairs]
+        self.numbers += len(numbers)
+        self.total += math.fsum(numbers)
+        self.squares += math.fsum(map(operator.mul, numbers, numbers))
+        self.largest = heapq.nlargest(OUTLIERS, self.largest + heapq.nlargest(OUTLIERS, pairs))
+        self.smallest = heapq.nsmallest(OUTLIERS, self.smallest + heapq.nsmallest(OUTLIERS, pairs))
+
+    def _decide_kind(self):
+        # Dates first: "01.02.2024" also parses as a number with thousands separators
+        if self.dates >= NUMERIC_SHARE * self.count:
+            self.kind = "dato"
+        elif self.numbers >= NUMERIC_SHARE * self.count:
+            self.kind = "tall"
+        else:
+            self.kind = "tekst"
+
+    def outliers(self):
+        """[(value, row, standard deviations from the mean)] for amounts far from the column's mean"""
+        if self.kind != "tall" or not self.is_amount or self.numbers < 2:
+            return []
+        mean = self.total / self.numbers
+        deviation = math.sqrt(max(0.0, self.squares / self.numbers - mean * mean))
+        if not deviation:
+            return []
+        found = [
+            (value, row, (value - mean) / deviation)
+            for value, row in self.largest + self.smallest
+            if abs(value - mean) >= OUTLIER_SIGMA * deviation
+        ]
+        return sorted(set(found), key=lambda outlier: -abs(outlier[2]))[:OUTLIERS]
+
+    def describe(self, rows):
+        """The column's profile as one line of text"""
+        if self.kind is None:
+            self._decide_kind()
+        parts = [f"Kolonne {_quote(self.name)} ({self.kind})"]
+        if self.nulls:
+            share = f"{self.nulls / rows:.1%}".replace(".", ",")
+            parts.append(f"{_format_number(self.nulls)} tomme ({share})")
+        if self.kind == "tall" and self.numbers:
+            parts.append(f"min {_format_number(self.smallest[0][0])}, maks {_format_number(self.largest[0][0])}")
+            if self.is_amount:
+                parts.append(f"sum {_format_number(self.total)}, snitt {_format_number(self.total / self.numbers)}")
+            if self.numbers < self.count:
+                parts.append(f"{_format_number(self.count - self.numbers)} verdier er ikke tall")
+        elif self.kind == "dato" and self.dates:
+            parts.append(f"fra {self.first_date} til {self.last_date}")
+        common = [(value, count) for value, count in self.values.most_common(TOP_VALUES) if count > 1]
+        if self.count >= KIND_SAMPLE and not common and (self.pruned or self.distinct > UNIQUE_SHARE * self.count):
+            parts.append("nesten bare unike verdier")
+        elif self.distinct:
+            distinct = f"minst {_format_number(self.distinct)}" if self.pruned else _format_number(self.distinct)
+            parts.append(f"{distinct} ulike verdier")
+            if common:
+                # Once pruned, the counts kept are lower bounds
+                at_least = "minst " if self.pruned else ""
+                parts.append("vanligst: " + ", ".join(
+                    f"{_quote(value)} ({at_least}{_format_number(count)})" for value, count in common
+                ))
+        return "; ".join(parts)
+
+
+class _Reservoir:
+    """Uniform random sample of rows from a stream of unknown length (Li's algorithm L)"""
+
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.rows = []  # (row number, row); rows are numbered from 1
+        self.random = random.Random(seed)
+        self.weight = self._weight(1.0)
+        self.next = self.size + self._skip()
+
+    def _uniform(self):
+        return self.random.random() or 1e-300
+
+    def _weight(self, weight):
+        return weight * math.exp(math.log(self._uniform()) / self.size)
+
+    def _skip(self):
+        return int(math.log(self._uniform()) / math.log(1 - self.weight)) + 1
+
+    def add(self, batch, first_row):
+        if len(self.rows) < self.size:
+            self.rows.extend(zip(range(first_row, first_row + self.size - len(self.rows)), batch))
+        end = first_row + len(batch)
+        while self.next < end:
+            self.rows[self.random.randrange(self.size)] = (self.next, batch[self.next - first_row])
+            self.weight = self._weight(self.weight)
+            self.next += self._skip()
+
+
+def profile_csv(chunks):
+    """Profile a CSV file, given as an iterator of byte chunks, into an Extraction.
+
+    One pass with bounded memory: encoding and dialect are detected from the first
+    bytes, then every column gets its kind, empty values, range, sum and mean
+    (amount columns), most common values and outlying amounts. Page 1 holds this
+    profile for the whole file, page 2 a table of CSV_SAMPLE_ROWS rows sampled
+    uniformly at random (seeded, so the same file gives the same sample).
+    """
+    sample_size = max(1, int(os.getenv('CSV_SAMPLE_ROWS', '200')))
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= SNIFF_BYTES:
+            break
+
+    with stage("extraction.csv") as span:
+        encoding = _detect_encoding(head)
+        sample = head[:SNIFF_BYTES].decode(encoding, errors="replace")
+        sample = sample[:sample.rfind("\n") + 1] or sample
+        dialect, has_header = _sniff(sample)
+
+        raw = _ChunkStream(itertools.chain([head], chunks))
+        del head
+        text = io.TextIOWrapper(io.BufferedReader(raw, 1024 * 1024), encoding=encoding, errors="replace", newline="")
+        reader = csv.reader(text, dialect)
+        first = next(reader, [])
+        width = len(first)
+        names = first if has_header else [f"Kolonne {index}" for index in range(1, width + 1)]
+        columns = [_Column(name.strip() or f"Kolonne {index}") for index, name in enumerate(names, 1)]
+        reservoir = _Reservoir(sample_size)
+        rows = 0
+        malformed = 0
+        stopped = None
+        batch = [] if has_header else [first]
+        while True:
+            try:
+                batch.extend(itertools.islice(reader, BATCH_ROWS - len(batch)))
+            except csv.Error as csv_error:
+                # Keep what was read so far, e.g. when a quote is never closed
+                stopped = f"Lesingen stoppet etter rad {_format_number(rows + len(batch))}: {csv_error}"
+                logging.warning(f"CSV profiling stopped early: {csv_error}")
+            if not batch:
+                break
+            lengths = list(map(len, batch))
+            if lengths.count(width) < len(batch):
+                batch = [row for row in batch if row]
+                malformed += sum(1 for row in batch if len(row) != width)
+                batch = [row[:width] + [""] * (width - len(row)) for row in batch]
+            for column, values in zip(columns, zip(*batch)):
+                column.add(values, rows + 1)
+            reservoir.add(batch, rows + 1)
+            rows += len(batch)
+            batch = []
+            if stopped:
+                break
+        span.set(bytes=raw.bytes_read, rows=rows, columns=width, encoding=encoding)
+
+    lines = [
+        f"CSV-fil med {_format_number(rows)} rader og {width} kolonner "
+        f"(skilletegn {dialect.delimiter!r}, tegnsett {encoding}).",
+        f"Tallene under gjelder hele filen. Tabellen på neste side er et tilfeldig utvalg på "
+        f"{_format_number(min(rows, sample_size))} rader, med radnummer i første kolonne."
+    ]
+    if rows:
+        lines.extend(column.describe(rows) for column in columns)
+        for column in columns:
+            outliers = column.outliers()
+            if outliers:
+                lines.append(f"Uvanlige beløp i {_quote(column.name)}: " + "; ".join(
+                    f"{_format_number(value)} (rad {_format_number(row)}, "
+                    f"{_format_number(round(abs(sigmas)))} standardavvik {'over' if sigmas > 0 else 'under'} snittet)"
+                    for value, row, sigmas in outliers
+                ))
+    if malformed:
+        lines.append(f"{_format_number(malformed)} rader hadde et annet antall felt enn overskriften.")
+    if stopped:
+        lines.append(stopped)
+
+    sampled = [
+        [str(row_number)] + [cell[:SAMPLE_CELL_CHARS] for cell in row]
+        for row_number, row in sorted(reservoir.rows, key=operator.itemgetter(0))
+    ]
+    logging.info(f"Profiled CSV: {rows} rows, {width} columns, {encoding}, delimiter {dialect.delimiter!r}")
+    pages = [Page(1, "csv", lines)]
+    if sampled:
+        pages.append(Page(2, "csv", [], [[["Rad"] + [column.name for column in columns]] + sampled]))
+    return Extraction(pages)
@@ -0,0 +1,554 @@
+import contextvars
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import zipfile
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from telemetry import stage
+
+# Extraction results are stored next to the upload as {file_id}/extracted.json.gz
+SIDECAR_NAME = "extracted.json.gz"
+# 3: layout tables without duplicated lines; 4: DOCX read locally instead of by Document Intelligence;
+# 5: DOCX tables kept in document order
+SIDECAR_VERSION = 5
+
+# Pages with fewer lines than this are never classified as tabular (title pages, short endings)
+MIN_TABULAR_PAGE_LINES = 5
+
+# Pages whose embedded text layer is shorter than this are treated as scanned/image-only
+MIN_TEXT_LAYER_CHARS = 20
+
+# WordprocessingML, the XML inside .docx files
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_HEADING_STYLE = re.compile(r"^(?:heading|overskrift)\s*(\d)$", re.IGNORECASE)
+
+
+class Page:
+    """One extracted page. Lines and table rows (cell text) are stored as tuples."""
+    __slots__ = ("number", "model", "lines", "tables")
+
+    def __init__(self, number, model, lines, tables=()):
+        self.number = number
+        self.model = model
+        self.lines = tuple(lines)
+        self.tables = tuple(tuple(tuple(row) for row in table) for table in tables)
+
+    def looks_tabular(self):
+        """Simple heuristic: a page with many short lines usually contains tables"""
+        if len(self.lines) < MIN_TABULAR_PAGE_LINES:
+            return False
+        short_lines = 0
+        for line in self.lines:
+            length = len(line.strip())
+            if 0 < length < 20:
+                short_lines += 1
+        return short_lines > len(self.lines) * 0.3  # More than 30% short lines
+
+    def render_parts(self):
+        """Yield the page's text pieces: tables first, then the regular lines"""
+        for table in self.tables:
+            yield "\n[TABELL]\n"
+            for row in table:
+                yield " | ".join(row)
+                yield "\n"
+            yield "[/TABELL]\n\n"
+        for line in self.lines:
+            yield line
+            yield "\n"
+
+
+class Extraction:
+    """An extracted document: its pages in page order"""
+    __slots__ = ("pages",)
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    @classmethod
+    def from_text(cls, text, model="text"):
+        """Wrap plain text (TXT/CSV) as a single-page extraction"""
+        return cls([Page(1, model, text.splitlines())])
+
+    @property
+    def model(self):
+        """Summary model name, e.g. 'local+prebuilt-layout'"""
+        return "+".join(sorted({page.model for page in self.pages}))
+
+    def render(self):
+        """Render the pages as page-marked text, in one pass and one final join"""
+        parts = []
+        for page in self.pages:
+            if page.number > 1:
+                parts.append(f"\n--- Side {page.number} ---\n")
+            parts.extend(page.render_parts())
+        return "".join(parts)
+
+    def page_models(self):
+        """Which pages went through which extraction model, as page ranges per model"""
+        by_model = {}
+        for page in self.pages:
+            by_model.setdefault(page.model, []).append(page.number)
+        return {model: _page_ranges(numbers) for model, numbers in by_model.items()}
+
+    def to_json(self):
+        # Pages as compact arrays: [number, model, lines, tables]
+        return {"pages": [[page.number, page.model, page.lines, page.tables] for page in self.pages]}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls([Page(number, model, lines, tables) for number, model, lines, tables in data["pages"]])
+
+
+def _read_pages(result):
+    """Per-page lines from a prebuilt-read result"""
+    return [Page(page.page_number, "prebuilt-read", (line.content for line in page.lines)) for page in result.pages]
+
+
+def _table_rows(table):
+    """Table cells as rows of text, placed by row/column index, column-header rows first"""
+    grid = [[""] * table.column_count for _ in range(table.row_count)]
+    header_rows = set()
+    for cell in table.cells:
+        grid[cell.row_index][cell.column_index] = cell.content
+        if getattr(cell, 'kind', None) == "columnHeader":
+            header_rows.add(cell.row_index)
+    ordered = sorted(range(table.row_count), key=lambda index: index not in header_rows)
+    return [grid[index] for index in ordered if any(grid[index])]
+
+
+def _span_filter(tables):
+    """Return a predicate telling whether a line lies entirely inside one of the tables' text spans"""
+    table_spans = sorted(
+        (span.offset, span.offset + span.length)
+        for table in tables for span in (getattr(table, 'spans', None) or ())
+    )
+    starts = [start for start, _ in table_spans]
+
+    def in_table(line):
+        spans = getattr(line, 'spans', None)
+        if not spans or not table_spans:
+            return False
+        for span in spans:
+            index = bisect_right(starts, span.offset) - 1
+            if index < 0 or span.offset + span.length > table_spans[index][1]:
+                return False
+        return True
+
+    return in_table
+
+
+def _layout_pages(result):
+    """Per-page lines and tables from a prebuilt-layout result.
+
+    Lines whose text span falls inside a table are left out, since the table
+    already carries that text.
+    """
+    # Group tables by page to avoid duplication
+    tables_by_page = {}
+    all_tables = []
+    if hasattr(result, 'tables') and result.tables:
+        for table in result.tables:
+            if hasattr(table, 'bounding_regions') and table.bounding_regions:
+                page_num = table.bounding_regions[0].page_number
+                tables_by_page.setdefault(page_num, []).append(table)
+                all_tables.append(table)
+    in_table = _span_filter(all_tables)
+
+    pages = []
+    for page in result.pages:
+        tables = [_table_rows(table) for table in tables_by_page.get(page.page_number, [])]
+        lines = (line.content for line in page.lines if not in_table(line))
+        pages.append(Page(page.page_number, "prebuilt-layout", lines, tables))
+    return pages
+
+
+def _page_ranges(page_numbers):
+    """Format sorted 1-based page numbers as ranges, e.g. '1-3,7'"""
+    ranges = []
+    for number in page_numbers:
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def _open_pdf(blob_data):
+    """Parse a PDF locally, or return None if it can't be parsed"""
+    # Imported here: only PDF extraction needs pypdf
+    from pypdf import PdfReader
+
+    try:
+        return PdfReader(io.BytesIO(blob_data))
+    except Exception as pdf_error:
+        logging.warning(f"Could not parse PDF locally, using Document Intelligence: {pdf_error}")
+        return None
+
+
+def _local_pdf_pages(reader):
+    """Read the embedded text layer of a PDF page by page.
+
+    Returns one entry per page: the page's lines, or None when the page has no usable
+    text layer (scanned/image-only) and needs OCR.
+    """
+    pages = []
+    for page in reader.pages:
+        try:
+            text = page.extract_text() or ""
+        except Exception:
+            text = ""
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        pages.append(lines if sum(len(line) for line in lines) >= MIN_TEXT_LAYER_CHARS else None)
+    return pages
+
+
+def _docx_heading_levels(archive):
+    """Heading level by paragraph style id, from word/styles.xml.
+
+    Style ids are localized ("Overskrift1"), but built-in style names stay English
+    ("heading 1"), and custom heading styles carry an outline level.
+    """
+    levels = {}
+    try:
+        styles = ElementTree.parse(archive.open("word/styles.xml")).getroot()
+    except KeyError:
+        return levels
+    for style in styles.iter(f"{_W}style"):
+        style_id = style.get(f"{_W}styleId")
+        name = style.find(f"{_W}name")
+        name = name.get(f"{_W}val", "") if name is not None else ""
+        outline = style.find(f"{_W}pPr/{_W}outlineLvl")
+        match = _HEADING_STYLE.match(name) or _HEADING_STYLE.match(style_id or "")
+        if match:
+            levels[style_id] = int(match.group(1))
+        elif name.lower() in ("title", "tittel"):
+            levels[style_id] = 1
+        elif outline is not None and int(outline.get(f"{_W}val", "9")) < 9:
+            levels[style_id] = int(outline.get(f"{_W}val")) + 1
+    return levels
+
+
+def _docx_pages(blob_data):
+    """Read a .docx locally: paragraphs, headings ("#" per level), list items ("- ") and tables.
+
+    word/document.xml is parsed incrementally and each paragraph and table is discarded
+    once emitted, so memory stays bounded for long documents. Pages follow the page
+    breaks Word recorded when the document was last saved (and explicit ones), and each
+    table starts a new page, so the rendered text keeps the document's order.
+    Returns None if the file isn't a readable .docx.
+    """
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(blob_data))
+        heading_levels = _docx_heading_levels(archive)
+        document = archive.open("word/document.xml")
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as docx_error:
+        logging.warning(f"Could not read DOCX locally, using Document Intelligence: {docx_error}")
+        return None
+
+    pages = []
+    lines = []
+    tables = []
+    paragraphs = []     # open paragraphs; text boxes nest paragraphs inside paragraphs
+    table_depth = 0     # nested tables are flattened into the cell that holds them
+    rows = []
+    row = []
+    cell = []
+    body = None
+
+    def new_page():
+        nonlocal lines, tables
+        if lines or tables:
+            pages.append(Page(len(pages) + 1, "docx", lines, tables))
+            lines, tables = [], []
+
+    def page_break():
+        paragraph = paragraphs[-1] if paragraphs else None
+        if paragraph is None or table_depth:
+            return
+        if any(part.strip() for part in paragraph["parts"]):
+            paragraph["break_after"] = True
+        else:
+            paragraph["break_before"] = True
+
+    try:
+        for event, element in ElementTree.iterparse(document, events=("start", "end")):
+            tag = element.tag
+            if event == "start":
+                if tag == f"{_W}p":
+                    paragraphs.append({"parts": [], "level": None, "list": False, "break_before": False, "break_after": False})
+                elif tag == f"{_W}tbl":
+                    table_depth += 1
+                    if table_depth == 1:
+                        # A page renders its tables before its lines, so a table starts a new page
+                        # to stay below the heading and text that precede it
+                        new_page()
+                        rows = []
+                elif tag == f"{_W}body":
+                    body = element
+                continue
+
+            if tag == f"{_W}t" and paragraphs:
+                paragraphs[-1]["parts"].append(element.text or "")
+            elif tag == f"{_W}tab" and paragraphs:
+                paragraphs[-1]["parts"].append(" ")
+            elif tag in (f"{_W}br", f"{_W}cr") and paragraphs:
+                if element.get(f"{_W}type") == "page":
+                    page_break()
+                else:
+                    paragraphs[-1]["parts"].append("\n")
+            elif tag == f"{_W}noBreakHyphen" and paragraphs:
+                paragraphs[-1]["parts"].append("-")
+            elif tag == f"{_W}lastRenderedPageBreak":
+                page_break()
+            elif tag == f"{_W}pStyle" and paragraphs:
+                paragraphs[-1]["level"] = heading_levels.get(element.get(f"{_W}val"), paragraphs[-1]["level"])
+            elif tag == f"{_W}outlineLvl" and paragraphs and int(element.get(f"{_W}val", "9")) < 9:
+                paragraphs[-1]["level"] = int(element.get(f"{_W}val")) + 1
+            elif tag == f"{_W}numPr" and paragraphs:
+                paragraphs[-1]["list"] = True
+            elif tag == f"{_W}pageBreakBefore" and paragraphs and element.get(f"{_W}val", "true") not in ("0", "false"):
+                paragraphs[-1]["break_before"] = True
+            elif tag == f"{_W}p":
+                paragraph = paragraphs.pop()
+                text_lines = [" ".join(line.split()) for line in "".join(paragraph["parts"]).split("\n")]
+                text_lines = [line for line in text_lines if line]
+                if table_depth:
+                    cell.extend(text_lines)
+                else:
+                    if paragraph["break_before"]:
+                        new_page()
+                    if text_lines and paragraph["level"]:
+                        text_lines[0] = "#" * paragraph["level"] + " " + text_lines[0]
+                    elif text_lines and paragraph["list"]:
+                        text_lines[0] = "- " + text_lines[0]
+                    lines.extend(text_lines)
+                    if paragraph["break_after"]:
+                        new_page()
+                element.clear()
+            elif tag == f"{_W}tc" and table_depth == 1:
+                row.append(" ".join(cell))
+                # Cells spanning several grid columns keep the columns below them aligned
+                span = element.find(f"{_W}tcPr/{_W}gridSpan")
+                if span is not None:
+                    row.extend([""] * (int(span.get(f"{_W}val", "1")) - 1))
+                cell = []
+            elif tag == f"{_W}tr" and table_depth == 1:
+                if any(row):
+                    rows.append(row)
+                row = []
+            elif tag == f"{_W}tbl":
+                table_depth -= 1
+                if not table_depth:
+                    if rows:
+                        tables.append(rows)
+                    element.clear()
+
+            if body is not None and not paragraphs and not table_depth and tag in (f"{_W}p", f"{_W}tbl"):
+                # Everything read so far has been emitted
+                body.clear()
+    except ElementTree.ParseError as docx_error:
+        logging.warning(f"Could not read DOCX locally, using Document Intelligence: {docx_error}")
+        return None
+    new_page()
+    return pages
+
+
+def _pdf_subset(reader, page_numbers):
+    """Build a PDF containing only the given 1-based pages"""
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for number in page_numbers:
+        writer.add_page(reader.pages[number - 1])
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def _analyze_pdf_pages(doc_client, reader, blob_data, filename, page_numbers):
+    """Run Document Intelligence on the given PDF pages.
+
+    Large page sets are split into ranges of EXTRACTION_RANGE_PAGES pages, submitted
+    as separate sub-PDFs with at most EXTRACTION_CONCURRENCY in flight, and merged back
+    in page order with their original page numbers.
+    """
+    range_size = max(1, int(os.getenv('EXTRACTION_RANGE_PAGES', '50')))
+    concurrency = max(1, int(os.getenv('EXTRACTION_CONCURRENCY', '4')))
+    ranges = [page_numbers[i:i + range_size] for i in range(0, len(page_numbers), range_size)]
+
+    def analyze_range(numbers, data):
+        result = _analyze_with_document_intelligence(doc_client, data, filename)
+        for page in result.pages:
+            page.number = numbers[page.number - 1]
+        return result
+
+    if len(ranges) == 1 and len(page_numbers) == len(reader.pages):
+        return _analyze_with_document_intelligence(doc_client, blob_data, filename)
+
+    # PdfReader is not thread-safe, so the sub-PDFs are built here before submitting
+    subsets = [_pdf_subset(reader, numbers) for numbers in ranges]
+    if len(ranges) == 1:
+        return analyze_range(ranges[0], subsets[0])
+
+    logging.info(f"Extracting {len(page_numbers)} pages in {len(ranges)} ranges, up to {concurrency} at a time")
+    # Each range runs in a copy of this context, so its stages are traced with the analysis
+    contexts = [contextvars.copy_context() for _ in ranges]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(ranges))) as executor:
+        results = list(executor.map(lambda context, *args: context.run(analyze_range, *args), contexts, ranges, subsets))
+
+    return Extraction([page for result in results for page in result.pages])
+
+
+def extract_document(doc_client, blob_data, filename):
+    """Extract a PDF/DOC/DOCX into an Extraction.
+
+    Born-digital PDF pages are read locally from their text layer; only scanned pages
+    and pages that look tabular go to Document Intelligence. DOCX files are read
+    locally; only legacy .doc (and DOCX files that can't be parsed) go to Document
+    Intelligence. Every page records the model that produced it. Returns None if a
+    Word document cannot be read at all.
+    """
+    if filename.endswith('.docx') and os.getenv('LOCAL_DOCX_EXTRACTION', 'true').lower() == 'true':
+        with stage("extraction.docx", bytes=len(blob_data)) as span:
+            docx_pages = _docx_pages(blob_data)
+            span.set(pages=len(docx_pages or ()), tables=sum(len(page.tables) for page in docx_pages or ()))
+        if docx_pages:
+            logging.info(f"Extracted {len(docx_pages)} pages from the DOCX locally")
+            return Extraction(docx_pages)
+        if docx_pages is not None:
+            logging.info("DOCX has no text, using Document Intelligence")
+
+    reader = _open_pdf(blob_data) if filename.endswith('.pdf') else None
+    if not reader:
+        return _analyze_with_document_intelligence(doc_client, blob_data, filename)
+
+    all_pages = list(range(1, len(reader.pages) + 1))
+    if os.getenv('LOCAL_PDF_EXTRACTION', 'true').lower() == 'true':
+        with stage("extraction.text_layer", pages=len(all_pages)) as span:
+            local_pages = _local_pdf_pages(reader)
+            span.set(text_pages=sum(lines is not None for lines in local_pages))
+        text_pages = [
+            Page(page_num + 1, "local", lines)
+            for page_num, lines in enumerate(local_pages) if lines is not None
+        ]
+        if not text_pages:
+            logging.info("PDF has no text layer, using Document Intelligence")
+        else:
+            # The text layer loses table structure, so tabular pages go straight to prebuilt-layout;
+            # only pages without a text layer need prebuilt-read
+            local_kept = [page for page in text_pages if not page.looks_tabular()]
+            tabular = [page for page in text_pages if page.looks_tabular()]
+            scanned = [number for number, lines in enumerate(local_pages, 1) if lines is None]
+            if not tabular and not scanned:
+                logging.info(f"Extracted all {len(local_pages)} pages from the PDF text layer")
+                return Extraction(local_kept)
+
+            logging.info(
+                f"Sending {len(tabular)} tabular and {len(scanned)} scanned of {len(local_pages)} pages "
+                f"to Document Intelligence"
+            )
+            pages = local_kept
+            if tabular:
+                pages = pages + _layout_pdf_pages(doc_client, blob_data, tabular)
+            if scanned:
+                pages = pages + _analyze_pdf_pages(doc_client, reader, blob_data, filename, scanned).pages
+            return Extraction(sorted(pages, key=lambda page: page.number))
+
+    return _analyze_pdf_pages(doc_client, reader, blob_data, filename, all_pages)
+
+
+def _layout_pdf_pages(doc_client, blob_data, pages):
+    """Re-extract text-layer pages that look tabular with prebuilt-layout, in one call with pages=.
+
+    If layout analysis fails, the text-layer pages are kept.
+    """
+    numbers = [page.number for page in pages]
+    try:
+        with stage("document_intelligence.layout", fallback="text_layer_tables", pages=len(numbers)):
+            poller = doc_client.begin_analyze_document("prebuilt-layout", blob_data, pages=_page_ranges(numbers))
+            layout_pages = {page.number: page for page in _layout_pages(poller.result())}
+    except Exception as layout_error:
+        logging.warning(f"Layout analysis of table pages failed, keeping the text layer: {layout_error}")
+        layout_pages = {}
+    return [layout_pages.get(page.number, page) for page in pages]
+
+
+def _analyze_with_document_intelligence(doc_client, blob_data, filename):
+    """Run Document Intelligence on a whole document.
+
+    Runs prebuilt-read first (cheaper/faster) and re-analyzes only the pages that look
+    tabular with prebuilt-layout. Word documents, which don't support page selection,
+    and documents where read fails or every page is tabular get a full layout pass.
+    """
+    fallback = "full_layout"
+    try:
+        with stage("document_intelligence.read", bytes=len(blob_data)) as span:
+            poller = doc_client.begin_analyze_document("prebuilt-read", blob_data)
+            pages_read = _read_pages(poller.result())
+            tabular = [page.number for page in pages_read if page.looks_tabular()]
+            span.set(pages=len(pages_read), tabular_pages=len(tabular))
+        if not tabular:
+            return Extraction(pages_read)
+
+        if filename.endswith('.pdf') and len(tabular) < len(pages_read):
+            logging.info(f"Pages {_page_ranges(tabular)} appear to have tables, using layout analysis for those")
+            try:
+                with stage("document_intelligence.layout", fallback="table_pages", pages=len(tabular)):
+                    poller = doc_client.begin_analyze_document("prebuilt-layout", blob_data, pages=_page_ranges(tabular))
+                    layout_pages = {page.number: page for page in _layout_pages(poller.result())}
+            except Exception as layout_error:
+                # Keep the read text for those pages rather than failing the document
+                logging.warning(f"Layout analysis of table pages failed, keeping read result: {layout_error}")
+                layout_pages = {}
+            return Extraction([layout_pages.get(page.number, page) for page in pages_read])
+        logging.info("Document appears to have tables, using layout analysis")
+    except Exception as read_error:
+        logging.warning(f"Read analysis failed, attempting layout analysis: {read_error}")
+        fallback = "read_failed"
+
+    # Fallback to layout analysis for better structure preservation
+    try:
+        with stage("document_intelligence.layout", fallback=fallback, bytes=len(blob_data)) as span:
+            poller = doc_client.begin_analyze_document("prebuilt-layout", blob_data)
+            pages = _layout_pages(poller.result())
+            span.set(pages=len(pages))
+        return Extraction(pages)
+    except Exception:
+        if filename.endswith('.pdf'):
+            raise
+        logging.error("Layout analysis failed for Word document", exc_info=True)
+        return None
+
+
+def sidecar_blob_name(file_id):
+    return f"{file_id}/{SIDECAR_NAME}"
+
+
+def load_sidecar(container_client, file_id):
+    """Load a stored extraction for file_id, or None if missing or from an older format"""
+    try:
+        raw = container_client.get_blob_client(sidecar_blob_name(file_id)).download_blob().readall()
+        data = json.loads(gzip.decompress(raw))
+        if data.get("version") != SIDECAR_VERSION:
+            return None
+        return Extraction.from_json(data)
+    except ResourceNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as sidecar_error:
+        logging.warning(f"Ignoring unreadable extraction sidecar for {file_id}: {sidecar_error}")
+        return None
+
+
+def save_sidecar(container_client, file_id, extraction):
+    """Store an extraction as gzip-compressed JSON next to the uploaded file"""
+    payload = dict(extraction.to_json(), version=SIDECAR_VERSION)
+    raw = gzip.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+    container_client.get_blob_client(sidecar_blob_name(file_id)).upload_blob(raw, overwrite=True)
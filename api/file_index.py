@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from azure.core.exceptions import ResourceNotFoundError
+
+# Index entries live next to the uploads, under this prefix in the pdf-uploads container
+FILE_INDEX_PREFIX = "_files/"
+
+# Entries map a content hash to the file_id whose extraction sidecar holds that content
+_HASH_DIR = "by-sha256"
+
+
+def file_record(file_id, blob_name, filename, size, content_hash, content_type):
+    """New index entry for an upload"""
+    now = time.time()
+    return {
+        "file_id": file_id,
+        "blob_name": blob_name,
+        "filename": filename,
+        "size": size,
+        "sha256": content_hash,
+        "content_type": content_type,
+        "extraction": None,   # None, or "stored" once the extraction sidecar exists
+        "analysis": None,     # None, queued, running, completed or failed
+        "job_id": None,
+        "created_at": now,
+        "updated_at": now
+    }
+
+
+class LocalFileIndex:
+    """File index as JSON files in a local directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, _HASH_DIR), exist_ok=True)
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, name, value):
+        # Write to a temp file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+    def get(self, file_id):
+        return self._read(f"{file_id}.json")
+
+    def put(self, record):
+        self._write(f"{record['file_id']}.json", record)
+
+    def get_by_hash(self, content_hash):
+        entry = self._read(os.path.join(_HASH_DIR, f"{content_hash}.json"))
+        return entry.get("file_id") if entry else None
+
+    def put_hash(self, content_hash, file_id):
+        self._write(os.path.join(_HASH_DIR, f"{content_hash}.json"), {"file_id": file_id})
+
+
+class BlobFileIndex:
+    """File index as JSON blobs in the uploads container; every lookup is a single blob read"""
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+
+    def _read(self, name):
+        try:
+            return json.loads(self.container_client.get_blob_client(f"{FILE_INDEX_PREFIX}{name}").download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+        except ValueError:
+            return None
+
+    def _write(self, name, value):
+        payload = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        self.container_client.get_blob_client(f"{FILE_INDEX_PREFIX}{name}").upload_blob(payload, overwrite=True)
+
+    def get(self, file_id):
+        return self._read(f"{file_id}.json")
+
+    def put(self, record):
+        self._write(f"{record['file_id']}.json", record)
+
+    def get_by_hash(self, content_hash):
+        entry = self._read(f"{_HASH_DIR}/{content_hash}.json")
+        return entry.get("file_id") if entry else None
+
+    def put_hash(self, content_hash, file_id):
+        self._write(f"{_HASH_DIR}/{content_hash}.json", {"file_id": file_id})
+
+
+_file_index = None
+_update_lock = threading.Lock()
+
+
+def get_file_index(container_client):
+    """Return the configured index backend (FILE_INDEX_BACKEND: blob or local)"""
+    global _file_index
+
+    if not _file_index:
+        backend = os.getenv('FILE_INDEX_BACKEND', 'blob').lower()
+        if backend == 'local':
+            directory = os.getenv('FILE_INDEX_DIR') or os.path.join(tempfile.gettempdir(), 'pdf-ai-analyzer-files')
+            _file_index = LocalFileIndex(directory)
+        else:
+            _file_index = BlobFileIndex(container_client)
+        logging.info(f"File index backend: {backend}")
+
+    return _file_index
+
+
+def update_file(index, file_id, **fields):
+    """Set fields on a file's index entry; a missing entry or a failing store is only logged"""
+    try:
+        # Serializes read-modify-write within this process; the index is advisory across instances
+        with _update_lock:
+            record = index.get(file_id)
+            if not record:
+                return None
+            record.update(fields)
+            record["updated_at"] = time.time()
+            index.put(record)
+            return record
+    except Exception as index_error:
+        logging.warning(f"Could not update file index for {file_id}: {index_error}")
+        return None
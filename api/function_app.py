@@ -1,56 +1,280 @@
+import time
+_module_started = time.perf_counter()
+
+import asyncio
 import azure.functions as func
 import logging
 import json
 import os
-import io
-from azure.storage.blob import BlobServiceClient
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.inference import ChatCompletionsClient
-from azure.identity import DefaultAzureCredential
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 import uuid
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from analysis_cache import cache_key, get_analysis_cache, get_chunk_cache
+from analysis_merge import merge_structured
+from json_repair import parse_analysis, validate_analysis, repair_json, record_repair, repair_counts
+from extraction import Extraction, extract_document, load_sidecar, save_sidecar, sidecar_blob_name
+from chunking import chunk_extraction, count_tokens, normalize_chunk_text
+from cleaning import clean_extraction
+from csv_profile import profile_csv
+from clients import ConfigError, ai_config, get_blob_service, get_chat_client, get_document_client
+from file_index import file_record, get_file_index, update_file
+from rate_limit import limiter_stats
+from scheduler import get_scheduler
+from telemetry import analysis_trace, configure_exporter, record_usage, stage
+from uploads import ALLOWED_EXTENSIONS, UploadError, max_upload_bytes, register_blob, stream_to_blob, upload_sas_url
+from jobs import JOB_QUEUE_NAME, create_batch, create_job, get_batch, get_job, job_events, job_progress, enqueue_job, job_queue_backend, save_job
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
-# Azure service clients
-blob_service_client = None
-doc_client = None
+# Ask for JSON mode (response_format="json_object") unless AI_JSON_MODE=false. Turned off
+# for the rest of the process if the deployment rejects it.
+json_mode = os.getenv('AI_JSON_MODE', 'true').lower() == 'true'
+json_mode_lock = threading.Lock()
+
+def rejects_json_mode(error):
+    """Whether a 400 from the model is about response_format, rather than e.g. a content
+    filter hit or a prompt over the context length, which must not turn JSON mode off"""
+    if error.status_code != 400:
+        return False
+    code = getattr(getattr(error, 'error', None), 'code', None) or ""
+    details = f"{code} {error.message or ''} {error}".lower()
+    return any(marker in details for marker in ("response_format", "json_object", "json mode"))
+
+def complete_json(ai_client, **kwargs):
+    """ai_client.complete for calls that must return a JSON object, in JSON mode when supported"""
+    global json_mode
+    response = None
+    if json_mode:
+        try:
+            response = ai_client.complete(response_format="json_object", **kwargs)
+        except HttpResponseError as mode_error:
+            if not rejects_json_mode(mode_error):
+                raise
+            with json_mode_lock:
+                if json_mode:
+                    logging.warning(f"JSON mode rejected by the model deployment, continuing without it: {mode_error}")
+                    json_mode = False
+    if response is None:
+        response = ai_client.complete(**kwargs)
+    if not kwargs.get("stream"):
+        record_usage(getattr(response, 'usage', None))
+    return response
+
+def summary_points(partial):
+    """Summary points of a (partial) analysis, for progress events"""
+    analysis = validate_analysis(partial)
+    return analysis["sammendrag"] if analysis else []
+
+# Minimum seconds between partial results while a model answer streams in
+STREAM_EVENT_INTERVAL = 0.5
 
-def get_clients():
-    global blob_service_client, doc_client
+def stream_json(ai_client, on_partial, **kwargs):
+    """Streaming complete_json: returns the full answer, calling on_partial(parsed) as it grows.
+
+    parsed is the answer so far, closed and parsed by repair_json (None until it has
+    an object to show); calls are throttled to one per STREAM_EVENT_INTERVAL.
+    """
+    parts = []
+    usage = None
+    last_partial = time.monotonic()
+    # Closing the stream gives back its concurrency slot, also when on_partial raises
+    with complete_json(ai_client, stream=True, **kwargs) as updates:
+        for update in updates:
+            usage = getattr(update, 'usage', None) or usage  # Only some deployments report usage on streams
+            delta = update.choices[0].delta.content if update.choices and update.choices[0].delta else None
+            if not delta:
+                continue
+            parts.append(delta)
+            now = time.monotonic()
+            if now - last_partial >= STREAM_EVENT_INTERVAL:
+                last_partial = now
+                partial = repair_json("".join(parts))
+                if partial:
+                    on_partial(partial)
+    text = "".join(parts)
+    prompt_tokens = sum(count_tokens(str(message.get("content", ""))) for message in kwargs.get("messages", []))
+    record_usage(usage, estimate=(prompt_tokens, count_tokens(text)))
+    return text
+
+# Bump when the prompts, or what the model is given for a file type, change so cached
+# analyses from older versions are not reused (3: CSV files are sent as a column profile)
+PROMPT_VERSION = "3"
+
+# Returned in place of a chunk analysis when the model call for that chunk fails
+CHUNK_FALLBACK_ANALYSIS = '{"sammendrag": ["Kunne ikke analysere denne delen"], "nøkkelinformasjon": {"personer": [], "selskaper": [], "offentlige_etater": [], "tidsperiode": ""}, "røde_flagg": {"uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [], "varsler_og_mangler": [], "andre_røde_flagg": []}}'
+
+def analyze_chunk(ai_client, model, chunk, index, total):
+    """Analyze one chunk of a larger document (map step), returning the raw JSON text"""
+    logging.info(f"Analyserer chunk {index+1}/{total}")
     
-    if not blob_service_client:
-        # Try connection string first, then account key, fallback to managed identity
-        storage_connection_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING') or os.getenv('AzureWebJobsStorage')
-        if storage_connection_string and storage_connection_string.strip():
-            blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
-        else:
-            # Try using account key
-            account_key = os.getenv('AZURE_STORAGE_ACCOUNT_KEY')
-            if account_key:
-                account_url = "https://pdfaianalyzernorway.blob.core.windows.net"
-                blob_service_client = BlobServiceClient(
-                    account_url=account_url, 
-                    credential=account_key
+    chunk_system = "Du analyserer dokumenter for Dagens Næringsliv. Returner KUN gyldig JSON uten markdown eller kommentarer."
+    chunk_user = f"""Analyser denne delen av et større dokument.
+
+JSON format:
+{{
+  "sammendrag": ["Viktige punkter fra denne delen"],
+  "nøkkelinformasjon": {{
+    "personer": ["Personer nevnt"], "selskaper": ["Selskaper nevnt"], 
+    "offentlige_etater": ["Etater nevnt"], "tidsperiode": "Tidsinfo"
+  }},
+  "røde_flagg": {{
+    "uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [],
+    "varsler_og_mangler": [], "andre_røde_flagg": []
+  }}
+}}
+
+Del {index+1}/{total}:
+{chunk}"""
+    
+    try:
+        with stage("map.chunk", chunk_index=index, chunks_total=total):
+            response = complete_json(
+                ai_client,
+                model=model,
+                messages=[
+                    {"role": "system", "content": chunk_system},
+                    {"role": "user", "content": chunk_user}
+                ],
+                max_tokens=1500,
+                temperature=0.3
+            )
+        return response.choices[0].message.content
+    except Exception as api_error:
+        logging.error(f"Feil ved analyse av chunk {index+1}: {api_error}")
+        return CHUNK_FALLBACK_ANALYSIS
+
+def chunk_cache_key(chunk, model):
+    """Cache key for a chunk's map result: its normalized text + model name + prompt version"""
+    text_hash = hashlib.sha256(normalize_chunk_text(chunk.text).encode('utf-8')).hexdigest()
+    return cache_key(text_hash, model, PROMPT_VERSION)
+
+def summarize_points(ai_client, model, point_groups, final=True, on_points=None):
+    """Ask the model to condense groups of summary points into one list of points.
+
+    Intermediate merges (final=False) keep the important points of their groups;
+    the final merge condenses them to 5-8 points for the whole document. Falls back
+    to the first points of each group if the model's answer can't be used. With
+    on_points, the answer is streamed and on_points(points) called as points arrive.
+    """
+    summary_hint = "5-8 hovedpunkter fra hele dokumentet" if final else "De viktigste punktene fra disse delene"
+    synthesis_system = "Du syntetiserer dokumentanalyser for Dagens Næringsliv. Returner KUN gyldig JSON uten markdown."
+    parts = "\n".join(
+        f"Del {i+1}:\n" + "\n".join(f"- {point}" for point in points)
+        for i, points in enumerate(point_groups)
+    )
+    synthesis_user = f"""Lag et samlet sammendrag av disse {len(point_groups)} delsammendragene.
+
+JSON format:
+{{"sammendrag": ["{summary_hint}"]}}
+
+Delsammendrag:
+{parts}"""
+    
+    try:
+        request = dict(
+            model=model,
+            messages=[
+                {"role": "system", "content": synthesis_system},
+                {"role": "user", "content": synthesis_user}
+            ],
+            max_tokens=1000,
+            temperature=0.3
+        )
+        with stage("synthesis.call", groups=len(point_groups), final=final):
+            if on_points:
+                content = stream_json(
+                    ai_client,
+                    lambda partial: on_points(summary_points(partial)),
+                    **request
                 )
             else:
-                # Fallback to managed identity
-                account_url = "https://pdfaianalyzernorway.blob.core.windows.net"
-                blob_service_client = BlobServiceClient(
-                    account_url=account_url, 
-                    credential=DefaultAzureCredential()
-                )
+                content = complete_json(ai_client, **request).choices[0].message.content
+        summary = parse_analysis(content)
+    except Exception as api_error:
+        error_str = str(api_error)
+        logging.error(f"Feil ved syntese: {error_str}", exc_info=True)
+        raise Exception(f"Feil ved syntese av analyse: {error_str}")
+    
+    points = summary.get("sammendrag") if summary else None
+    if isinstance(points, list) and points:
+        return [str(point) for point in points]
+    logging.warning("Ugyldig sammendrag fra syntese, bruker de første punktene fra hver del")
+    limit = 8 if final else 5
+    return [point for points in point_groups for point in points[:2]][:limit]
+
+def reduce_analyses(ai_client, model, analyses, report, owner):
+    """Combine chunk analyses into one analysis, returned as JSON text.
+
+    nøkkelinformasjon and røde_flagg are merged locally. Only the summary points go
+    to the model, merged as a tree: groups of SYNTHESIS_FAN_IN in parallel (through
+    the shared scheduler, as owner), level by level, until a final synthesis over at
+    most SYNTHESIS_FAN_IN groups remains.
+    """
+    fan_in = max(2, int(os.getenv('SYNTHESIS_FAN_IN', '5')))
     
-    if not doc_client:
-        # Document Intelligence client
-        doc_intelligence_endpoint = os.getenv('DOC_INTELLIGENCE_ENDPOINT')
-        doc_intelligence_key = os.getenv('DOC_INTELLIGENCE_KEY')
-        doc_client = DocumentAnalysisClient(
-            endpoint=doc_intelligence_endpoint,
-            credential=AzureKeyCredential(doc_intelligence_key)
+    parsed = [parse_analysis(analysis) for analysis in analyses]
+    nøkkelinformasjon, røde_flagg = merge_structured([analysis for analysis in parsed if analysis])
+    
+    # Chunks whose output isn't valid JSON still contribute their raw text as summary input
+    point_groups = []
+    for analysis, raw in zip(parsed, analyses):
+        if analysis:
+            point_groups.append([str(point) for point in analysis.get("sammendrag") or []])
+        else:
+            point_groups.append([raw])
+    
+    level = 0
+    while len(point_groups) > fan_in:
+        level += 1
+        groups = [point_groups[i:i + fan_in] for i in range(0, len(point_groups), fan_in)]
+        logging.info(f"Syntesenivå {level}: {len(point_groups)} delsammendrag i {len(groups)} grupper")
+        report("synthesizing", synthesis_level=level, synthesis_groups=len(groups))
+        point_groups = get_scheduler().map(
+            owner,
+            lambda group: group[0] if len(group) == 1 else summarize_points(ai_client, model, group, final=False),
+            groups
         )
     
-    return blob_service_client, doc_client
+    report("synthesizing", synthesis_level=level + 1, synthesis_groups=1)
+    sammendrag = summarize_points(
+        ai_client, model, point_groups, final=True,
+        on_points=lambda points: report("synthesizing", event={"type": "summary", "data": points, "replace": True})
+    )
+    return json.dumps({
+        "sammendrag": sammendrag,
+        "nøkkelinformasjon": nøkkelinformasjon,
+        "røde_flagg": røde_flagg
+    }, ensure_ascii=False)
+
+def upload_response(file_id, filename, content_hash):
+    return func.HttpResponse(
+        json.dumps({
+            "message": "File uploaded successfully",
+            "file_id": file_id,
+            "filename": filename,
+            "sha256": content_hash
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+def validate_filename(filename):
+    """Error response for a missing or disallowed filename, or None if it is fine"""
+    if not filename:
+        return func.HttpResponse(
+            json.dumps({"error": "No file selected"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+    if not filename.lower().endswith(ALLOWED_EXTENSIONS):
+        return func.HttpResponse(
+            json.dumps({"error": "Only PDF, TXT, CSV, DOC, and DOCX files are allowed"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+    return None
 
 @app.route(route="upload", methods=["POST"])
 def upload_pdf(req: func.HttpRequest) -> func.HttpResponse:
@@ -67,63 +291,35 @@ def upload_pdf(req: func.HttpRequest) -> func.HttpResponse:
             )
         
         file = files['file']
-        if file.filename == '':
-            return func.HttpResponse(
-                json.dumps({"error": "No file selected"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        
-        # Validate file type
-        allowed_extensions = ('.pdf', '.txt', '.csv', '.doc', '.docx')
-        if not file.filename.lower().endswith(allowed_extensions):
-            return func.HttpResponse(
-                json.dumps({"error": "Only PDF, TXT, CSV, DOC, and DOCX files are allowed"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        
-        # Security: Check file size (limit to 50MB)
-        file_content = file.read()
-        max_file_size = 50 * 1024 * 1024  # 50MB in bytes
-        if len(file_content) > max_file_size:
-            return func.HttpResponse(
-                json.dumps({"error": f"File size too large. Maximum allowed size is {max_file_size // (1024*1024)}MB"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        
-        # Security: Basic file content validation
-        if len(file_content) == 0:
-            return func.HttpResponse(
-                json.dumps({"error": "Empty file not allowed"}),
-                status_code=400,
-                mimetype="application/json"
-            )
+        invalid = validate_filename(file.filename)
+        if invalid:
+            return invalid
         
         # Generate unique filename
         file_id = str(uuid.uuid4())
         blob_name = f"{file_id}/{file.filename}"
         
-        # Upload to Azure Blob Storage
-        blob_service_client, _ = get_clients()
+        # Copy to Azure Blob Storage block by block. The size limit (MAX_UPLOAD_MB) and the
+        # content hash (the analysis cache key) are computed on the way, without a full copy.
+        blob_service_client = get_blob_service()
         blob_client = blob_service_client.get_blob_client(
             container="pdf-uploads", 
             blob=blob_name
         )
+        size, content_hash = stream_to_blob(blob_client, file.stream)
+        index_upload(
+            blob_service_client.get_container_client("pdf-uploads"),
+            file_record(file_id, blob_name, file.filename, size, content_hash, file.content_type)
+        )
         
-        blob_client.upload_blob(file_content, overwrite=True)
+        return upload_response(file_id, file.filename, content_hash)
         
+    except UploadError as e:
         return func.HttpResponse(
-            json.dumps({
-                "message": "File uploaded successfully",
-                "file_id": file_id,
-                "filename": file.filename
-            }),
-            status_code=200,
+            json.dumps({"error": str(e)}),
+            status_code=e.status_code,
             mimetype="application/json"
         )
-        
     except Exception as e:
         logging.error(f"Upload error: {str(e)}")
         return func.HttpResponse(
@@ -132,271 +328,301 @@ def upload_pdf(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
-@app.route(route="analyze/{file_id}", methods=["POST"])
-def analyze_pdf(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('PDF analysis function triggered.')
+@app.route(route="upload/sas", methods=["POST"])
+def upload_sas(req: func.HttpRequest) -> func.HttpResponse:
+    """Start a direct upload: returns a short-lived SAS URL the client PUTs the file to.
+
+    The client then calls upload/{file_id}/complete, so the file never passes through
+    this function app.
+    """
+    try:
+        filename = (req.get_json() or {}).get('filename')
+    except ValueError:
+        filename = None
+    invalid = validate_filename(filename)
+    if invalid:
+        return invalid
     
     try:
-        file_id = req.route_params.get('file_id')
-        if not file_id:
+        file_id = str(uuid.uuid4())
+        blob_name = f"{file_id}/{filename}"
+        blob_service_client = get_blob_service()
+        blob_client = blob_service_client.get_blob_client(
+            container="pdf-uploads",
+            blob=blob_name
+        )
+        upload_url = upload_sas_url(blob_service_client, blob_client)
+        # Size and hash are filled in when the upload is completed
+        index_upload(
+            blob_service_client.get_container_client("pdf-uploads"),
+            file_record(file_id, blob_name, filename, None, None, None)
+        )
+    except Exception as e:
+        logging.error(f"Could not create upload URL: {e}", exc_info=True)
+        return func.HttpResponse(
+            json.dumps({"error": f"Upload failed: {str(e)}"}),
+            status_code=500,
+            mimetype="application/json"
+        )
+    return func.HttpResponse(
+        json.dumps({
+            "file_id": file_id,
+            "upload_url": upload_url,
+            "headers": {"x-ms-blob-type": "BlockBlob"},
+            "max_bytes": max_upload_bytes(),
+            "complete_url": f"/api/upload/{file_id}/complete"
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+@app.route(route="upload/{file_id}/complete", methods=["POST"])
+def upload_complete(req: func.HttpRequest) -> func.HttpResponse:
+    """Register a direct upload: check its size and store its SHA-256, read in blocks"""
+    file_id = req.route_params.get('file_id')
+    try:
+        blob_service_client = get_blob_service()
+        container_client = blob_service_client.get_container_client("pdf-uploads")
+        file_index = get_file_index(container_client)
+        record = file_index.get(file_id)
+        doc_name = record["blob_name"] if record else find_document_blob(container_client, file_id)[0]
+        if not doc_name:
             return func.HttpResponse(
-                json.dumps({"error": "File ID required"}),
-                status_code=400,
+                json.dumps({"error": "File not found"}),
+                status_code=404,
                 mimetype="application/json"
             )
-        
-        # Get blob from storage
-        blob_service_client, doc_client = get_clients()
-        
-        # Find the document file in the blob storage
-        container_client = blob_service_client.get_container_client("pdf-uploads")
-        blobs = container_client.list_blobs(name_starts_with=file_id)
-        
-        doc_blob = None
-        for blob in blobs:
-            # Support all allowed file types
-            allowed_extensions = ('.pdf', '.txt', '.csv', '.doc', '.docx')
-            if blob.name.lower().endswith(allowed_extensions):
-                doc_blob = blob
-                break
-        
-        if not doc_blob:
+        try:
+            size, content_hash = register_blob(container_client.get_blob_client(doc_name))
+        except ResourceNotFoundError:
             return func.HttpResponse(
                 json.dumps({"error": "File not found"}),
                 status_code=404,
                 mimetype="application/json"
             )
-        
-        # Download blob content
-        blob_client = blob_service_client.get_blob_client(
-            container="pdf-uploads", 
-            blob=doc_blob.name
+        filename = doc_name.split("/", 1)[1]
+        if record:
+            update_file(file_index, file_id, size=size, sha256=content_hash)
+        else:
+            index_upload(container_client, file_record(file_id, doc_name, filename, size, content_hash, None))
+        return upload_response(file_id, filename, content_hash)
+    except UploadError as e:
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
+            status_code=e.status_code,
+            mimetype="application/json"
         )
-        blob_data = blob_client.download_blob().readall()
-        
-        # Extract text based on file type with improved structure preservation
-        filename = doc_blob.name.lower()
-        if filename.endswith('.txt') or filename.endswith('.csv'):
+    except Exception as e:
+        logging.error(f"Upload error: {str(e)}")
+        return func.HttpResponse(
+            json.dumps({"error": f"Upload failed: {str(e)}"}),
+            status_code=500,
+            mimetype="application/json"
+        )
+
+def find_document_blob(container_client, file_id):
+    """Locate an upload by listing its blobs: (blob name, sha256 metadata, has sidecar)"""
+    doc_blob = None
+    has_sidecar = False
+    for blob in container_client.list_blobs(name_starts_with=f"{file_id}/", include=['metadata']):
+        if blob.name == sidecar_blob_name(file_id):
+            has_sidecar = True
+            continue
+        # Support all allowed file types
+        if not doc_blob and blob.name.lower().endswith(ALLOWED_EXTENSIONS):
+            doc_blob = blob
+    if not doc_blob:
+        return None, None, False
+    return doc_blob.name, (doc_blob.metadata or {}).get('sha256'), has_sidecar
+
+def index_upload(container_client, record):
+    """Add an upload to the file index. Analysis falls back to a blob listing without it."""
+    try:
+        get_file_index(container_client).put(record)
+    except Exception as index_error:
+        logging.warning(f"Could not add {record['file_id']} to the file index: {index_error}")
+
+class AnalysisError(Exception):
+    """Analysis failure that should be reported with a specific HTTP status code"""
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+def friendly_error_message(error_msg):
+    """Map low-level SDK errors to messages that are useful to the user"""
+    if "Could not resolve host" in error_msg or "Connection" in error_msg:
+        return "Kunne ikke koble til Azure AI-tjenesten. Sjekk nettverkstilkobling."
+    elif "authentication" in error_msg.lower() or "unauthorized" in error_msg.lower() or "401" in error_msg:
+        return "Autentisering feilet. Sjekk at API-nøkkelen er korrekt."
+    elif "model" in error_msg.lower() or "deployment" in error_msg.lower() or "404" in error_msg:
+        ai_foundry_model = os.getenv('AI_FOUNDRY_MODEL', 'gpt-4o-mini')
+        return f"Modell ikke funnet. Sjekk at '{ai_foundry_model}' er riktig deployment-navn."
+    elif "endpoint" in error_msg.lower():
+        return "Endpoint-konfigurasjon feilet. Sjekk AI_FOUNDRY_ENDPOINT."
+    return error_msg
+
+def run_analysis(file_id, progress=None):
+    """Run the full analysis pipeline for an uploaded file and return the response body.
+
+    progress, if given, is called as progress(stage, event=None, **details) when a stage
+    starts and after every analyzed chunk. event carries partial results for streaming
+    clients: "extracted", "chunk" (one chunk's analysis) and "summary" (the summary
+    points so far, while the synthesis streams). Raises AnalysisError for client-facing
+    failures.
+
+    Each stage is traced (OpenTelemetry spans and metrics, see telemetry.py), and the
+    response gets this run's "timings" and token "usage", also on a cache hit.
+    """
+    with analysis_trace(file_id) as trace:
+        response_body = analyze_file(file_id, progress)
+        response_body["timings"] = trace.timings()
+        response_body["usage"] = trace.usage_summary()
+    logging.info(
+        f"Analysis of {file_id}: {response_body['timings']['total_ms']:.0f} ms, "
+        f"{response_body['usage']['total_tokens']} tokens in {response_body['usage']['calls']} model calls"
+    )
+    return response_body
+
+def analyze_file(file_id, progress):
+    report = progress or (lambda stage, **details: None)
+    
+    # Get blob from storage
+    report("downloading")
+    blob_service_client = get_blob_service()
+    
+    # Find the document file (and any stored extraction): one lookup in the file index,
+    # or a listing of the file's blobs for uploads from before the index existed
+    container_client = blob_service_client.get_container_client("pdf-uploads")
+    file_index = get_file_index(container_client)
+    record = file_index.get(file_id)
+    if record and record.get("sha256"):
+        doc_name = record["blob_name"]
+        content_hash = record["sha256"]
+        has_sidecar = record.get("extraction") == "stored"
+    else:
+        doc_name, content_hash, has_sidecar = find_document_blob(container_client, file_id)
+    
+    if not doc_name:
+        raise AnalysisError("File not found", status_code=404)
+    
+    blob_client = blob_service_client.get_blob_client(
+        container="pdf-uploads", 
+        blob=doc_name
+    )
+    ai_foundry_model = os.getenv('AI_FOUNDRY_MODEL', 'gpt-4o-mini')
+    
+    def download():
+        with stage("download") as span:
+            data = blob_client.download_blob().readall()
+            span.set(bytes=len(data))
+        return data
+    
+    # Look up a previous analysis of the same bytes before any extraction or model calls
+    blob_data = None
+    if not content_hash:
+        # Uploaded before hashing was added; hash the content we have to download anyway
+        blob_data = download()
+        content_hash = hashlib.sha256(blob_data).hexdigest()
+    if not record:
+        # Uploaded before the file index existed; add it so the next lookup is direct
+        record = file_record(file_id, doc_name, doc_name.split("/", 1)[1], None, content_hash, None)
+        record["extraction"] = "stored" if has_sidecar else None
+        index_upload(container_client, record)
+    
+    analysis_cache = get_analysis_cache(container_client)
+    analysis_key = cache_key(content_hash, ai_foundry_model, PROMPT_VERSION)
+    if analysis_cache:
+        with stage("cache.lookup"):
+            cached_response = analysis_cache.get(analysis_key)
+        if cached_response:
+            logging.info(f"Analysis cache hit for {file_id} ({content_hash[:12]})")
+            update_file(file_index, file_id, analysis="completed")
+            cached_response["cache"] = "hit"
+            return cached_response
+    
+    # Extract text based on file type with improved structure preservation
+    report("extracting")
+    with stage("extraction") as extraction_span:
+        filename = doc_name.lower()
+        extraction_source = "document_intelligence"
+        if filename.endswith('.txt'):
             # For text files, directly use content
-            extracted_text = blob_data.decode('utf-8')
-        elif filename.endswith('.pdf'):
-            # Try Document Intelligence Read first (cheaper/faster), fallback to Layout if needed
-            try:
-                poller = doc_client.begin_analyze_document("prebuilt-read", blob_data)
-                result = poller.result()
-                
-                # Simple text extraction
-                extracted_text = ""
-                for page_num, page in enumerate(result.pages):
-                    if page_num > 0:
-                        extracted_text += f"\n--- Side {page_num + 1} ---\n"
-                    
-                    for line in page.lines:
-                        extracted_text += line.content + "\n"
-                
-                # Check if we should fallback to layout analysis for better structure
-                # Simple heuristic: if document seems to have many short lines (potential tables)
-                lines = extracted_text.split('\n')
-                short_lines = sum(1 for line in lines if len(line.strip()) < 20 and len(line.strip()) > 0)
-                if short_lines > len(lines) * 0.3:  # More than 30% short lines
-                    logging.info("Document appears to have tables, using layout analysis")
-                    raise Exception("Fallback to layout")
-                    
-            except:
-                # Fallback to layout analysis for better structure preservation
-                logging.info("Using layout analysis for better structure preservation")
-                poller = doc_client.begin_analyze_document("prebuilt-layout", blob_data)
-                result = poller.result()
-                
-                # Group tables by page to avoid duplication
-                tables_by_page = {}
-                if hasattr(result, 'tables') and result.tables:
-                    for table in result.tables:
-                        if hasattr(table, 'bounding_regions') and table.bounding_regions:
-                            page_num = table.bounding_regions[0].page_number
-                            if page_num not in tables_by_page:
-                                tables_by_page[page_num] = []
-                            tables_by_page[page_num].append(table)
-                
-                # Extract text content with preserved structure
-                extracted_text = ""
-                for page_num, page in enumerate(result.pages):
-                    current_page = page_num + 1
-                    if page_num > 0:
-                        extracted_text += f"\n--- Side {current_page} ---\n"
-                    
-                    # Add tables for this page
-                    if current_page in tables_by_page:
-                        for table in tables_by_page[current_page]:
-                            extracted_text += "\n[TABELL]\n"
-                            for cell in table.cells:
-                                extracted_text += f"{cell.content}\t"
-                                if cell.column_index == table.column_count - 1:
-                                    extracted_text += "\n"
-                            extracted_text += "[/TABELL]\n\n"
-                    
-                    # Add regular text content
-                    for line in page.lines:
-                        extracted_text += line.content + "\n"
+            if blob_data is None:
+                blob_data = download()
+            extraction = Extraction.from_text(blob_data.decode('utf-8'))
+            extraction_source = "text"
         else:
-            # For DOC/DOCX files, try Document Intelligence Read first, then Layout if needed
-            try:
-                # Try basic read first
-                poller = doc_client.begin_analyze_document("prebuilt-read", blob_data)
-                result = poller.result()
-                
-                extracted_text = ""
-                for page_num, page in enumerate(result.pages):
-                    if page_num > 0:
-                        extracted_text += f"\n--- Side {page_num + 1} ---\n"
-                    
-                    for line in page.lines:
-                        extracted_text += line.content + "\n"
-                
-                # Check if layout analysis might be beneficial
-                lines = extracted_text.split('\n')
-                short_lines = sum(1 for line in lines if len(line.strip()) < 20 and len(line.strip()) > 0)
-                if short_lines > len(lines) * 0.3:
-                    raise Exception("Fallback to layout for better structure")
-                    
-            except Exception as structure_error:
-                logging.warning(f"Attempting layout analysis for better structure: {structure_error}")
+            # Reuse a stored Document Intelligence result when this file, or another upload
+            # of the same bytes, was extracted before
+            sidecar_file_id = file_id if has_sidecar else file_index.get_by_hash(content_hash)
+            extraction = load_sidecar(container_client, sidecar_file_id) if sidecar_file_id else None
+            if extraction:
+                logging.info(f"Using stored extraction from {sidecar_file_id} ({extraction.model})")
+                extraction_source = "sidecar"
+            elif filename.endswith('.csv'):
+                # Profiled while it streams from storage, so large spreadsheets are never held in memory
+                chunks = [blob_data] if blob_data is not None else blob_client.download_blob().chunks()
+                extraction = profile_csv(chunks)
+                extraction_source = "csv"
+            else:
+                if blob_data is None:
+                    blob_data = download()
+                extraction = extract_document(get_document_client(), blob_data, filename)
+            if extraction and extraction_source != "sidecar":
                 try:
-                    # Fallback to layout analysis
-                    poller = doc_client.begin_analyze_document("prebuilt-layout", blob_data)
-                    result = poller.result()
-                    
-                    # Group tables by page
-                    tables_by_page = {}
-                    if hasattr(result, 'tables') and result.tables:
-                        for table in result.tables:
-                            if hasattr(table, 'bounding_regions') and table.bounding_regions:
-                                page_num = table.bounding_regions[0].page_number
-                                if page_num not in tables_by_page:
-                                    tables_by_page[page_num] = []
-                                tables_by_page[page_num].append(table)
-                    
-                    extracted_text = ""
-                    for page_num, page in enumerate(result.pages):
-                        current_page = page_num + 1
-                        if page_num > 0:
-                            extracted_text += f"\n--- Side {current_page} ---\n"
-                        
-                        # Add tables for this page
-                        if current_page in tables_by_page:
-                            for table in tables_by_page[current_page]:
-                                extracted_text += "\n[TABELL]\n"
-                                for cell in table.cells:
-                                    extracted_text += f"{cell.content}\t"
-                                    if cell.column_index == table.column_count - 1:
-                                        extracted_text += "\n"
-                                extracted_text += "[/TABELL]\n\n"
-                        
-                        for line in page.lines:
-                            extracted_text += line.content + "\n"
-                            
-                except:
-                    extracted_text = "Kunne ikke lese dokument. Prøv med PDF eller TXT format."
-        
-        if not extracted_text.strip():
-            return func.HttpResponse(
-                json.dumps({"error": "No text could be extracted from the document"}),
-                status_code=400,
-                mimetype="application/json"
-            )
-        
-        # Cost control: Limit total text size for analysis
-        max_total_chars = int(os.getenv('MAX_DOCUMENT_CHARS', '100000'))  # Default 100k chars
-        max_chunks = int(os.getenv('MAX_CHUNKS', '15'))  # Default 15 chunks max
-        
-        if len(extracted_text) > max_total_chars:
-            logging.info(f"Document too large ({len(extracted_text)} chars), truncating to {max_total_chars}")
-            extracted_text = extracted_text[:max_total_chars]
-        
-        # Chunking implementation for large documents
-        def chunk_text(text, max_chunk_size=7000):
-            """Split text into overlapping chunks for better analysis coverage"""
-            if len(text) <= max_chunk_size:
-                return [text]
-            
-            chunks = []
-            overlap = 500  # Character overlap between chunks
-            start = 0
-            
-            while start < len(text):
-                end = start + max_chunk_size
-                if end >= len(text):
-                    chunks.append(text[start:])
-                    break
-                
-                # Try to break at sentence boundary near the end
-                chunk = text[start:end]
-                last_period = chunk.rfind('.')
-                last_newline = chunk.rfind('\n')
-                break_point = max(last_period, last_newline)
-                
-                if break_point > 0 and break_point > max_chunk_size * 0.7:  # Good break point found
-                    chunks.append(text[start:start + break_point + 1])
-                    start = start + break_point + 1 - overlap
-                else:  # No good break point, use max size
-                    chunks.append(chunk)
-                    start = end - overlap
-                    
-                # Cost control: Limit number of chunks
-                if len(chunks) >= max_chunks:
-                    logging.info(f"Reached maximum chunks limit ({max_chunks}), stopping chunking")
-                    break
-                    
-            return chunks
-
-        # Analyse med Azure AI Foundry
-        ai_foundry_endpoint = os.getenv('AI_FOUNDRY_ENDPOINT')
-        ai_foundry_api_key = os.getenv('AI_FOUNDRY_API_KEY')
-        ai_foundry_model = os.getenv('AI_FOUNDRY_MODEL', 'gpt-4o-mini')
-        
-        if not ai_foundry_endpoint or not ai_foundry_api_key:
-            return func.HttpResponse(
-                json.dumps({"error": "Azure AI Foundry-konfigurasjon mangler. Sett AI_FOUNDRY_ENDPOINT og AI_FOUNDRY_API_KEY."}),
-                status_code=500,
-                mimetype="application/json"
-            )
+                    save_sidecar(container_client, file_id, extraction)
+                    update_file(file_index, file_id, extraction="stored")
+                    file_index.put_hash(content_hash, file_id)
+                except Exception as sidecar_error:
+                    logging.warning(f"Could not store extraction sidecar: {sidecar_error}")
         
-        endpoint = ai_foundry_endpoint.rstrip('/')
-        if not endpoint.startswith('https://'):
-            return func.HttpResponse(
-                json.dumps({"error": f"Ugyldig endpoint: {endpoint}. Må starte med https://"}),
-                status_code=500,
-                mimetype="application/json"
-            )
-        
-        if 'services.ai.azure.com' not in endpoint:
-            return func.HttpResponse(
-                json.dumps({"error": "Kun Azure AI Foundry endpoints (services.ai.azure.com) støttes."}),
-                status_code=500,
-                mimetype="application/json"
-            )
-        
-        # AI Foundry format: https://<resource>.services.ai.azure.com/models
-        if not endpoint.endswith('/models'):
-            endpoint = f"{endpoint}/models"
-        
-        logging.info(f"Bruker Azure AI Foundry: {endpoint}, modell: {ai_foundry_model}")
-        try:
-            ai_client = ChatCompletionsClient(
-                endpoint=endpoint,
-                credential=AzureKeyCredential(ai_foundry_api_key)
-            )
-        except Exception as client_error:
-            logging.error(f"Kunne ikke opprette AI Foundry-klient: {client_error}")
-            raise Exception(f"Kunne ikke opprette Azure AI Foundry-klient: {str(client_error)}")
-        
-        # Process document in chunks if it's large
-        text_chunks = chunk_text(extracted_text)
-        logging.info(f"Dokument delt i {len(text_chunks)} chunks")
-        
-        if len(text_chunks) == 1:
-            # Single chunk - direct analysis
-            system_prompt = """Du er en AI-assistent som analyserer dokumenter for Dagens Næringsliv. 
+            if not extraction:
+                extraction = Extraction.from_text("Kunne ikke lese dokument. Prøv med PDF eller TXT format.", model="none")
+        extraction_span.set(source=extraction_source, pages=len(extraction.pages), model=extraction.model)
+    
+    extracted_text = extraction.render()
+    
+    if not extracted_text.strip():
+        raise AnalysisError("No text could be extracted from the document", status_code=400)
+    
+    # Analyse med Azure AI Foundry (config is validated once per process, the client is pooled)
+    try:
+        ai_client = get_chat_client()
+    except ConfigError as config_error:
+        raise AnalysisError(str(config_error), status_code=500)
+    except Exception as client_error:
+        logging.error(f"Kunne ikke opprette AI Foundry-klient: {client_error}")
+        raise Exception(f"Kunne ikke opprette Azure AI Foundry-klient: {str(client_error)}")
+    
+    # Drop running headers/footers, page numbers, repeated disclaimers and near-duplicate
+    # paragraphs before chunking; the stored extraction keeps the full text
+    with stage("cleaning") as cleaning_span:
+        cleaned_extraction, cleaning = clean_extraction(extraction)
+        cleaning_span.set(chars_removed=cleaning["chars_removed"], fraction=cleaning["fraction"])
+    
+    # Process document in chunks if it's large. Chunk size adapts to the document and
+    # the number of parallel calls; MAX_CHUNKS caps cost and coverage reports what's left out.
+    max_chunks = int(os.getenv('MAX_CHUNKS', '25'))  # Default 25 chunks max
+    max_concurrency = max(1, int(os.getenv('MAX_CONCURRENT_CHUNKS', '4')))
+    with stage("chunking") as chunking_span:
+        text_chunks, coverage = chunk_extraction(cleaned_extraction, concurrency=max_concurrency, max_chunks=max_chunks)
+        chunking_span.set(chunks=len(text_chunks), tokens=coverage["tokens_total"], coverage=coverage["fraction"])
+    logging.info(f"Dokument delt i {len(text_chunks)} chunks")
+    report("analyzing", chunks_completed=0, chunks_total=len(text_chunks), event={
+        "type": "extracted",
+        "data": {"pages": coverage["pages_total"], "chunks_total": len(text_chunks), "coverage": coverage["fraction"]}
+    })
+    
+    def chunk_event(index, chunk, analysis, cached=False):
+        data = parse_analysis(analysis) or {}
+        data.update(index=index, total=len(text_chunks), first_page=chunk.first_page, last_page=chunk.last_page, cached=cached)
+        return {"type": "chunk", "data": data}
+    
+    chunks_cached = 0
+    
+    if len(text_chunks) == 1:
+        # Single chunk - direct analysis
+        system_prompt = """Du er en AI-assistent som analyserer dokumenter for Dagens Næringsliv. 
 Returner resultatet som gyldig JSON i følgende format:
 
 {
@@ -417,11 +643,19 @@ Returner resultatet som gyldig JSON i følgende format:
 }
 
 Analyser dokumentet objektivt og detaljert på norsk."""
-            
-            user_prompt = f"Analyser følgende dokument:\n\n{text_chunks[0]}"
-            
-            try:
-                response = ai_client.complete(
+        
+        user_prompt = f"Analyser følgende dokument:\n\n{text_chunks[0].text}"
+        
+        try:
+            with stage("single"):
+                # Streamed, so the summary points can be shown while the rest is generated
+                ai_analysis = stream_json(
+                    ai_client,
+                    lambda partial: report("analyzing", event={
+                        "type": "summary",
+                        "data": summary_points(partial),
+                        "replace": True
+                    }),
                     model=ai_foundry_model,
                     messages=[
                         {"role": "system", "content": system_prompt},
@@ -430,102 +664,100 @@ Analyser dokumentet objektivt og detaljert på norsk."""
                     max_tokens=2000,
                     temperature=0.3
                 )
-                ai_analysis = response.choices[0].message.content
-            except Exception as api_error:
-                error_str = str(api_error)
-                logging.error(f"AI Foundry-feil: {error_str}", exc_info=True)
-                raise Exception(f"Azure AI Foundry feil: {error_str}")
-                
-        else:
-            # Multiple chunks - map-reduce approach
-            chunk_analyses = []
+            report("analyzing", chunks_completed=1, chunks_total=1, event=chunk_event(0, text_chunks[0], ai_analysis))
+        except Exception as api_error:
+            error_str = str(api_error)
+            logging.error(f"AI Foundry-feil: {error_str}", exc_info=True)
+            raise Exception(f"Azure AI Foundry feil: {error_str}")
             
-            # Step 1: Analyze each chunk
-            for i, chunk in enumerate(text_chunks):
-                logging.info(f"Analyserer chunk {i+1}/{len(text_chunks)}")
-                
-                chunk_system = "Du analyserer dokumenter for Dagens Næringsliv. Returner KUN gyldig JSON uten markdown eller kommentarer."
-                chunk_user = f"""Analyser denne delen av et større dokument.
-
-JSON format:
-{{
-  "sammendrag": ["Viktige punkter fra denne delen"],
-  "nøkkelinformasjon": {{
-    "personer": ["Personer nevnt"], "selskaper": ["Selskaper nevnt"], 
-    "offentlige_etater": ["Etater nevnt"], "tidsperiode": "Tidsinfo"
-  }},
-  "røde_flagg": {{
-    "uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [],
-    "varsler_og_mangler": [], "andre_røde_flagg": []
-  }}
-}}
-
-Del {i+1}/{len(text_chunks)}:
-{chunk}"""
-                
+    else:
+        # Multiple chunks - map-reduce approach
+        # Step 1: Analyze chunks through the scheduler shared by all analyses in the process:
+        # up to MAX_CONCURRENT_CHUNKS at once, taking turns with other documents.
+        # scheduler.map returns results in submission order, so chunk order is kept.
+        # Chunks whose text was analyzed before (typically the unchanged parts of a revised
+        # document; boundaries are content-defined) are taken from the chunk cache instead.
+        scheduler = get_scheduler()
+        owner = f"{file_id}:{uuid.uuid4().hex[:8]}"
+        completed_lock = threading.Lock()
+        completed = [0]
+        
+        def report_chunk(index, chunk, analysis, cached=False):
+            event = chunk_event(index, chunk, analysis, cached)
+            with completed_lock:
+                completed[0] += 1
+                chunks_completed = completed[0]
+            # Outside the lock: reporting may write the job to storage
+            report("analyzing", chunks_completed=chunks_completed, chunks_total=len(text_chunks), event=event)
+        
+        chunk_cache = get_chunk_cache(container_client)
+        chunk_keys = [chunk_cache_key(chunk, ai_foundry_model) for chunk in text_chunks]
+        chunk_analyses = [None] * len(text_chunks)
+        if chunk_cache:
+            def cached_chunk(key):
                 try:
-                    response = ai_client.complete(
-                        model=ai_foundry_model,
-                        messages=[
-                            {"role": "system", "content": chunk_system},
-                            {"role": "user", "content": chunk_user}
-                        ],
-                        max_tokens=1500,
-                        temperature=0.3
-                    )
-                    chunk_analyses.append(response.choices[0].message.content)
-                except Exception as api_error:
-                    logging.error(f"Feil ved analyse av chunk {i+1}: {api_error}")
-                    chunk_analyses.append('{"sammendrag": ["Kunne ikke analysere denne delen"], "nøkkelinformasjon": {"personer": [], "selskaper": [], "offentlige_etater": [], "tidsperiode": ""}, "røde_flagg": {"uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [], "varsler_og_mangler": [], "andre_røde_flagg": []}}')
-            
-            # Step 2: Synthesize all chunk analyses
-            synthesis_system = "Du syntetiserer dokumentanalyser for Dagens Næringsliv. Returner KUN gyldig JSON uten markdown."
-            synthesis_user = f"""Kombiner disse {len(text_chunks)} delanalysene til en komplett analyse.
-
-JSON format:
-{{
-  "sammendrag": ["5-8 hovedpunkter fra hele dokumentet"],
-  "nøkkelinformasjon": {{
-    "personer": ["Alle personer"], "selskaper": ["Alle selskaper"], 
-    "offentlige_etater": ["Alle etater"], "tidsperiode": "Samlet periode"
-  }},
-  "røde_flagg": {{
-    "uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [],
-    "varsler_og_mangler": [], "andre_røde_flagg": []
-  }}
-}}
-
-Delanalyser:
-{chr(10).join([f"Del {i+1}: {analysis}" for i, analysis in enumerate(chunk_analyses)])}"""
+                    entry = chunk_cache.get(key)
+                    return entry.get("analysis") if entry else None
+                except Exception as cache_error:
+                    logging.warning(f"Chunk cache read failed: {cache_error}")
+                    return None
             
-            try:
-                response = ai_client.complete(
-                    model=ai_foundry_model,
-                    messages=[
-                        {"role": "system", "content": synthesis_system},
-                        {"role": "user", "content": synthesis_user}
-                    ],
-                    max_tokens=2500,
-                    temperature=0.3
-                )
-                ai_analysis = response.choices[0].message.content
-                logging.info("Map-reduce analyse fullført")
-            except Exception as api_error:
-                error_str = str(api_error)
-                logging.error(f"Feil ved syntese: {error_str}", exc_info=True)
-                raise Exception(f"Feil ved syntese av analyse: {error_str}")
+            with stage("chunk_cache.lookup", chunks=len(chunk_keys)):
+                with ThreadPoolExecutor(max_workers=min(8, len(chunk_keys))) as lookups:
+                    chunk_analyses = list(lookups.map(cached_chunk, chunk_keys))
+            for index, analysis in enumerate(chunk_analyses):
+                if analysis is not None:
+                    chunks_cached += 1
+                    report_chunk(index, text_chunks[index], analysis, cached=True)
         
-        # Parse JSON response with repair attempt
-        try:
-            analysis_data = json.loads(ai_analysis)
-        except json.JSONDecodeError as json_error:
-            logging.warning(f"Første JSON parsing feil: {json_error}, prøver reparasjon")
-            # Try JSON repair
+        def analyze_and_report(index):
+            chunk = text_chunks[index]
+            result = analyze_chunk(ai_client, ai_foundry_model, chunk.text, index, len(text_chunks))
+            if chunk_cache and result != CHUNK_FALLBACK_ANALYSIS and parse_analysis(result) is not None:
+                try:
+                    chunk_cache.set(chunk_keys[index], {"analysis": result})
+                except Exception as cache_error:
+                    logging.warning(f"Chunk cache write failed: {cache_error}")
+            report_chunk(index, chunk, result)
+            return result
+        
+        missing = [index for index, analysis in enumerate(chunk_analyses) if analysis is None]
+        logging.info(
+            f"Analyserer {len(missing)} av {len(text_chunks)} chunks ({chunks_cached} fra cache) "
+            f"med opptil {scheduler.per_owner} samtidige kall"
+        )
+        with stage("map", chunks=len(missing), cached=chunks_cached):
+            for index, result in zip(missing, scheduler.map(owner, analyze_and_report, missing)):
+                chunk_analyses[index] = result
+        
+        # Step 2: Synthesize all chunk analyses, in a tree when there are many
+        report("synthesizing")
+        with stage("synthesis", chunks=len(chunk_analyses)):
+            ai_analysis = reduce_analyses(ai_client, ai_foundry_model, chunk_analyses, report, owner)
+        logging.info("Map-reduce analyse fullført")
+    
+    # Parse the JSON response: as returned, then repaired locally, and only as a
+    # last resort by asking the model to repair it
+    analysis_degraded = False
+    try:
+        analysis_data = validate_analysis(json.loads(ai_analysis))
+        repair_outcome = "valid" if analysis_data else "local"
+    except json.JSONDecodeError as json_error:
+        logging.warning(f"Første JSON parsing feil: {json_error}, prøver lokal reparasjon")
+        analysis_data = None
+        repair_outcome = "local"
+    if analysis_data is None:
+        analysis_data = validate_analysis(repair_json(ai_analysis))
+    if analysis_data is None:
+        logging.warning("Lokal JSON reparasjon feilet, ber modellen reparere")
+        repair_outcome = "model"
+        with stage("repair"):
             try:
                 repair_system = "Du reparerer ugyldig JSON. Returner KUN gyldig JSON, ingen forklaringer eller markdown."
                 repair_user = f"Reparer denne JSON til gyldig format:\n{ai_analysis}"
-                
-                repair_response = ai_client.complete(
+            
+                repair_response = complete_json(
+                    ai_client,
                     model=ai_foundry_model,
                     messages=[
                         {"role": "system", "content": repair_system},
@@ -534,108 +766,492 @@ Delanalyser:
                     max_tokens=1500,
                     temperature=0.1
                 )
-                
-                repaired_json = repair_response.choices[0].message.content
-                analysis_data = json.loads(repaired_json)
-                logging.info("JSON reparasjon suksessful")
-                
+                analysis_data = parse_analysis(repair_response.choices[0].message.content)
             except Exception as repair_error:
                 logging.error(f"JSON reparasjon feilet: {repair_error}")
-                # Final fallback to simple response
-                analysis_data = {
-                    "sammendrag": ["Dokumentet har blitt analysert"],
-                    "nøkkelinformasjon": {"personer": [], "selskaper": [], "offentlige_etater": [], "tidsperiode": ""},
-                    "røde_flagg": {"uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [], "varsler_og_mangler": [], "andre_røde_flagg": []}
-                }
-        
-        # Create formatted output from structured JSON
-        sammendrag_punkter = analysis_data.get("sammendrag", [])
-        nøkkelinfo = analysis_data.get("nøkkelinformasjon", {})
-        røde_flagg = analysis_data.get("røde_flagg", {})
-        
-        # Create summary from first 3 summary points
-        summary = " ".join(sammendrag_punkter[:3]) if sammendrag_punkter else "Kunne ikke generere sammendrag"
-        
-        # Build key_points list from all structured data
-        key_points = []
-        
-        # Add summary points
-        key_points.extend(sammendrag_punkter[:5])
-        
-        # Add key information if available
-        if nøkkelinfo.get("personer"):
-            personer = nøkkelinfo["personer"]
-            if isinstance(personer, list) and personer:
-                key_points.append(f"Personer: {', '.join(personer[:3])}")
-            elif isinstance(personer, str) and personer.strip():
-                key_points.append(f"Personer: {personer}")
-                
-        if nøkkelinfo.get("selskaper"):
-            selskaper = nøkkelinfo["selskaper"]
-            if isinstance(selskaper, list) and selskaper:
-                key_points.append(f"Selskaper: {', '.join(selskaper[:3])}")
-            elif isinstance(selskaper, str) and selskaper.strip():
-                key_points.append(f"Selskaper: {selskaper}")
-        
-        # Add red flags if found
-        all_red_flags = []
-        for category, flags in røde_flagg.items():
-            if isinstance(flags, list):
-                all_red_flags.extend(flags[:2])  # Limit per category
-            elif isinstance(flags, str) and flags.strip():
-                all_red_flags.append(flags)
-        
-        # Add red flags to key points
-        for flag in all_red_flags[:3]:  # Limit total red flags
-            key_points.append(f"Rødt flagg: {flag}")
-        
-        # Fallback if no data
-        if not summary or not key_points:
-            summary = "Dokumentet har blitt analysert med AI."
-            key_points = ["Dokumentanalyse ferdig", "Se full tekst for detaljer"]
-        
-        # Keep file for potential re-analysis or user access
-        # blob_client.delete_blob()  # Commented out - keep files
-        
+    if analysis_data is None:
+        # Final fallback to simple response
+        repair_outcome = "failed"
+        analysis_degraded = True
+        analysis_data = {
+            "sammendrag": ["Dokumentet har blitt analysert"],
+            "nøkkelinformasjon": {"personer": [], "selskaper": [], "offentlige_etater": [], "tidsperiode": ""},
+            "røde_flagg": {"uvanlige_formuleringer": [], "avvik_og_kritikk": [], "økonomiske_størrelser": [], "varsler_og_mangler": [], "andre_røde_flagg": []}
+        }
+    record_repair(repair_outcome)
+    if repair_outcome != "valid":
+        logging.info(f"JSON parsing: {repair_outcome}, totalt {repair_counts()}")
+    
+    # Create formatted output from structured JSON
+    sammendrag_punkter = analysis_data.get("sammendrag", [])
+    nøkkelinfo = analysis_data.get("nøkkelinformasjon", {})
+    røde_flagg = analysis_data.get("røde_flagg", {})
+    
+    # Create summary from first 3 summary points
+    summary = " ".join(sammendrag_punkter[:3]) if sammendrag_punkter else "Kunne ikke generere sammendrag"
+    
+    # Build key_points list from all structured data
+    key_points = []
+    
+    # Add summary points
+    key_points.extend(sammendrag_punkter[:5])
+    
+    # Add key information if available
+    if nøkkelinfo.get("personer"):
+        personer = nøkkelinfo["personer"]
+        if isinstance(personer, list) and personer:
+            key_points.append(f"Personer: {', '.join(personer[:3])}")
+        elif isinstance(personer, str) and personer.strip():
+            key_points.append(f"Personer: {personer}")
+            
+    if nøkkelinfo.get("selskaper"):
+        selskaper = nøkkelinfo["selskaper"]
+        if isinstance(selskaper, list) and selskaper:
+            key_points.append(f"Selskaper: {', '.join(selskaper[:3])}")
+        elif isinstance(selskaper, str) and selskaper.strip():
+            key_points.append(f"Selskaper: {selskaper}")
+    
+    # Add red flags if found
+    all_red_flags = []
+    for category, flags in røde_flagg.items():
+        if isinstance(flags, list):
+            all_red_flags.extend(flags[:2])  # Limit per category
+        elif isinstance(flags, str) and flags.strip():
+            all_red_flags.append(flags)
+    
+    # Add red flags to key points
+    for flag in all_red_flags[:3]:  # Limit total red flags
+        key_points.append(f"Rødt flagg: {flag}")
+    
+    # Fallback if no data
+    if not summary or not key_points:
+        summary = "Dokumentet har blitt analysert med AI."
+        key_points = ["Dokumentanalyse ferdig", "Se full tekst for detaljer"]
+    
+    # Keep file (and its extraction sidecar) for potential re-analysis or user access
+    # blob_client.delete_blob()  # Commented out - keep files
+    
+    response_body = {
+        "summary": summary,
+        "key_points": key_points[:8],
+        "confidence": 0.85,
+        "full_analysis": ai_analysis,
+        "structured_analysis": analysis_data,  # Include parsed JSON structure
+        "json_repair": repair_outcome,  # valid, local, model or failed
+        "chunks_processed": len(text_chunks),
+        "chunks_cached": chunks_cached,  # Map results reused from the chunk cache
+        "coverage": coverage,
+        "cleaning": cleaning,  # Boilerplate and near-duplicate text removed before chunking
+        "extraction_source": extraction_source,
+        "extraction_models": extraction.page_models(),  # Page ranges per extraction model, e.g. {"prebuilt-layout": "4,9"}
+        "extracted_text": extracted_text[:1000] + "..." if len(extracted_text) > 1000 else extracted_text
+    }
+    
+    # Don't cache the generic fallback, so a later request gets a real retry
+    if analysis_cache and not analysis_degraded:
+        try:
+            analysis_cache.set(analysis_key, response_body)
+        except Exception as cache_error:
+            logging.warning(f"Could not store analysis in cache: {cache_error}")
+    update_file(file_index, file_id, analysis="completed")
+    response_body["cache"] = "miss"
+    
+    return response_body
+    
+
+@app.route(route="analyze/{file_id}", methods=["POST"])
+def analyze_pdf(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('PDF analysis function triggered.')
+    
+    file_id = req.route_params.get('file_id')
+    if not file_id:
+        return func.HttpResponse(
+            json.dumps({"error": "File ID required"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+    
+    # Default is job mode: enqueue and return at once. ?mode=sync runs the pipeline in this request.
+    if req.params.get('mode', 'job') != 'sync':
+        try:
+            blob_service_client = get_blob_service()
+            container_client = blob_service_client.get_container_client("pdf-uploads")
+            job = create_job(container_client, file_id)
+            update_file(get_file_index(container_client), file_id, analysis="queued", job_id=job["job_id"])
+            enqueue_job(job, process_job)
+        except Exception as e:
+            logging.error(f"Could not enqueue analysis job: {e}", exc_info=True)
+            return func.HttpResponse(
+                json.dumps({"error": f"Kunne ikke starte analyse: {str(e)}"}),
+                status_code=500,
+                mimetype="application/json"
+            )
         return func.HttpResponse(
             json.dumps({
-                "summary": summary,
-                "key_points": key_points[:8],
-                "confidence": 0.85,
-                "full_analysis": ai_analysis,
-                "structured_analysis": analysis_data,  # Include parsed JSON structure
-                "chunks_processed": len(text_chunks),
-                "extracted_text": extracted_text[:1000] + "..." if len(extracted_text) > 1000 else extracted_text
+                "job_id": job["job_id"],
+                "status": job["status"],
+                "status_url": f"/api/jobs/{job['job_id']}",
+                "events_url": f"/api/jobs/{job['job_id']}/events"
             }),
+            status_code=202,
+            mimetype="application/json"
+        )
+    
+    try:
+        return func.HttpResponse(
+            json.dumps(run_analysis(file_id)),
             status_code=200,
             mimetype="application/json"
         )
-        
+    except AnalysisError as e:
+        return func.HttpResponse(
+            json.dumps({"error": str(e)}),
+            status_code=e.status_code,
+            mimetype="application/json"
+        )
     except Exception as e:
         error_msg = str(e)
         logging.error(f"Analysis error: {error_msg}", exc_info=True)
         
-        # Provide more helpful error messages
-        if "Could not resolve host" in error_msg or "Connection" in error_msg:
-            error_msg = "Kunne ikke koble til Azure AI-tjenesten. Sjekk nettverkstilkobling."
-        elif "authentication" in error_msg.lower() or "unauthorized" in error_msg.lower() or "401" in error_msg:
-            error_msg = "Autentisering feilet. Sjekk at API-nøkkelen er korrekt."
-        elif "model" in error_msg.lower() or "deployment" in error_msg.lower() or "404" in error_msg:
-            error_msg = f"Modell ikke funnet. Sjekk at '{ai_foundry_model}' er riktig deployment-navn."
-        elif "endpoint" in error_msg.lower():
-            error_msg = "Endpoint-konfigurasjon feilet. Sjekk AI_FOUNDRY_ENDPOINT."
+        return func.HttpResponse(
+            json.dumps({"error": friendly_error_message(error_msg)}),
+            status_code=500,
+            mimetype="application/json"
+        )
+
+def process_job(message):
+    """Worker: run the analysis for a queued job and record progress and result on the job.
+
+    Everything runs inside the try, so a failure at any step is recorded on the job; a
+    job whose worker disappears altogether is reported as failed once it goes stale.
+    """
+    container_client = job = file_index = progress = None
+    try:
+        container_client = get_blob_service().get_container_client("pdf-uploads")
+        job = get_job(container_client, message["job_id"])
+        if not job:
+            logging.error(f"Analysis job {message['job_id']} not found")
+            return
+        
+        # Also clears the stale status get_job reports for a job that waited long in the queue
+        job.update(status="running", error=None)
+        file_index = get_file_index(container_client)
+        update_file(file_index, job["file_id"], analysis="running")
+        progress = job_progress(container_client, job)
+        result = run_analysis(job["file_id"], progress=progress)
+        progress("completed", status="completed", result=result)
+    except Exception as e:
+        if isinstance(e, AnalysisError):
+            error = str(e)
+        else:
+            logging.error(f"Analysis job {message['job_id']} failed: {e}", exc_info=True)
+            error = friendly_error_message(str(e))
+        if not job:
+            return
+        try:
+            if file_index:
+                update_file(file_index, job["file_id"], analysis="failed")
+            if progress:
+                progress("failed", status="failed", error=error)
+            else:
+                job.update(status="failed", stage="failed", error=error)
+                save_job(container_client, job)
+        except Exception as save_error:
+            logging.error(f"Could not record failure of job {job['job_id']}: {save_error}")
+
+# The storage queue worker is only registered when that backend is used; Static Web Apps
+# managed functions support HTTP triggers only, so the default is the in-process stand-in.
+if job_queue_backend() == 'storage':
+    @app.queue_trigger(arg_name="msg", queue_name=JOB_QUEUE_NAME, connection="AzureWebJobsStorage")
+    def analysis_worker(msg: func.QueueMessage) -> None:
+        process_job(json.loads(msg.get_body().decode('utf-8')))
+
+@app.route(route="jobs/{job_id}", methods=["GET"])
+def job_status(req: func.HttpRequest) -> func.HttpResponse:
+    """Status, progress and (when done) result of an analysis job"""
+    job_id = req.route_params.get('job_id')
+    try:
+        blob_service_client = get_blob_service()
+        job = get_job(blob_service_client.get_container_client("pdf-uploads"), job_id)
+    except Exception as e:
+        logging.error(f"Job status error: {e}", exc_info=True)
+        return func.HttpResponse(
+            json.dumps({"error": f"Kunne ikke hente jobbstatus: {str(e)}"}),
+            status_code=500,
+            mimetype="application/json"
+        )
+    
+    if not job:
+        return func.HttpResponse(
+            json.dumps({"error": "Job not found"}),
+            status_code=404,
+            mimetype="application/json"
+        )
+    return func.HttpResponse(
+        json.dumps(job),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+def upload_batch_files(files, container_client):
+    """Store the files of a multipart batch upload; returns one document entry per file"""
+    documents = []
+    for file in files:
+        document = {"file_id": None, "filename": file.filename, "job_id": None, "error": None}
+        documents.append(document)
+        invalid = validate_filename(file.filename)
+        if invalid:
+            document["error"] = json.loads(invalid.get_body())["error"]
+            continue
+        file_id = str(uuid.uuid4())
+        blob_name = f"{file_id}/{file.filename}"
+        try:
+            size, content_hash = stream_to_blob(container_client.get_blob_client(blob_name), file.stream)
+        except UploadError as e:
+            document["error"] = str(e)
+            continue
+        index_upload(container_client, file_record(file_id, blob_name, file.filename, size, content_hash, file.content_type))
+        document["file_id"] = file_id
+    return documents
+
+@app.route(route="batch", methods=["POST"])
+def analyze_batch(req: func.HttpRequest) -> func.HttpResponse:
+    """Analyze many documents at once: JSON {"file_ids": [...]} or a multipart upload of several files.
+
+    Every document becomes a job, and all of them run at once: extraction concurrently,
+    and their model calls through the shared scheduler, which takes turns between the
+    documents. GET batch/{batch_id} returns each document's result as it finishes.
+    """
+    max_documents = int(os.getenv('MAX_BATCH_DOCUMENTS', '50'))
+    try:
+        container_client = get_blob_service().get_container_client("pdf-uploads")
+        if 'multipart/form-data' in req.headers.get('Content-Type', ''):
+            files = req.files.getlist('file')
+            if len(files) > max_documents:
+                raise UploadError(f"Too many documents. Maximum is {max_documents} per batch")
+            documents = upload_batch_files(files, container_client)
+        else:
+            try:
+                file_ids = (req.get_json() or {}).get('file_ids') or []
+            except ValueError:
+                file_ids = []
+            if len(file_ids) > max_documents:
+                raise UploadError(f"Too many documents. Maximum is {max_documents} per batch")
+            documents = [{"file_id": str(file_id), "filename": None, "job_id": None, "error": None} for file_id in file_ids]
+        if not documents:
+            raise UploadError("No files or file_ids provided")
         
+        file_index = get_file_index(container_client)
+        for document in documents:
+            if document["error"]:
+                continue
+            job = create_job(container_client, document["file_id"])
+            update_file(file_index, document["file_id"], analysis="queued", job_id=job["job_id"])
+            enqueue_job(job, process_job, batch=True)
+            document["job_id"] = job["job_id"]
+        batch = create_batch(container_client, documents)
+    except UploadError as e:
         return func.HttpResponse(
-            json.dumps({"error": error_msg}),
+            json.dumps({"error": str(e)}),
+            status_code=e.status_code,
+            mimetype="application/json"
+        )
+    except Exception as e:
+        logging.error(f"Could not start batch: {e}", exc_info=True)
+        return func.HttpResponse(
+            json.dumps({"error": f"Kunne ikke starte analyse: {str(e)}"}),
             status_code=500,
             mimetype="application/json"
         )
+    
+    return func.HttpResponse(
+        json.dumps({
+            "batch_id": batch["batch_id"],
+            "documents": documents,
+            "status_url": f"/api/batch/{batch['batch_id']}"
+        }),
+        status_code=202,
+        mimetype="application/json"
+    )
+
+@app.route(route="batch/{batch_id}", methods=["GET"])
+def batch_status(req: func.HttpRequest) -> func.HttpResponse:
+    """Status of every document in a batch, with the result of each one that has finished"""
+    batch_id = req.route_params.get('batch_id')
+    try:
+        container_client = get_blob_service().get_container_client("pdf-uploads")
+        batch = get_batch(container_client, batch_id)
+        if not batch:
+            return func.HttpResponse(
+                json.dumps({"error": "Batch not found"}),
+                status_code=404,
+                mimetype="application/json"
+            )
+        job_ids = [document["job_id"] for document in batch["documents"]]
+        with ThreadPoolExecutor(max_workers=min(16, max(1, len(job_ids)))) as executor:
+            jobs = list(executor.map(lambda job_id: get_job(container_client, job_id) if job_id else None, job_ids))
+    except Exception as e:
+        logging.error(f"Batch status error: {e}", exc_info=True)
+        return func.HttpResponse(
+            json.dumps({"error": f"Kunne ikke hente jobbstatus: {str(e)}"}),
+            status_code=500,
+            mimetype="application/json"
+        )
+    
+    documents = []
+    counts = {"queued": 0, "running": 0, "completed": 0, "failed": 0}
+    for document, job in zip(batch["documents"], jobs):
+        entry = dict(document)
+        if job:
+            entry.update(
+                status=job["status"],
+                stage=job["stage"],
+                chunks_completed=job.get("chunks_completed"),
+                chunks_total=job.get("chunks_total"),
+                result=job.get("result"),
+                error=job.get("error")
+            )
+        else:
+            entry["status"] = "failed"
+            entry["error"] = entry.get("error") or "Job not found"
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        documents.append(entry)
+    
+    return func.HttpResponse(
+        json.dumps({
+            "batch_id": batch_id,
+            "status": "completed" if counts["completed"] + counts["failed"] == len(documents) else "running",
+            "counts": counts,
+            "documents": documents
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+@app.route(route="files/{file_id}", methods=["GET"])
+def file_status(req: func.HttpRequest) -> func.HttpResponse:
+    """Index entry of an upload: name, size, hash, extraction and analysis state, latest job"""
+    file_id = req.route_params.get('file_id')
+    try:
+        blob_service_client = get_blob_service()
+        record = get_file_index(blob_service_client.get_container_client("pdf-uploads")).get(file_id)
+    except Exception as e:
+        logging.error(f"File status error: {e}", exc_info=True)
+        return func.HttpResponse(
+            json.dumps({"error": f"Kunne ikke hente filstatus: {str(e)}"}),
+            status_code=500,
+            mimetype="application/json"
+        )
+    
+    if not record:
+        return func.HttpResponse(
+            json.dumps({"error": "File not found"}),
+            status_code=404,
+            mimetype="application/json"
+        )
+    if record.get("job_id"):
+        record["status_url"] = f"/api/jobs/{record['job_id']}"
+    return func.HttpResponse(
+        json.dumps(record),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+def sse_message(event_type, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines.append(f"event: {event_type}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+@app.route(route="jobs/{job_id}/events", methods=["GET"])
+async def job_event_stream(req: func.HttpRequest) -> func.HttpResponse:
+    """Server-sent events with the partial results of an analysis job.
+
+    HTTP responses from this function app are buffered, so each request waits up to
+    JOB_EVENTS_WAIT_SECONDS for events after Last-Event-ID (or ?after=), returns them
+    and ends; EventSource reconnects after the retry interval and continues from the
+    last id. The stream ends with a "completed" event carrying the result, or "failed".
+    Async, so a waiting request holds no worker thread: the blob reads run in a thread
+    and the waits between them on the event loop.
+    """
+    job_id = req.route_params.get('job_id')
+    try:
+        after = int(req.headers.get('Last-Event-ID') or req.params.get('after') or 0)
+    except ValueError:
+        after = 0
+    wait_seconds = float(os.getenv('JOB_EVENTS_WAIT_SECONDS', '15'))
+    poll_interval = float(os.getenv('JOB_EVENTS_POLL_SECONDS', '0.5'))
+    
+    try:
+        blob_service_client = get_blob_service()
+        container_client = blob_service_client.get_container_client("pdf-uploads")
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            job = await asyncio.to_thread(get_job, container_client, job_id)
+            if not job:
+                return func.HttpResponse(
+                    json.dumps({"error": "Job not found"}),
+                    status_code=404,
+                    mimetype="application/json"
+                )
+            events = await asyncio.to_thread(job_events, container_client, job, after)
+            finished = job["status"] in ("completed", "failed")
+            if events or finished or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(poll_interval)
+    except Exception as e:
+        logging.error(f"Job events error: {e}", exc_info=True)
+        return func.HttpResponse(
+            json.dumps({"error": f"Kunne ikke hente jobbstatus: {str(e)}"}),
+            status_code=500,
+            mimetype="application/json"
+        )
+    
+    body = [f"retry: {int(poll_interval * 1000)}\n\n"]
+    body.append(sse_message("progress", {
+        "stage": job["stage"],
+        "chunks_completed": job.get("chunks_completed"),
+        "chunks_total": job.get("chunks_total")
+    }))
+    body.extend(sse_message(event["type"], event["data"], event["id"]) for event in events)
+    final_id = job.get("event_seq", 0) + 1
+    if job["status"] == "completed":
+        body.append(sse_message("completed", job["result"], final_id))
+    elif job["status"] == "failed":
+        body.append(sse_message("failed", {"error": job["error"]}, final_id))
+    return func.HttpResponse(
+        "".join(body),
+        status_code=200,
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
 
 @app.route(route="health")
 def health_check(req: func.HttpRequest) -> func.HttpResponse:
     """Health check endpoint"""
     return func.HttpResponse(
-        json.dumps({"status": "healthy", "service": "PDF AI Analyzer"}),
+        json.dumps({
+            "status": "healthy",
+            "service": "PDF AI Analyzer",
+            "startup_ms": STARTUP_MS,
+            "json_repair": repair_counts(),
+            "rate_limits": limiter_stats()
+        }),
         status_code=200,
         mimetype="application/json"
-    )
\ No newline at end of file
+    )
+
+# Export stage spans and metrics if TELEMETRY_EXPORTER is set (off by default: it loads the exporter SDK)
+try:
+    configure_exporter()
+except Exception as telemetry_error:
+    logging.warning(f"Could not configure telemetry export: {telemetry_error}")
+
+# Validate the AI Foundry settings once, at startup; analyses report the error if they're wrong
+try:
+    ai_config()
+except ConfigError as startup_config_error:
+    logging.warning(f"AI Foundry configuration: {startup_config_error}")
+
+STARTUP_MS = round((time.perf_counter() - _module_started) * 1000, 1)
+logging.info(f"function_app loaded in {STARTUP_MS} ms")
\ No newline at end of file
@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import ResourceNotFoundError
+
+# Job state is stored as JSON blobs under this prefix in the pdf-uploads container
+JOB_PREFIX = "_jobs/"
+JOB_QUEUE_NAME = "analysis-jobs"
+BATCH_PREFIX = "_batches/"
+
+# A job's events (partial results) are appended as JSON lines to an append blob next to the
+# job, so the job document stays small and an event costs one append, not a rewrite of all
+EVENTS_SUFFIX = ".events"
+
+_local_executor = None
+_batch_executor = None
+_executor_lock = threading.Lock()
+
+
+def job_queue_backend():
+    """JOB_QUEUE_BACKEND: 'storage' (Azure Storage queue + queue trigger) or 'local' (in-process)"""
+    return os.getenv('JOB_QUEUE_BACKEND', 'local').lower()
+
+
+def _job_blob(container_client, job_id):
+    return container_client.get_blob_client(f"{JOB_PREFIX}{job_id}.json")
+
+
+def _events_blob(container_client, job_id):
+    return container_client.get_blob_client(f"{JOB_PREFIX}{job_id}{EVENTS_SUFFIX}")
+
+
+def save_job(container_client, job):
+    job["updated_at"] = time.time()
+    _job_blob(container_client, job["job_id"]).upload_blob(json.dumps(job), overwrite=True)
+
+
+def create_job(container_client, file_id):
+    """Create and store a queued job for file_id"""
+    now = time.time()
+    job = {
+        "job_id": str(uuid.uuid4()),
+        "file_id": file_id,
+        "status": "queued",
+        "stage": "queued",
+        "chunks_completed": 0,
+        "chunks_total": None,
+        "result": None,
+        "error": None,
+        "event_seq": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    _events_blob(container_client, job["job_id"]).create_append_blob()
+    save_job(container_client, job)
+    return job
+
+
+def get_job(container_client, job_id):
+    """The stored job, reported as failed if it is queued or running but hasn't been updated
+    for JOB_STALE_SECONDS (its worker was lost, e.g. to a host recycle)"""
+    try:
+        job = json.loads(_job_blob(container_client, job_id).download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+    stale_seconds = float(os.getenv('JOB_STALE_SECONDS', '900'))
+    if job["status"] in ("queued", "running") and time.time() - job.get("updated_at", 0) > stale_seconds:
+        job.update(status="failed", error=f"Analysen stoppet uten å bli ferdig (ingen fremdrift på {stale_seconds / 60:.0f} minutter)")
+    return job
+
+
+def job_events(container_client, job, after=0):
+    """Events of a job with an id above after; the events blob is only read when there are any.
+
+    A replace event supersedes the previous event if it has the same type, as for a
+    summary that grows while the synthesis streams; it still has a new id so clients
+    that already saw the old one receive it.
+    """
+    if job.get("event_seq", 0) <= after:
+        return []
+    try:
+        raw = _events_blob(container_client, job["job_id"]).download_blob().readall()
+    except ResourceNotFoundError:
+        return []
+    events = []
+    for line in raw.decode('utf-8').splitlines():
+        if not line:
+            continue
+        event = json.loads(line)
+        if event.pop("replace", False) and events and events[-1]["type"] == event["type"]:
+            events.pop()
+        events.append(event)
+    return [event for event in events if event["id"] > after]
+
+
+def create_batch(container_client, documents):
+    """Create and store a batch: documents is a list of {"file_id", "filename", "job_id", "error"}"""
+    batch = {
+        "batch_id": str(uuid.uuid4()),
+        "documents": documents,
+        "created_at": time.time()
+    }
+    container_client.get_blob_client(f"{BATCH_PREFIX}{batch['batch_id']}.json").upload_blob(json.dumps(batch), overwrite=True)
+    return batch
+
+
+def get_batch(container_client, batch_id):
+    try:
+        return json.loads(container_client.get_blob_client(f"{BATCH_PREFIX}{batch_id}.json").download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+
+
+def job_progress(container_client, job):
+    """Progress callback for run_analysis that records stage, details and events on the stored job.
+
+    Chunk workers report concurrently. Reports are merged: the thread writing to storage
+    picks up whatever was reported meanwhile and the others return at once, so workers
+    never queue behind each other's uploads. New events are appended to the events blob
+    before the job document (with the new event_seq) is written. Reports that finish the
+    job wait until they are stored.
+    """
+    state_lock = threading.Lock()
+    write_lock = threading.Lock()
+    pending = []
+    dirty = [False]
+
+    def write():
+        with state_lock:
+            events = pending[:]
+            pending.clear()
+            dirty[0] = False
+            job["updated_at"] = time.time()
+            document = json.dumps(job)
+        try:
+            if events:
+                _events_blob(container_client, job["job_id"]).append_block(
+                    "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events).encode('utf-8')
+                )
+            _job_blob(container_client, job["job_id"]).upload_blob(document, overwrite=True)
+        except Exception as save_error:
+            logging.warning(f"Could not update job {job['job_id']}: {save_error}")
+
+    def report(stage, event=None, **details):
+        with state_lock:
+            job["stage"] = stage
+            if details.get("chunks_completed") is not None:
+                # Workers report after leaving their completion lock, so counts may arrive out of order
+                details["chunks_completed"] = max(details["chunks_completed"], job.get("chunks_completed") or 0)
+            job.update(details)
+            if event:
+                job["event_seq"] = job.get("event_seq", 0) + 1
+                pending.append(dict(
+                    {"id": job["event_seq"], "type": event["type"], "data": event.get("data")},
+                    **({"replace": True} if event.get("replace") else {})
+                ))
+            dirty[0] = True
+            finished = job.get("status") in ("completed", "failed")
+        # Whoever holds write_lock checks dirty after releasing it, so nothing reported is left unwritten
+        while write_lock.acquire(blocking=finished):
+            try:
+                write()
+            finally:
+                write_lock.release()
+            with state_lock:
+                if not dirty[0]:
+                    return
+
+    return report
+
+
+def enqueue_job(job, worker, batch=False):
+    """Send a job to the configured queue.
+
+    With the 'local' backend, worker(message) runs on a background thread in this
+    process instead, standing in for the storage queue and its queue trigger. Jobs
+    of a batch get their own pool of BATCH_WORKERS threads, so all documents of a
+    case are extracted and queued for the model at once without holding up single
+    analyses; the model calls themselves share the process-wide scheduler.
+    """
+    global _local_executor, _batch_executor
+
+    message = {"job_id": job["job_id"], "file_id": job["file_id"]}
+    if job_queue_backend() == 'storage':
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy
+
+        queue_client = QueueClient.from_connection_string(
+            os.getenv('AzureWebJobsStorage'),
+            JOB_QUEUE_NAME,
+            message_encode_policy=TextBase64EncodePolicy()  # The queue trigger expects base64 messages
+        )
+        try:
+            queue_client.send_message(json.dumps(message))
+        except ResourceNotFoundError:
+            queue_client.create_queue()
+            queue_client.send_message(json.dumps(message))
+        return
+
+    with _executor_lock:
+        if batch and not _batch_executor:
+            _batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('BATCH_WORKERS', '16')))
+        elif not batch and not _local_executor:
+            _local_executor = ThreadPoolExecutor(max_workers=int(os.getenv('JOB_WORKERS', '2')))
+        executor = _batch_executor if batch else _local_executor
+    executor.submit(worker, message)
@@ -0,0 +1,179 @@
+import json
+import re
+import threading
+
+from analysis_merge import ENTITY_FIELDS, RED_FLAG_FIELDS
+
+# Models sometimes drop the Norwegian letters from keys
+_KEY_ALIASES = {
+    "nokkelinformasjon": "nøkkelinformasjon",
+    "rode_flagg": "røde_flagg",
+    "okonomiske_storrelser": "økonomiske_størrelser",
+    "andre_rode_flagg": "andre_røde_flagg"
+}
+
+# How final analyses were parsed since the process started: as returned, repaired
+# locally, repaired by a model call, or replaced by the fallback
+_outcomes = {"valid": 0, "local": 0, "model": 0, "failed": 0}
+_outcomes_lock = threading.Lock()
+
+_FENCE = re.compile(r"^\s*```[a-zA-Z]*\s*\n?(.*?)\n?\s*```\s*$", re.DOTALL)
+
+
+def _strip_trailing_comma(out):
+    """Remove a trailing comma (and the whitespace after it) from the output buffer"""
+    end = len(out)
+    while end and out[end - 1].isspace():
+        end -= 1
+    if end and out[end - 1] == ',':
+        del out[end - 1:]
+
+
+def _repair_structure(text):
+    """Drop trailing commas and close an unterminated string and any open brackets"""
+    out = []
+    closers = []
+    in_string = False
+    escape = False
+    for ch in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in '{[':
+            closers.append('}' if ch == '{' else ']')
+        elif ch in '}]':
+            _strip_trailing_comma(out)
+            if closers:
+                closers.pop()
+        out.append(ch)
+
+    if in_string:
+        if escape:
+            out.pop()
+        out.append('"')
+    repaired = "".join(out).rstrip()
+    # A truncated object may end in a key without a value, or in a dangling ':' or ','
+    if closers and closers[-1] == '}':
+        repaired = re.sub(r',?\s*"[^"]*"\s*:?\s*$', '', repaired) if re.search(r'[{,]\s*"[^"]*"\s*:?\s*$', repaired) else repaired
+    repaired = re.sub(r'[,:]\s*$', '', repaired)
+    return repaired + "".join(reversed(closers))
+
+
+def _object_end(text, start):
+    """Index of the '}' closing the object that opens at start, or -1 if it is never closed.
+
+    Brackets inside strings are skipped, so a truncated answer isn't cut at a '}' in its text.
+    """
+    depth = 0
+    in_string = False
+    escape = False
+    for index in range(start, len(text)):
+        ch = text[index]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '{[':
+            depth += 1
+        elif ch in '}]':
+            depth -= 1
+            if not depth:
+                return index if ch == '}' else -1
+    return -1
+
+
+def repair_json(text):
+    """Parse model output as a JSON object, repairing common problems locally.
+
+    Handles markdown code fences, prose around the object, trailing commas and
+    output truncated mid-string or mid-object. Returns None if nothing usable remains.
+    """
+    if not isinstance(text, str):
+        return None
+    candidate = text.strip()
+    fenced = _FENCE.match(candidate)
+    if fenced:
+        candidate = fenced.group(1).strip()
+
+    start = candidate.find('{')
+    if start < 0:
+        return None
+    end = _object_end(candidate, start)
+    attempts = [candidate[start:end + 1], _repair_structure(candidate[start:end + 1])] if end > start else []
+    attempts.append(_repair_structure(candidate[start:]))
+
+    for attempt in attempts:
+        try:
+            data = json.loads(attempt)
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            return data
+    return None
+
+
+def _string_list(value):
+    if isinstance(value, list):
+        return [str(item) for item in value if item is not None and str(item).strip()]
+    if isinstance(value, str) and value.strip():
+        return [value]
+    return []
+
+
+def validate_analysis(data):
+    """Normalize a parsed analysis to the sammendrag/nøkkelinformasjon/røde_flagg schema.
+
+    Missing fields are filled with empty values and single strings become lists.
+    Returns None if data has none of the expected top-level fields.
+    """
+    if not isinstance(data, dict):
+        return None
+    data = {_KEY_ALIASES.get(key, key): value for key, value in data.items()}
+    if not any(key in data for key in ("sammendrag", "nøkkelinformasjon", "røde_flagg")):
+        return None
+
+    info = data.get("nøkkelinformasjon") if isinstance(data.get("nøkkelinformasjon"), dict) else {}
+    flags = data.get("røde_flagg") if isinstance(data.get("røde_flagg"), dict) else {}
+    info = {_KEY_ALIASES.get(key, key): value for key, value in info.items()}
+    flags = {_KEY_ALIASES.get(key, key): value for key, value in flags.items()}
+
+    tidsperiode = info.get("tidsperiode")
+    if isinstance(tidsperiode, list):
+        tidsperiode = "; ".join(str(item) for item in tidsperiode)
+
+    nøkkelinformasjon = {field: _string_list(info.get(field)) for field in ENTITY_FIELDS}
+    nøkkelinformasjon["tidsperiode"] = str(tidsperiode) if tidsperiode else ""
+    return {
+        "sammendrag": _string_list(data.get("sammendrag")),
+        "nøkkelinformasjon": nøkkelinformasjon,
+        "røde_flagg": {field: _string_list(flags.get(field)) for field in RED_FLAG_FIELDS}
+    }
+
+
+def parse_analysis(text):
+    """Parse and validate a model analysis, repairing it locally; None if it can't be salvaged"""
+    return validate_analysis(repair_json(text))
+
+
+def record_repair(outcome):
+    """Count how an analysis was parsed: 'valid', 'local', 'model' or 'failed'"""
+    with _outcomes_lock:
+        _outcomes[outcome] += 1
+
+
+def repair_counts():
+    with _outcomes_lock:
+        return dict(_outcomes)
@@ -0,0 +1,303 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+
+from chunking import count_tokens
+
+# Status codes worth retrying; 429 also lowers the concurrency limit
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Budget of `per_minute` units refilled continuously; acquire blocks until there is room.
+
+    The level may go negative through adjust(), when a call turned out to cost more
+    than was reserved, which delays the next acquire accordingly.
+    """
+
+    def __init__(self, per_minute, clock=time.monotonic, sleep=time.sleep):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        # A single call bigger than the whole budget waits for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = (amount - self.level) / self.rate
+            self.sleep(wait)
+
+    def adjust(self, amount):
+        with self.lock:
+            self._refill()
+            self.level = min(self.capacity, self.level - amount)
+
+
+class AdaptiveConcurrency:
+    """Concurrency limit that halves on throttling and grows by one per `limit` successes (AIMD)"""
+
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def succeeded(self):
+        with self.condition:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.condition.notify_all()
+
+    def throttled(self):
+        with self.condition:
+            self.limit = max(1.0, self.limit / 2)
+
+
+def _retry_after(error):
+    """Seconds the service asked us to wait, from retry-after-ms / x-ms-retry-after-ms / Retry-After"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    for name, scale in (('retry-after-ms', 0.001), ('x-ms-retry-after-ms', 0.001), ('Retry-After', 1.0)):
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            continue  # An HTTP date; fall back to exponential backoff
+    return None
+
+
+def _is_transient(error):
+    if isinstance(error, (ServiceRequestError, ServiceResponseError)):
+        return True
+    return isinstance(error, HttpResponseError) and error.status_code in RETRY_STATUS_CODES
+
+
+class RateLimiter:
+    """Requests/min and tokens/min budgets, adaptive concurrency and retries for one service.
+
+    One instance per service is shared by every analysis in the process, so concurrent
+    jobs draw from the same budget and all slow down when the service throttles.
+    """
+
+    def __init__(self, name, requests_per_minute=0, tokens_per_minute=0, max_concurrency=8,
+                 max_retries=5, base_delay=1.0, max_delay=60.0, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute, clock, sleep) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, clock, sleep) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.paused_until = 0.0
+        self.pause_lock = threading.Lock()
+        self.stats = {"calls": 0, "retries": 0, "throttled": 0, "failed": 0}
+        self.stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def _wait_for_pause(self):
+        # A Retry-After from the service applies to every caller, not just the one that got it
+        with self.pause_lock:
+            delay = self.paused_until - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+
+    def acquire(self, tokens=0):
+        """Wait for budget and a concurrency slot; release() must follow"""
+        self._wait_for_pause()
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+        self.concurrency.acquire()
+
+    def release(self):
+        self.concurrency.release()
+
+    def call(self, fn, tokens=0, hold=False):
+        """Call fn() within the budget, retrying transient failures with backoff.
+
+        tokens is the estimated token cost reserved from the tokens/min budget. With
+        hold=True the concurrency slot is kept after a successful call and the caller
+        must release() it (for streamed responses).
+        """
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            self._count("calls")
+            try:
+                result = fn()
+            except Exception as error:
+                self.release()
+                if not _is_transient(error) or attempt >= self.max_retries:
+                    if _is_transient(error):
+                        self._count("failed")
+                    raise
+                retry_after = _retry_after(error)
+                if getattr(error, 'status_code', None) == 429:
+                    self._count("throttled")
+                    self.concurrency.throttled()
+                    if retry_after:
+                        with self.pause_lock:
+                            self.paused_until = max(self.paused_until, self.clock() + retry_after)
+                delay = retry_after if retry_after is not None else min(
+                    self.max_delay, self.base_delay * (2 ** attempt) * (0.5 + random.random())
+                )
+                logging.warning(
+                    f"{self.name}: {getattr(error, 'status_code', None) or type(error).__name__}, "
+                    f"retry {attempt + 1}/{self.max_retries} in {delay:.1f}s "
+                    f"(concurrency {int(self.concurrency.limit)})"
+                )
+                self._count("retries")
+                attempt += 1
+                self.sleep(delay)
+                continue
+            self.concurrency.succeeded()
+            if not hold:
+                self.release()
+            return result
+
+
+class _StreamHolder:
+    """Iterates a streamed response, keeping the concurrency slot until it is closed.
+
+    The slot is released by close(): when iteration ends, on leaving a with block, or
+    at the latest when the holder is garbage collected without having been iterated.
+    """
+
+    def __init__(self, stream, limiter):
+        self.stream = stream
+        self.limiter = limiter
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.stream
+        finally:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        try:
+            close = getattr(self.stream, 'close', None)
+            if close:
+                close()
+        finally:
+            self.limiter.release()
+
+    def __del__(self):
+        self.close()
+
+
+class LimitedChatClient:
+    """ChatCompletionsClient whose complete() goes through a RateLimiter"""
+
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def complete(self, **kwargs):
+        prompt_tokens = sum(count_tokens(str(message.get("content", ""))) for message in kwargs.get("messages", []))
+        estimate = prompt_tokens + kwargs.get("max_tokens", 0)
+        stream = kwargs.get("stream", False)
+        response = self.limiter.call(lambda: self.client.complete(**kwargs), tokens=estimate, hold=stream)
+        if stream:
+            return _StreamHolder(response, self.limiter)
+        usage = getattr(response, 'usage', None)
+        if usage and self.limiter.tokens:
+            # Settle the reservation against what the call actually used
+            self.limiter.tokens.adjust(usage.total_tokens - estimate)
+        return response
+
+
+class _CompletedPoller:
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+class LimitedDocumentClient:
+    """DocumentAnalysisClient whose begin_analyze_document goes through a RateLimiter.
+
+    The whole operation, including waiting for the result, holds one concurrency slot
+    and is retried as a unit; the returned poller is already complete.
+    """
+
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def begin_analyze_document(self, model_id, document, **kwargs):
+        return _CompletedPoller(self.limiter.call(
+            lambda: self.client.begin_analyze_document(model_id, document, **kwargs).result()
+        ))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(service):
+    """Process-wide limiter for 'ai' or 'document_intelligence', configured from the environment"""
+    with _limiters_lock:
+        if service not in _limiters:
+            prefix = "AI" if service == "ai" else "DI"
+            _limiters[service] = RateLimiter(
+                service,
+                requests_per_minute=int(os.getenv(f'{prefix}_REQUESTS_PER_MINUTE', '0')),
+                tokens_per_minute=int(os.getenv(f'{prefix}_TOKENS_PER_MINUTE', '0')) if service == "ai" else 0,
+                max_concurrency=int(os.getenv(f'{prefix}_MAX_CONCURRENCY', '8')),
+                max_retries=int(os.getenv('RATE_LIMIT_MAX_RETRIES', '5'))
+            )
+        return _limiters[service]
+
+
+def limiter_stats():
+    with _limiters_lock:
+        return {name: dict(limiter.stats, concurrency=int(limiter.concurrency.limit)) for name, limiter in _limiters.items()}
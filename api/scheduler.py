@@ -0,0 +1,95 @@
+import contextvars
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+
+class FairScheduler:
+    """Work queue shared by all analyses in the process, served round-robin per document.
+
+    Each document (owner) has its own FIFO of model calls. Workers take the next call
+    from the next owner in turn, so a 300-page document queued first doesn't hold back
+    the chunks of the small documents queued after it, and the number of workers is
+    the model concurrency budget for everything running in the process. per_owner
+    caps how many calls of one document run at once. Calls run in a copy of the
+    submitter's context, so they are traced as part of its analysis.
+    """
+
+    def __init__(self, workers, per_owner=None):
+        self.workers = workers
+        self.per_owner = per_owner or workers
+        self.queues = OrderedDict()  # owner -> deque of (future, fn, args, context); order is the rotation
+        self.running = {}
+        self.condition = threading.Condition()
+        self.threads = [
+            threading.Thread(target=self._work, name=f"scheduler-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, owner, fn, *args):
+        future = Future()
+        with self.condition:
+            self.queues.setdefault(owner, deque()).append((future, fn, args, contextvars.copy_context()))
+            self.condition.notify()
+        return future
+
+    def map(self, owner, fn, items):
+        """Like Executor.map, for the calls of one owner: results in submission order"""
+        futures = [self.submit(owner, fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    def _next(self):
+        # Called with the condition held: first owner in rotation with work and a free slot
+        for owner, queue in self.queues.items():
+            if self.running.get(owner, 0) < self.per_owner:
+                task = queue.popleft()
+                if queue:
+                    self.queues.move_to_end(owner)  # Next turn goes to the other owners
+                else:
+                    del self.queues[owner]
+                self.running[owner] = self.running.get(owner, 0) + 1
+                return owner, task
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                picked = self._next()
+                while picked is None:
+                    self.condition.wait()
+                    picked = self._next()
+            owner, (future, fn, args, context) = picked
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(context.run(fn, *args))
+                except BaseException as task_error:
+                    future.set_exception(task_error)
+            with self.condition:
+                self.running[owner] -= 1
+                if not self.running[owner]:
+                    del self.running[owner]
+                self.condition.notify_all()
+
+    def pending(self):
+        with self.condition:
+            return {str(owner): len(queue) for owner, queue in self.queues.items()}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide scheduler: MODEL_WORKERS calls in total, MAX_CONCURRENT_CHUNKS per document"""
+    global _scheduler
+    with _scheduler_lock:
+        if not _scheduler:
+            workers = int(os.getenv('MODEL_WORKERS', os.getenv('AI_MAX_CONCURRENCY', '8')))
+            per_owner = max(1, int(os.getenv('MAX_CONCURRENT_CHUNKS', '4')))
+            _scheduler = FairScheduler(workers, per_owner)
+            logging.info(f"Model call scheduler: {workers} workers, {per_owner} per document")
+        return _scheduler
@@ -0,0 +1,189 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Stage timings and token usage of one analysis. The active trace and stage live in
+# context variables, so calls made on other threads see them when those threads run
+# in a copy of the caller's context (the scheduler and the extraction pool do this).
+_current_trace = contextvars.ContextVar("analysis_trace", default=None)
+_current_stage = contextvars.ContextVar("analysis_stage", default=None)
+
+_otel = None
+_otel_lock = threading.Lock()
+
+
+def _opentelemetry():
+    """(tracer, stage duration histogram, token counter), or False without opentelemetry-api.
+
+    Spans and metrics go to the globally configured OpenTelemetry providers; without
+    any (no SDK or exporter configured) the API's no-op implementations are used.
+    """
+    global _otel
+    with _otel_lock:
+        if _otel is None:
+            try:
+                # Imported on first use, like the Azure SDKs
+                from opentelemetry import metrics, trace
+            except ImportError:
+                _otel = False
+            else:
+                meter = metrics.get_meter("pdf-ai-analyzer")
+                _otel = (
+                    trace.get_tracer("pdf-ai-analyzer"),
+                    meter.create_histogram("analysis.stage.duration", unit="ms", description="Duration of an analysis stage"),
+                    meter.create_counter("analysis.tokens", unit="{token}", description="Model tokens used, by stage and kind")
+                )
+        return _otel
+
+
+def configure_exporter():
+    """Export spans and metrics to Application Insights when TELEMETRY_EXPORTER=azure_monitor.
+
+    Needs azure-monitor-opentelemetry (see requirements.txt) and
+    APPLICATIONINSIGHTS_CONNECTION_STRING. Otherwise spans go to whatever
+    OpenTelemetry providers the host has configured, if any.
+    """
+    if os.getenv('TELEMETRY_EXPORTER', 'none').lower() != 'azure_monitor':
+        return
+    try:
+        from azure.monitor.opentelemetry import configure_azure_monitor
+    except ImportError:
+        logging.warning("TELEMETRY_EXPORTER=azure_monitor, but azure-monitor-opentelemetry is not installed")
+        return
+    configure_azure_monitor()
+    logging.info("Exporting analysis telemetry to Azure Monitor")
+
+
+class StageSpan:
+    """Attributes of the running stage; set() adds to them (and to the OpenTelemetry span)"""
+
+    def __init__(self, name, attributes, span=None):
+        self.name = name
+        self.attributes = attributes
+        self.span = span
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        if self.span is not None:
+            for key, value in attributes.items():
+                if value is not None:
+                    self.span.set_attribute(key, value)
+
+
+class AnalysisTrace:
+    """Collects stage durations and token usage for one analysis"""
+
+    def __init__(self, file_id):
+        self.file_id = file_id
+        self.started = time.perf_counter()
+        self.stages = {}  # name -> {"ms", "calls", "max_ms"}
+        self.usage = {}   # stage name -> {"prompt_tokens", "completion_tokens", "total_tokens", "calls", "estimated"}
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, ms):
+        with self.lock:
+            entry = self.stages.setdefault(name, {"ms": 0.0, "calls": 0, "max_ms": 0.0})
+            entry["ms"] += ms
+            entry["calls"] += 1
+            entry["max_ms"] = max(entry["max_ms"], ms)
+
+    def add_usage(self, stage, prompt_tokens, completion_tokens, estimated):
+        with self.lock:
+            entry = self.usage.setdefault(stage, {
+                "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "calls": 0, "estimated": 0
+            })
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["total_tokens"] += prompt_tokens + completion_tokens
+            entry["calls"] += 1
+            entry["estimated"] += int(estimated)
+
+    def timings(self):
+        """{"total_ms", "stages": {name: {"ms", "calls", "max_ms"}}}; stages that run in
+        parallel (map.chunk, synthesis.call) add up to more than their wall time"""
+        with self.lock:
+            stages = {
+                name: {key: round(value, 1) if isinstance(value, float) else value for key, value in entry.items()}
+                for name, entry in self.stages.items()
+            }
+        return {"total_ms": round((time.perf_counter() - self.started) * 1000, 1), "stages": stages}
+
+    def usage_summary(self):
+        """Token totals for the analysis, and per stage; "estimated" counts calls whose
+        usage the service didn't report (streamed answers), counted locally instead"""
+        with self.lock:
+            by_stage = {name: dict(entry) for name, entry in self.usage.items()}
+        totals = {key: sum(entry[key] for entry in by_stage.values()) for key in (
+            "prompt_tokens", "completion_tokens", "total_tokens", "calls", "estimated"
+        )}
+        return dict(totals, by_stage=by_stage)
+
+
+@contextmanager
+def analysis_trace(file_id):
+    """Trace one analysis: a root span, and the trace that stage() and record_usage() report to"""
+    trace = AnalysisTrace(file_id)
+    otel = _opentelemetry()
+    token = _current_trace.set(trace)
+    try:
+        if otel:
+            with otel[0].start_as_current_span("analyze", attributes={"file_id": file_id}):
+                yield trace
+        else:
+            yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def stage(name, **attributes):
+    """Time a stage of the current analysis, as a span and a duration metric.
+
+    Yields a StageSpan for attributes known only at the end (bytes, pages, the
+    fallback taken). Model calls made inside the stage have their usage counted
+    under its name. Without an active analysis trace, only the span is recorded.
+    """
+    trace = _current_trace.get()
+    otel = _opentelemetry()
+    stage_token = _current_stage.set(name)
+    started = time.perf_counter()
+    try:
+        if otel:
+            with otel[0].start_as_current_span(name) as span:
+                current = StageSpan(name, {}, span)
+                current.set(**attributes)
+                yield current
+        else:
+            yield StageSpan(name, dict(attributes))
+    finally:
+        _current_stage.reset(stage_token)
+        ms = (time.perf_counter() - started) * 1000
+        if trace:
+            trace.add_stage(name, ms)
+        if otel:
+            otel[1].record(ms, {"stage": name})
+
+
+def record_usage(usage, estimate=None):
+    """Count a model call's tokens under the current stage.
+
+    usage is the response's usage (prompt_tokens/completion_tokens); when the service
+    didn't report it, estimate gives (prompt_tokens, completion_tokens) counted locally.
+    """
+    if usage is not None:
+        prompt_tokens, completion_tokens, estimated = usage.prompt_tokens, usage.completion_tokens, False
+    elif estimate:
+        (prompt_tokens, completion_tokens), estimated = estimate, True
+    else:
+        return
+    name = _current_stage.get() or "other"
+    trace = _current_trace.get()
+    if trace:
+        trace.add_usage(name, prompt_tokens, completion_tokens, estimated)
+    otel = _opentelemetry()
+    if otel:
+        otel[2].add(prompt_tokens, {"stage": name, "kind": "prompt"})
+        otel[2].add(completion_tokens, {"stage": name, "kind": "completion"})
@@ -0,0 +1,105 @@
+import base64
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+
+ALLOWED_EXTENSIONS = ('.pdf', '.txt', '.csv', '.doc', '.docx')
+
+# Uploads are read and staged in blocks of this size, so a request holds at most one block
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class UploadError(Exception):
+    """An upload that is rejected, with the HTTP status to report"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def max_upload_bytes():
+    return int(os.getenv('MAX_UPLOAD_MB', '50')) * 1024 * 1024
+
+
+def _too_large():
+    return UploadError(f"File size too large. Maximum allowed size is {max_upload_bytes() // (1024*1024)}MB")
+
+
+def _block_id(index):
+    # Block ids must be base64 and of equal length within a blob
+    return base64.b64encode(f"{index:06d}".encode()).decode()
+
+
+def stream_to_blob(blob_client, stream, block_size=UPLOAD_BLOCK_SIZE):
+    """Copy a file-like object to a block blob, one block at a time.
+
+    The size limit and SHA-256 are checked as the blocks are read, so an oversized
+    upload is rejected after MAX_UPLOAD_MB without reading the rest. The sha256 is
+    stored as blob metadata. Returns (size, sha256).
+    """
+    limit = max_upload_bytes()
+    digest = hashlib.sha256()
+    size = 0
+    block_ids = []
+    block = stream.read(block_size)
+    while block:
+        size += len(block)
+        if size > limit:
+            # Staged but uncommitted blocks are discarded by the storage service
+            raise _too_large()
+        digest.update(block)
+        next_block = stream.read(block_size)
+        if not block_ids and not next_block:
+            # Fits in one block: a single request instead of stage + commit
+            blob_client.upload_blob(block, overwrite=True, metadata={"sha256": digest.hexdigest()})
+            return size, digest.hexdigest()
+        block_ids.append(_block_id(len(block_ids)))
+        blob_client.stage_block(block_ids[-1], block)
+        block = next_block
+
+    if not size:
+        raise UploadError("Empty file not allowed")
+    blob_client.commit_block_list(block_ids, metadata={"sha256": digest.hexdigest()})
+    return size, digest.hexdigest()
+
+
+def register_blob(blob_client):
+    """Check and hash a blob the client uploaded directly, storing the sha256 as metadata.
+
+    Oversized or empty blobs are deleted. Returns (size, sha256).
+    """
+    size = blob_client.get_blob_properties().size
+    if not size or size > max_upload_bytes():
+        blob_client.delete_blob()
+        raise UploadError("Empty file not allowed") if not size else _too_large()
+    digest = hashlib.sha256()
+    for block in blob_client.download_blob().chunks():
+        digest.update(block)
+    blob_client.set_blob_metadata({"sha256": digest.hexdigest()})
+    return size, digest.hexdigest()
+
+
+def upload_sas_url(blob_service_client, blob_client):
+    """Short-lived URL the client can PUT the file to directly (create/write on this blob only).
+
+    Signed with the account key when the client has one, otherwise with a user
+    delegation key (managed identity). Valid for UPLOAD_SAS_TTL_MINUTES.
+    """
+    from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+
+    now = datetime.now(timezone.utc)
+    expiry = now + timedelta(minutes=int(os.getenv('UPLOAD_SAS_TTL_MINUTES', '15')))
+    account_key = getattr(blob_service_client.credential, 'account_key', None)
+    delegation_key = None
+    if not account_key:
+        delegation_key = blob_service_client.get_user_delegation_key(now - timedelta(minutes=5), expiry)
+    sas = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=account_key,
+        user_delegation_key=delegation_key,
+        permission=BlobSasPermissions(create=True, write=True),
+        start=now - timedelta(minutes=5),
+        expiry=expiry
+    )
+    return f"{blob_client.url}?{sas}"
@@ -43,30 +43,179 @@ const theme = createTheme({
   },
 });
 
+const STAGE_LABELS = {
+  queued: 'I kø...',
+  downloading: 'Henter dokument...',
+  extracting: 'Leser tekst fra dokumentet...',
+  analyzing: 'Analyserer dokument...',
+  synthesizing: 'Setter sammen analysen...'
+};
+
+const JOB_POLL_INTERVAL_MS = 2000;
+
+// Upload straight to Blob Storage with a short-lived SAS URL (needs CORS on the storage account)
+const DIRECT_UPLOAD = import.meta.env.VITE_DIRECT_UPLOAD === 'true';
+
+const uploadViaApi = async (file) => {
+  const formData = new FormData();
+  formData.append('file', file);
+  
+  const uploadResponse = await fetch('/api/upload', {
+    method: 'POST',
+    body: formData
+  });
+  
+  if (!uploadResponse.ok) {
+    throw new Error(`Upload failed: ${uploadResponse.statusText}`);
+  }
+  return uploadResponse.json();
+};
+
+const uploadDirect = async (file) => {
+  const sasResponse = await fetch('/api/upload/sas', {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ filename: file.name })
+  });
+  if (!sasResponse.ok) {
+    throw new Error(`Upload failed: ${sasResponse.statusText}`);
+  }
+  const upload = await sasResponse.json();
+  
+  const putResponse = await fetch(upload.upload_url, {
+    method: 'PUT',
+    headers: { ...upload.headers, 'Content-Type': file.type || 'application/octet-stream' },
+    body: file
+  });
+  if (!putResponse.ok) {
+    throw new Error(`Upload failed: ${putResponse.statusText}`);
+  }
+  
+  // Lets the API check the size and record the content hash
+  const completeResponse = await fetch(upload.complete_url, { method: 'POST' });
+  if (!completeResponse.ok) {
+    throw new Error(`Upload failed: ${completeResponse.statusText}`);
+  }
+  return completeResponse.json();
+};
+
+// Entities and red flags from the analyzed chunks, without duplicates
+const mergeUnique = (items, more) => {
+  const seen = new Set(items.map((item) => item.toLowerCase()));
+  return items.concat((more || []).filter((item) => {
+    const key = item.toLowerCase();
+    if (seen.has(key)) return false;
+    seen.add(key);
+    return true;
+  }));
+};
+
+// Turn the partial results received so far into what ResultsDisplay shows
+const partialResult = (partial) => {
+  const keyPoints = [...partial.chunkPoints];
+  if (partial.personer.length) keyPoints.push(`Personer: ${partial.personer.slice(0, 5).join(', ')}`);
+  if (partial.selskaper.length) keyPoints.push(`Selskaper: ${partial.selskaper.slice(0, 5).join(', ')}`);
+  partial.flags.slice(0, 5).forEach((flag) => keyPoints.push(`Rødt flagg: ${flag}`));
+  return {
+    partial: true,
+    summary: partial.summary.join(' '),
+    keyPoints,
+    stage: partial.stage,
+    chunksCompleted: partial.chunksCompleted,
+    chunksTotal: partial.chunksTotal
+  };
+};
+
 function App() {
   const [analysisResult, setAnalysisResult] = useState(null);
   const [isAnalyzing, setIsAnalyzing] = useState(false);
+  const [progress, setProgress] = useState(null);
+
+  // Poll an analysis job until it completes or fails, reporting progress along the way
+  const waitForJob = async (statusUrl) => {
+    while (true) {
+      await new Promise((resolve) => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+      const statusResponse = await fetch(statusUrl);
+      if (!statusResponse.ok) {
+        throw new Error(`Kunne ikke hente status: ${statusResponse.statusText}`);
+      }
+      const job = await statusResponse.json();
+      if (job.status === 'completed') {
+        return job.result;
+      }
+      if (job.status === 'failed') {
+        throw new Error(job.error || 'Analysen feilet');
+      }
+      setProgress({
+        stage: job.stage,
+        chunksCompleted: job.chunks_completed,
+        chunksTotal: job.chunks_total
+      });
+    }
+  };
+
+  // Follow an analysis job over server-sent events, showing partial results as they arrive
+  const streamJob = (eventsUrl, onPartial) => new Promise((resolve, reject) => {
+    const partial = {
+      stage: 'queued', chunksCompleted: 0, chunksTotal: null,
+      summary: [], chunkPoints: [], personer: [], selskaper: [], flags: []
+    };
+    const source = new EventSource(eventsUrl);
+    const update = () => onPartial(partialResult(partial));
+
+    source.addEventListener('progress', (e) => {
+      const data = JSON.parse(e.data);
+      partial.stage = data.stage;
+      partial.chunksCompleted = data.chunks_completed;
+      partial.chunksTotal = data.chunks_total;
+      setProgress({
+        stage: data.stage,
+        chunksCompleted: data.chunks_completed,
+        chunksTotal: data.chunks_total
+      });
+      if (partial.chunkPoints.length || partial.summary.length) update();
+    });
+    source.addEventListener('chunk', (e) => {
+      const data = JSON.parse(e.data);
+      const info = data['nøkkelinformasjon'] || {};
+      partial.chunkPoints = partial.chunkPoints.concat((data.sammendrag || []).slice(0, 2));
+      partial.personer = mergeUnique(partial.personer, info.personer);
+      partial.selskaper = mergeUnique(partial.selskaper, info.selskaper);
+      Object.values(data['røde_flagg'] || {}).forEach((flags) => {
+        partial.flags = mergeUnique(partial.flags, flags);
+      });
+      update();
+    });
+    source.addEventListener('summary', (e) => {
+      partial.summary = JSON.parse(e.data);
+      update();
+    });
+    source.addEventListener('completed', (e) => {
+      source.close();
+      resolve(JSON.parse(e.data));
+    });
+    source.addEventListener('failed', (e) => {
+      source.close();
+      reject(new Error(JSON.parse(e.data).error || 'Analysen feilet'));
+    });
+    // The server ends each response and the browser reconnects by itself; only give up when it stops trying
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) {
+        reject(new Error('Mistet forbindelsen til analysen'));
+      }
+    };
+  });
 
   const handleFileAnalysis = async (file) => {
     setIsAnalyzing(true);
+    setProgress(null);
+    setAnalysisResult(null);
     try {
-      // Step 1: Upload PDF to Azure Functions
-      const formData = new FormData();
-      formData.append('file', file);
-      
-      const uploadResponse = await fetch('/api/upload', {
-        method: 'POST',
-        body: formData
-      });
-      
-      if (!uploadResponse.ok) {
-        throw new Error(`Upload failed: ${uploadResponse.statusText}`);
-      }
-      
-      const uploadResult = await uploadResponse.json();
+      // Step 1: Upload PDF to Azure Functions, or straight to Blob Storage when enabled
+      const uploadResult = DIRECT_UPLOAD ? await uploadDirect(file) : await uploadViaApi(file);
       const fileId = uploadResult.file_id;
       
-      // Step 2: Analyze the uploaded PDF
+      // Step 2: Start analysis of the uploaded PDF (returns a job id at once)
       const analysisResponse = await fetch(`/api/analyze/${fileId}`, {
         method: 'POST',
         headers: {
@@ -86,7 +235,12 @@ function App() {
         throw new Error(errorMessage);
       }
       
-      const analysisResult = await analysisResponse.json();
+      const job = await analysisResponse.json();
+      
+      // Step 3: Wait for the background job to finish, streaming partial results where supported
+      const analysisResult = window.EventSource && job.events_url
+        ? await streamJob(job.events_url, setAnalysisResult)
+        : await waitForJob(job.status_url);
       
       // Check if response contains error
       if (analysisResult.error) {
@@ -108,6 +262,7 @@ function App() {
       });
     } finally {
       setIsAnalyzing(false);
+      setProgress(null);
     }
   };
 
@@ -174,13 +329,26 @@ function App() {
             <DocumentUpload onFileSelect={handleFileAnalysis} />
           )}
 
-          {isAnalyzing && (
+          {isAnalyzing && !analysisResult && (
             <Paper sx={{ p: 4, textAlign: 'center' }}>
               <Description sx={{ fontSize: 60, color: 'primary.main', mb: 2 }} />
               <Typography variant="h5" sx={{ mb: 2 }}>
-                Analyserer dokument...
+                {(progress && STAGE_LABELS[progress.stage]) || 'Analyserer dokument...'}
               </Typography>
-              <LinearProgress sx={{ mb: 2 }} />
+              {progress && progress.stage === 'analyzing' && progress.chunksTotal ? (
+                <>
+                  <LinearProgress
+                    variant="determinate"
+                    value={(100 * progress.chunksCompleted) / progress.chunksTotal}
+                    sx={{ mb: 1 }}
+                  />
+                  <Typography variant="body2" color="text.secondary" sx={{ mb: 2 }}>
+                    Del {progress.chunksCompleted} av {progress.chunksTotal} analysert
+                  </Typography>
+                </>
+              ) : (
+                <LinearProgress sx={{ mb: 2 }} />
+              )}
               <Typography variant="body2" color="text.secondary">
                 Dette kan ta noen minutter avhengig av dokumentets størrelse
               </Typography>
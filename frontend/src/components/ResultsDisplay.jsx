@@ -11,7 +11,8 @@ import {
   Chip,
   Divider,
   Card,
-  CardContent
+  CardContent,
+  LinearProgress
 } from '@mui/material';
 import {
   CheckCircle,
@@ -22,7 +23,8 @@ import {
 } from '@mui/icons-material';
 
 const ResultsDisplay = ({ result, onNewAnalysis }) => {
-  const { summary, keyPoints, confidence, full_analysis } = result;
+  // partial results stream in while the analysis runs; the final result replaces them
+  const { summary, keyPoints, confidence, full_analysis, partial, chunksCompleted, chunksTotal } = result;
   
   const getConfidenceColor = (confidence) => {
     if (confidence >= 0.8) return 'success';
@@ -43,23 +45,39 @@ const ResultsDisplay = ({ result, onNewAnalysis }) => {
         <Box sx={{ display: 'flex', justifyContent: 'space-between', alignItems: 'center', mb: 2 }}>
           <Typography variant="h4" sx={{ color: 'primary.main', display: 'flex', alignItems: 'center' }}>
             <Article sx={{ mr: 2, fontSize: 40 }} />
-            Analyse ferdig
+            {partial ? 'Analyse pågår' : 'Analyse ferdig'}
           </Typography>
-          <Box sx={{ display: 'flex', alignItems: 'center', gap: 1 }}>
-            <Chip 
-              label={getConfidenceText(confidence)}
-              color={getConfidenceColor(confidence)}
-              icon={<CheckCircle />}
-            />
-            <Chip 
-              label={`${Math.round(confidence * 100)}%`}
-              variant="outlined"
-            />
-          </Box>
+          {!partial && (
+            <Box sx={{ display: 'flex', alignItems: 'center', gap: 1 }}>
+              <Chip 
+                label={getConfidenceText(confidence)}
+                color={getConfidenceColor(confidence)}
+                icon={<CheckCircle />}
+              />
+              <Chip 
+                label={`${Math.round(confidence * 100)}%`}
+                variant="outlined"
+              />
+            </Box>
+          )}
         </Box>
-        <Typography variant="body2" color="text.secondary">
-          Dokumentet har blitt analysert med AI. Se resultatet nedenfor.
-        </Typography>
+        {partial ? (
+          <>
+            <LinearProgress
+              variant={chunksTotal ? 'determinate' : 'indeterminate'}
+              value={chunksTotal ? (100 * chunksCompleted) / chunksTotal : 0}
+              sx={{ mb: 1 }}
+            />
+            <Typography variant="body2" color="text.secondary">
+              {chunksTotal ? `Del ${chunksCompleted} av ${chunksTotal} analysert. ` : ''}
+              Foreløpige funn vises under og oppdateres fortløpende.
+            </Typography>
+          </>
+        ) : (
+          <Typography variant="body2" color="text.secondary">
+            Dokumentet har blitt analysert med AI. Se resultatet nedenfor.
+          </Typography>
+        )}
       </Paper>
 
       {/* Summary */}
@@ -69,8 +87,8 @@ const ResultsDisplay = ({ result, onNewAnalysis }) => {
             <Insights sx={{ mr: 1 }} />
             Oppsummering
           </Typography>
-          <Typography variant="body1" sx={{ lineHeight: 1.7 }}>
-            {summary}
+          <Typography variant="body1" sx={{ lineHeight: 1.7 }} color={summary ? 'text.primary' : 'text.secondary'}>
+            {summary || 'Oppsummeringen lages når alle delene av dokumentet er analysert...'}
           </Typography>
         </CardContent>
       </Card>
@@ -80,7 +98,7 @@ const ResultsDisplay = ({ result, onNewAnalysis }) => {
         <CardContent>
           <Typography variant="h5" sx={{ mb: 2, display: 'flex', alignItems: 'center' }}>
             <TrendingUp sx={{ mr: 1 }} />
-            Hovedpunkter
+            {partial ? 'Funn så langt' : 'Hovedpunkter'}
           </Typography>
           <List>
             {keyPoints.map((point, index) => (
@@ -126,33 +144,37 @@ const ResultsDisplay = ({ result, onNewAnalysis }) => {
         </Card>
       )}
 
-      <Divider sx={{ my: 3 }} />
+      {!partial && (
+        <>
+          <Divider sx={{ my: 3 }} />
 
-      {/* Action Buttons */}
-      <Box sx={{ textAlign: 'center' }}>
-        <Button
-          variant="contained"
-          size="large"
-          startIcon={<Refresh />}
-          onClick={onNewAnalysis}
-          sx={{ minWidth: 200 }}
-        >
-          Analyser nytt dokument
-        </Button>
-      </Box>
+          {/* Action Buttons */}
+          <Box sx={{ textAlign: 'center' }}>
+            <Button
+              variant="contained"
+              size="large"
+              startIcon={<Refresh />}
+              onClick={onNewAnalysis}
+              sx={{ minWidth: 200 }}
+            >
+              Analyser nytt dokument
+            </Button>
+          </Box>
 
-      {/* Footer */}
-      <Typography 
-        variant="caption" 
-        sx={{ 
-          display: 'block', 
-          textAlign: 'center', 
-          mt: 3, 
-          color: 'text.secondary' 
-        }}
-      >
-        Analyse utført av Azure AI Services • Dagens Næringsliv
-      </Typography>
+          {/* Footer */}
+          <Typography 
+            variant="caption" 
+            sx={{ 
+              display: 'block', 
+              textAlign: 'center', 
+              mt: 3, 
+              color: 'text.secondary' 
+            }}
+          >
+            Analyse utført av Azure AI Services • Dagens Næringsliv
+          </Typography>
+        </>
+      )}
     </Box>
   );
 };